@@ -30,8 +30,10 @@ def hit_esmfold(sequence):
     return hit_model_endpoint('esmfold', [sequence])[0]
 
 @mlflow.trace(span_type="TOOL")
-def hit_rfdiffusion(input_dict):
-    return hit_model_endpoint('rfdiffusion_inpainting', [input_dict])[0]
+def hit_rfdiffusion(input_dict, num_designs=1, chain='A'):
+    # a list of designs, num_designs of them (unless input_dict sets 'num_designs')
+    input_dict = {'num_designs': num_designs, 'chain': chain, **input_dict}
+    return hit_model_endpoint('rfdiffusion_inpainting', [input_dict])
 
 @mlflow.trace(span_type="TOOL")
 def hit_proteinmpnn(pdb_str):
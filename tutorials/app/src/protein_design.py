@@ -38,7 +38,8 @@ def hit_esmfold(sequence):
 
 @mlflow.trace(span_type="TOOL")
 def hit_rfdiffusion(input_dict):
-    return hit_model_endpoint('rfdiffusion_inpainting', [input_dict])[0]
+    # a list of designs, input_dict['num_designs'] of them
+    return hit_model_endpoint('rfdiffusion_inpainting', [input_dict])
 
 @mlflow.trace(span_type="TOOL")
 def hit_proteinmpnn(pdb_str):
@@ -103,14 +104,14 @@ def make_designs(sequence, n_rfdiffusion_hits=1):
     )
 
     # now pass that modified structure to rfdifffusion as string
-    designed_pdb_strs = []
-    for i in range(n_rfdiffusion_hits):
-        designed_pdb = hit_rfdiffusion({
-            'pdb': modified_pdb_text,
-            'start_idx': seq_details['start_idx'],
-            'end_idx': seq_details['end_idx'],
-        })
-        designed_pdb_strs.append(designed_pdb)
+    # all designs come from one request, sharing the preprocessing of the input structure
+    designed_pdb_strs = hit_rfdiffusion({
+        'pdb': modified_pdb_text,
+        'start_idx': seq_details['start_idx'],
+        'end_idx': seq_details['end_idx'],
+        'num_designs': n_rfdiffusion_hits,
+        'chain': 'A',
+    })
     
     all_seqs = []
     for pdb_ in designed_pdb_strs:
@@ -14,13 +14,22 @@
 
 # modified from original:
 # - alphafold imports are instead local imports
+# - adding a local sharded search mode (shard_fasta_database, num_shards)
+# - adding query_batch to search many queries concurrently
+# - adding query_async/query_batch_async, running jackhmmer through
+#   dbboltz.tool_runner (timeouts, cancellation, stderr streaming)
 
 """Library to run Jackhmmer from Python."""
 
+import asyncio
 from concurrent import futures
+import fcntl
 import glob
+import hashlib
+import json
 import os
 import subprocess
+import tempfile
 from typing import Any, Callable, Mapping, Optional, Sequence
 from urllib import request
 
@@ -28,9 +37,138 @@ from absl import logging
 
 from . import parsers
 from . import utils
+from .. import target_db
+from .. import tool_runner
 # Internal import (7716).
 
 
+def _prefetch(path: str):
+  """Asks the OS to start reading a file into the page cache."""
+  if not hasattr(os, 'posix_fadvise'):
+    return
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+  finally:
+    os.close(fd)
+
+
+def _shard_prefix(database_path: str, shard_dir: str) -> str:
+  # the path hash keeps databases with the same file name apart in a shared shard_dir
+  path_hash = hashlib.blake2b(os.path.abspath(database_path).encode('utf-8'),
+                              digest_size=6).hexdigest()
+  return os.path.join(shard_dir,
+                      f'{os.path.basename(database_path)}.{path_hash}')
+
+
+def _shard_manifest_path(database_path: str, shard_dir: str) -> str:
+  return _shard_prefix(database_path, shard_dir) + '.shards.json'
+
+
+def _read_shard_manifest(manifest_path: str, source: Mapping[str, Any],
+                         num_shards: int) -> Optional[Mapping[str, Any]]:
+  """The manifest at manifest_path if it describes usable shards of source."""
+  try:
+    with open(manifest_path) as f:
+      manifest = json.load(f)
+  except (FileNotFoundError, json.JSONDecodeError):
+    return None
+  if (manifest['source'] == source and
+      manifest.get('requested_shards') == num_shards and
+      all(os.path.exists(p) for p in manifest['shards'])):
+    return manifest
+  return None
+
+
+def shard_fasta_database(database_path: str,
+                         num_shards: int,
+                         shard_dir: Optional[str] = None) -> Mapping[str, Any]:
+  """Splits a FASTA database into num_shards files of roughly equal size.
+
+  The shards and a JSON manifest are written to shard_dir. If a manifest for
+  the same database file (path, size and mtime) and number of shards already
+  exists it is reused, so this is cheap to call before every search.
+
+  Sharding holds a file lock in shard_dir, so concurrent requests for the same
+  database shard it once, and every shard is written to a temporary file and
+  renamed into place, so a search never reads a partially written shard. A
+  database with fewer sequences than num_shards gets one shard per sequence.
+
+  Args:
+    database_path: The FASTA database to split.
+    num_shards: The number of shards.
+    shard_dir: Directory for the shards and manifest, by default the writable
+      target database directory (databases are often on read-only volumes).
+
+  Returns:
+    The manifest: the source file details, 'num_sequences' in the full database
+    (to be used as the jackhmmer -Z value) and the list of 'shards' paths.
+  """
+  if shard_dir is None:
+    shard_dir = target_db.DEFAULT_ROOT
+  os.makedirs(shard_dir, exist_ok=True)
+  stat = os.stat(database_path)
+  source = dict(path=os.path.abspath(database_path),
+                size=stat.st_size,
+                mtime=stat.st_mtime)
+
+  manifest_path = _shard_manifest_path(database_path, shard_dir)
+  manifest = _read_shard_manifest(manifest_path, source, num_shards)
+  if manifest is not None:
+    return manifest
+
+  with open(manifest_path + '.lock', 'w') as lock_file:
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    # another request may have sharded the database while we waited
+    manifest = _read_shard_manifest(manifest_path, source, num_shards)
+    if manifest is not None:
+      return manifest
+
+    prefix = _shard_prefix(database_path, shard_dir)
+    shard_paths = [f'{prefix}.shard{i}' for i in range(num_shards)]
+    shard_sequences = [0] * num_shards
+    target_size = stat.st_size / num_shards
+    num_sequences = 0
+    shard_index = 0
+    written = 0
+    basename = os.path.basename(database_path)
+    with utils.timing(f'Sharding {basename} into {num_shards}'):
+      shard_files = [open(p + '.tmp', 'wb') for p in shard_paths]
+      try:
+        with open(database_path, 'rb') as f:
+          for line in f:
+            if line.startswith(b'>'):
+              # Only move to the next shard at a record boundary.
+              if (written >= target_size * (shard_index + 1) and
+                  shard_index < num_shards - 1 and
+                  shard_sequences[shard_index]):
+                shard_index += 1
+              num_sequences += 1
+              shard_sequences[shard_index] += 1
+            shard_files[shard_index].write(line)
+            written += len(line)
+      finally:
+        for shard_file in shard_files:
+          shard_file.close()
+
+    # Shards left empty (fewer sequences than shards) are not searched.
+    kept = [p for p, n in zip(shard_paths, shard_sequences) if n] or shard_paths[:1]
+    for p in shard_paths:
+      if p in kept:
+        os.replace(p + '.tmp', p)
+      else:
+        os.remove(p + '.tmp')
+
+    manifest = dict(source=source, num_sequences=num_sequences,
+                    requested_shards=num_shards, shards=kept)
+    # Write the manifest last so a partially written set of shards is never used.
+    fd, tmp_path = tempfile.mkstemp(dir=shard_dir, suffix='.shards.json.tmp')
+    with os.fdopen(fd, 'w') as f:
+      json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+  return manifest
+
+
 class Jackhmmer:
   """Python wrapper of the Jackhmmer binary."""
 
@@ -49,7 +187,9 @@ class Jackhmmer:
                incdom_e: Optional[float] = None,
                dom_e: Optional[float] = None,
                num_streamed_chunks: Optional[int] = None,
-               streaming_callback: Optional[Callable[[int], None]] = None):
+               streaming_callback: Optional[Callable[[int], None]] = None,
+               num_shards: Optional[int] = None,
+               shard_dir: Optional[str] = None):
     """Initializes the Python Jackhmmer wrapper.
 
     Args:
@@ -69,6 +209,12 @@ class Jackhmmer:
       num_streamed_chunks: Number of database chunks to stream over.
       streaming_callback: Callback function run after each chunk iteration with
         the iteration number as argument.
+      num_shards: Split the (local) database into this many shards and search
+        them concurrently, dividing n_cpu between the searches. The results
+        are merged into one alignment ordered by E-value. Only supported with
+        n_iter=1: each shard would build its profile from its own hits only.
+      shard_dir: Where to keep the shards (a writable directory), see
+        shard_fasta_database.
     """
     self.binary_path = binary_path
     self.database_path = database_path
@@ -89,49 +235,108 @@ class Jackhmmer:
     self.dom_e = dom_e
     self.get_tblout = get_tblout
     self.streaming_callback = streaming_callback
+    self.num_shards = num_shards
+    self.shard_dir = shard_dir
+
+    if num_shards is not None and num_streamed_chunks is not None:
+      raise ValueError('num_shards and num_streamed_chunks can not be combined')
+    if num_shards is not None and n_iter > 1:
+      raise ValueError('num_shards can only be used with n_iter=1')
+
+  def _build_command(self,
+                     input_fasta_path: str,
+                     database_path: str,
+                     query_tmp_dir: str,
+                     n_cpu: int,
+                     z_value: Optional[int],
+                     get_tblout: bool) -> Sequence[str]:
+    """Returns the Jackhmmer command writing its outputs to query_tmp_dir."""
+    sto_path = os.path.join(query_tmp_dir, 'output.sto')
+
+    # The F1/F2/F3 are the expected proportion to pass each of the filtering
+    # stages (which get progressively more expensive), reducing these
+    # speeds up the pipeline at the expensive of sensitivity.  They are
+    # currently set very low to make querying Mgnify run in a reasonable
+    # amount of time.
+    cmd_flags = [
+        # Don't pollute stdout with Jackhmmer output.
+        '-o', '/dev/null',
+        '-A', sto_path,
+        '--noali',
+        '--F1', str(self.filter_f1),
+        '--F2', str(self.filter_f2),
+        '--F3', str(self.filter_f3),
+        '--incE', str(self.e_value),
+        # Report only sequences with E-values <= x in per-sequence output.
+        '-E', str(self.e_value),
+        '--cpu', str(n_cpu),
+        '-N', str(self.n_iter)
+    ]
+    if get_tblout:
+      tblout_path = os.path.join(query_tmp_dir, 'tblout.txt')
+      cmd_flags.extend(['--tblout', tblout_path])
+
+    if z_value:
+      cmd_flags.extend(['-Z', str(z_value)])
+
+    if self.dom_e is not None:
+      cmd_flags.extend(['--domE', str(self.dom_e)])
+
+    if self.incdom_e is not None:
+      cmd_flags.extend(['--incdomE', str(self.incdom_e)])
+
+    return [self.binary_path] + cmd_flags + [input_fasta_path, database_path]
+
+  def _read_outputs(self,
+                    query_tmp_dir: str,
+                    retcode: int,
+                    stderr: bytes,
+                    max_sequences: Optional[int],
+                    get_tblout: bool) -> Mapping[str, Any]:
+    """Collects the outputs a Jackhmmer command wrote to query_tmp_dir."""
+    if retcode:
+      raise RuntimeError(
+          'Jackhmmer failed\nstderr:\n%s\n' % stderr.decode('utf-8'))
+
+    # Get e-values for each target name
+    tbl = ''
+    if get_tblout:
+      with open(os.path.join(query_tmp_dir, 'tblout.txt')) as f:
+        tbl = f.read()
+
+    sto_path = os.path.join(query_tmp_dir, 'output.sto')
+    if max_sequences is None:
+      with open(sto_path) as f:
+        sto = f.read()
+    else:
+      sto = parsers.truncate_stockholm_msa(sto_path, max_sequences)
+
+    raw_output = dict(
+        sto=sto,
+        tbl=tbl,
+        stderr=stderr,
+        n_iter=self.n_iter,
+        e_value=self.e_value)
+
+    return raw_output
 
   def _query_chunk(self,
                    input_fasta_path: str,
                    database_path: str,
-                   max_sequences: Optional[int] = None) -> Mapping[str, Any]:
-    """Queries the database chunk using Jackhmmer."""
+                   max_sequences: Optional[int] = None,
+                   n_cpu: Optional[int] = None,
+                   z_value: Optional[int] = None,
+                   get_tblout: Optional[bool] = None) -> Mapping[str, Any]:
+    """Queries the database chunk using Jackhmmer.
+
+    n_cpu, z_value and get_tblout override the values set at initialization.
+    """
+    n_cpu = self.n_cpu if n_cpu is None else n_cpu
+    z_value = self.z_value if z_value is None else z_value
+    get_tblout = self.get_tblout if get_tblout is None else get_tblout
     with utils.tmpdir_manager() as query_tmp_dir:
-      sto_path = os.path.join(query_tmp_dir, 'output.sto')
-
-      # The F1/F2/F3 are the expected proportion to pass each of the filtering
-      # stages (which get progressively more expensive), reducing these
-      # speeds up the pipeline at the expensive of sensitivity.  They are
-      # currently set very low to make querying Mgnify run in a reasonable
-      # amount of time.
-      cmd_flags = [
-          # Don't pollute stdout with Jackhmmer output.
-          '-o', '/dev/null',
-          '-A', sto_path,
-          '--noali',
-          '--F1', str(self.filter_f1),
-          '--F2', str(self.filter_f2),
-          '--F3', str(self.filter_f3),
-          '--incE', str(self.e_value),
-          # Report only sequences with E-values <= x in per-sequence output.
-          '-E', str(self.e_value),
-          '--cpu', str(self.n_cpu),
-          '-N', str(self.n_iter)
-      ]
-      if self.get_tblout:
-        tblout_path = os.path.join(query_tmp_dir, 'tblout.txt')
-        cmd_flags.extend(['--tblout', tblout_path])
-
-      if self.z_value:
-        cmd_flags.extend(['-Z', str(self.z_value)])
-
-      if self.dom_e is not None:
-        cmd_flags.extend(['--domE', str(self.dom_e)])
-
-      if self.incdom_e is not None:
-        cmd_flags.extend(['--incdomE', str(self.incdom_e)])
-
-      cmd = [self.binary_path] + cmd_flags + [input_fasta_path,
-                                              database_path]
+      cmd = self._build_command(input_fasta_path, database_path, query_tmp_dir,
+                                n_cpu, z_value, get_tblout)
 
       logging.info('Launching subprocess "%s"', ' '.join(cmd))
       process = subprocess.Popen(
@@ -141,30 +346,44 @@ class Jackhmmer:
         _, stderr = process.communicate()
         retcode = process.wait()
 
-      if retcode:
-        raise RuntimeError(
-            'Jackhmmer failed\nstderr:\n%s\n' % stderr.decode('utf-8'))
-
-      # Get e-values for each target name
-      tbl = ''
-      if self.get_tblout:
-        with open(tblout_path) as f:
-          tbl = f.read()
-
-      if max_sequences is None:
-        with open(sto_path) as f:
-          sto = f.read()
-      else:
-        sto = parsers.truncate_stockholm_msa(sto_path, max_sequences)
+      return self._read_outputs(query_tmp_dir, retcode, stderr, max_sequences,
+                                get_tblout)
 
-    raw_output = dict(
-        sto=sto,
-        tbl=tbl,
-        stderr=stderr,
-        n_iter=self.n_iter,
-        e_value=self.e_value)
+  async def _query_chunk_async(
+      self,
+      input_fasta_path: str,
+      database_path: str,
+      max_sequences: Optional[int] = None,
+      n_cpu: Optional[int] = None,
+      timeout: Optional[float] = None,
+      runner: Optional[tool_runner.ToolRunner] = None,
+      z_value: Optional[int] = None,
+      get_tblout: Optional[bool] = None) -> Mapping[str, Any]:
+    """_query_chunk run through a ToolRunner, see query_async."""
+    n_cpu = self.n_cpu if n_cpu is None else n_cpu
+    z_value = self.z_value if z_value is None else z_value
+    get_tblout = self.get_tblout if get_tblout is None else get_tblout
+    if runner is None:
+      runner = tool_runner.ToolRunner()
+    with utils.tmpdir_manager() as query_tmp_dir:
+      cmd = self._build_command(input_fasta_path, database_path, query_tmp_dir,
+                                n_cpu, z_value, get_tblout)
+      result = await runner.run(
+          cmd, timeout=timeout,
+          span_name=f'Jackhmmer ({os.path.basename(database_path)}) query')
+      return self._read_outputs(query_tmp_dir, result.returncode,
+                                result.stderr, max_sequences, get_tblout)
 
-    return raw_output
+  async def _gather_or_cancel(self, coroutines) -> list:
+    """Awaits all coroutines; if one fails the others are cancelled."""
+    tasks = [asyncio.ensure_future(c) for c in coroutines]
+    try:
+      return await asyncio.gather(*tasks)
+    except BaseException:
+      for task in tasks:
+        task.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
+      raise
 
   def query(self,
             input_fasta_path: str,
@@ -172,12 +391,111 @@ class Jackhmmer:
     """Queries the database using Jackhmmer."""
     return self.query_multiple([input_fasta_path], max_sequences)[0]
 
+  async def query_async(
+      self,
+      input_fasta_path: str,
+      max_sequences: Optional[int] = None,
+      timeout: Optional[float] = None,
+      runner: Optional[tool_runner.ToolRunner] = None,
+    ) -> Sequence[Mapping[str, Any]]:
+    """Queries the local database using Jackhmmer without blocking.
+
+    The search runs through a ToolRunner: it is killed when timeout (seconds)
+    expires, raising ToolTimeoutError, or when the awaiting task is cancelled,
+    waits for a free slot of the per process tool limit, and streams its stderr
+    into mlflow span events.
+    """
+    if self.num_streamed_chunks is not None:
+      raise ValueError('query_async only supports searching a local database')
+    if self.num_shards is not None:
+      return [await self._query_sharded_async(
+          input_fasta_path, max_sequences, timeout=timeout, runner=runner)]
+    return [await self._query_chunk_async(
+        input_fasta_path, self.database_path, max_sequences,
+        timeout=timeout, runner=runner)]
+
+  async def query_batch_async(
+      self,
+      input_fasta_paths: Sequence[str],
+      max_sequences: Optional[int] = None,
+      timeout: Optional[float] = None,
+      runner: Optional[tool_runner.ToolRunner] = None,
+    ) -> Sequence[Sequence[Mapping[str, Any]]]:
+    """query_batch without blocking, see query_async.
+
+    If one query fails or times out the others are cancelled (and killed).
+    With num_shards, the queries run one after another, each searching all
+    shards concurrently (as in query_multiple), and timeout applies per query.
+    """
+    if self.num_streamed_chunks is not None:
+      raise ValueError('query_batch_async only supports searching a local '
+                       'database')
+    if self.num_shards is not None:
+      return [[await self._query_sharded_async(
+          input_fasta_path, max_sequences, timeout=timeout, runner=runner)]
+              for input_fasta_path in input_fasta_paths]
+    n_cpu = max(1, self.n_cpu // max(1, len(input_fasta_paths)))
+    _prefetch(self.database_path)
+    outputs = await self._gather_or_cancel(
+        self._query_chunk_async(
+            input_fasta_path, self.database_path, max_sequences,
+            n_cpu=n_cpu, timeout=timeout, runner=runner)
+        for input_fasta_path in input_fasta_paths)
+    return [[output] for output in outputs]
+
+  def query_batch(
+      self,
+      input_fasta_paths: Sequence[str],
+      max_sequences: Optional[int] = None,
+      max_concurrent: Optional[int] = None,
+    ) -> Sequence[Sequence[Mapping[str, Any]]]:
+    """Queries the database for many queries at once.
+
+    Instead of one query after the other, each re-reading the database, the
+    queries run as concurrent Jackhmmer processes sharing n_cpu. They scan the
+    same database file at the same time, so each page is read from disk once
+    and served from the page cache to the other processes. Streamed chunks are
+    already searched by all queries once downloaded, and shards are searched
+    one query at a time with all cores, so those modes use query_multiple.
+
+    Args:
+      input_fasta_paths: One FASTA file per query.
+      max_sequences: Truncate each alignment to this many sequences.
+      max_concurrent: Maximum number of concurrent Jackhmmer processes, all
+        queries (up to n_cpu) by default.
+
+    Returns:
+      The results per query, in the same format as query_multiple.
+    """
+    if (self.num_streamed_chunks is not None or self.num_shards is not None or
+        len(input_fasta_paths) <= 1):
+      return self.query_multiple(input_fasta_paths, max_sequences)
+
+    if max_concurrent is None:
+      max_concurrent = len(input_fasta_paths)
+    max_concurrent = max(1, min(max_concurrent, len(input_fasta_paths),
+                                self.n_cpu))
+    n_cpu = max(1, self.n_cpu // max_concurrent)
+
+    _prefetch(self.database_path)
+    with futures.ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+      outputs = list(executor.map(
+          lambda input_fasta_path: self._query_chunk(
+              input_fasta_path, self.database_path, max_sequences,
+              n_cpu=n_cpu),
+          input_fasta_paths))
+    return [[output] for output in outputs]
+
   def query_multiple(
       self,
       input_fasta_paths: Sequence[str],
       max_sequences: Optional[int] = None,
     ) -> Sequence[Sequence[Mapping[str, Any]]]:
     """Queries the database for multiple queries using Jackhmmer."""
+    if self.num_shards is not None:
+      return [[self._query_sharded(input_fasta_path, max_sequences)]
+              for input_fasta_path in input_fasta_paths]
+
     if self.num_streamed_chunks is None:
       single_chunk_results = []
       for input_fasta_path in input_fasta_paths:
@@ -221,4 +539,61 @@ class Jackhmmer:
           future = next_future
         if self.streaming_callback:
           self.streaming_callback(i)
-    return chunked_outputs
\ No newline at end of file
+    return chunked_outputs
+
+  def _merge_shard_outputs(self,
+                           shard_outputs: Sequence[Mapping[str, Any]],
+                           max_sequences: Optional[int]) -> Mapping[str, Any]:
+    """Merges the hits of the shard searches of one query by E-value."""
+    e_values = {}
+    for output in shard_outputs:
+      e_values.update(parsers.parse_e_values_from_tblout(output['tbl']))
+    sto = parsers.merge_stockholm_msas(
+        [output['sto'] for output in shard_outputs], e_values, max_sequences)
+
+    return dict(
+        sto=sto,
+        tbl=''.join(output['tbl'] for output in shard_outputs)
+        if self.get_tblout else '',
+        stderr=b''.join(output['stderr'] for output in shard_outputs),
+        n_iter=self.n_iter,
+        e_value=self.e_value)
+
+  def _query_sharded(self,
+                     input_fasta_path: str,
+                     max_sequences: Optional[int] = None) -> Mapping[str, Any]:
+    """Queries all shards of the database concurrently and merges the hits."""
+    manifest = shard_fasta_database(
+        self.database_path, self.num_shards, self.shard_dir)
+    shards = manifest['shards']
+    # E-values are only comparable across shards with the full database size.
+    z_value = self.z_value or manifest['num_sequences']
+    n_cpu = max(1, self.n_cpu // len(shards))
+
+    with futures.ThreadPoolExecutor(max_workers=len(shards)) as executor:
+      shard_outputs = list(executor.map(
+          lambda shard: self._query_chunk(
+              input_fasta_path, shard, max_sequences,
+              n_cpu=n_cpu, z_value=z_value, get_tblout=True),
+          shards))
+    return self._merge_shard_outputs(shard_outputs, max_sequences)
+
+  async def _query_sharded_async(
+      self,
+      input_fasta_path: str,
+      max_sequences: Optional[int] = None,
+      timeout: Optional[float] = None,
+      runner: Optional[tool_runner.ToolRunner] = None) -> Mapping[str, Any]:
+    """_query_sharded through a ToolRunner, see query_async."""
+    manifest = await asyncio.get_running_loop().run_in_executor(
+        None, shard_fasta_database,
+        self.database_path, self.num_shards, self.shard_dir)
+    shards = manifest['shards']
+    z_value = self.z_value or manifest['num_sequences']
+    n_cpu = max(1, self.n_cpu // len(shards))
+    shard_outputs = await self._gather_or_cancel(
+        self._query_chunk_async(
+            input_fasta_path, shard, max_sequences, n_cpu=n_cpu,
+            timeout=timeout, runner=runner, z_value=z_value, get_tblout=True)
+        for shard in shards)
+    return self._merge_shard_outputs(shard_outputs, max_sequences)
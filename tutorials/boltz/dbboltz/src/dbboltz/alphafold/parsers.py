@@ -12,13 +12,32 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+# Modified from the original by:
+#  - adding ArrayMsa, a numpy backed Msa, with vectorized parse_a3m_array and
+#    parse_stockholm_array
+#  - remove_empty_columns_from_stockholm_msa computes and applies the column
+#    mask of each block with numpy
+#  - deduplicate_stockholm_msa compares 64-bit digests of the masked
+#    alignments and can stop early at max_sequences unique sequences
+#  - adding merge_stockholm_msas to combine searches over database shards
+#  - truncate_stockholm_msa reads the file once, in binary, and seeks past the
+#    rows of dropped sequences in later alignment blocks
+#  - the HHR and hmmsearch parsers use precompiled regexes and compute residue
+#    indices with numpy, and have generator versions iter_hhr_hits and
+#    iter_hmmsearch_a3m_hits
+
 """Functions for parsing various file formats."""
 import collections
 import dataclasses
+import hashlib
+import io
 import itertools
 import re
 import string
-from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Set
+from typing import (BinaryIO, Container, Dict, Iterable, Iterator, List,
+                    Optional, Sequence, Set, Tuple)
+
+import numpy as np
 
 # Internal import (7716).
 
@@ -52,6 +71,51 @@ class Msa:
                descriptions=self.descriptions[:max_seqs])
 
 
+@dataclasses.dataclass(frozen=True)
+class ArrayMsa:
+  """Class representing a parsed MSA as arrays.
+
+  `msa` holds the aligned (deletion-free) sequences as ASCII codes, uint8
+  [num_seqs, num_res], and `deletion_matrix` the deletion counts, int32
+  [num_seqs, num_res]. `sequences` decodes rows on access, so an ArrayMsa can
+  be passed where an Msa is expected; `to_msa` builds a plain Msa.
+  """
+  msa: np.ndarray
+  deletion_matrix: np.ndarray
+  descriptions: Sequence[str]
+
+  def __post_init__(self):
+    if not (self.msa.shape[0] ==
+            self.deletion_matrix.shape[0] ==
+            len(self.descriptions)):
+      raise ValueError(
+          'All fields for an MSA must have the same length. '
+          f'Got {self.msa.shape[0]} sequences, '
+          f'{self.deletion_matrix.shape[0]} rows in the deletion matrix and '
+          f'{len(self.descriptions)} descriptions.')
+    if self.msa.shape != self.deletion_matrix.shape:
+      raise ValueError(
+          f'MSA of shape {self.msa.shape} and deletion matrix of shape '
+          f'{self.deletion_matrix.shape} do not match.')
+
+  def __len__(self):
+    return self.msa.shape[0]
+
+  @property
+  def sequences(self) -> Sequence[str]:
+    return [row.tobytes().decode('ascii') for row in self.msa]
+
+  def truncate(self, max_seqs: int):
+    return ArrayMsa(msa=self.msa[:max_seqs],
+                    deletion_matrix=self.deletion_matrix[:max_seqs],
+                    descriptions=self.descriptions[:max_seqs])
+
+  def to_msa(self) -> Msa:
+    return Msa(sequences=self.sequences,
+               deletion_matrix=self.deletion_matrix.tolist(),
+               descriptions=list(self.descriptions))
+
+
 @dataclasses.dataclass(frozen=True)
 class TemplateHit:
   """Class representing a template hit."""
@@ -191,6 +255,114 @@ def parse_a3m(a3m_string: str) -> Msa:
              descriptions=descriptions)
 
 
+def parse_a3m_array(a3m_string: str) -> ArrayMsa:
+  """Parses an a3m format alignment into an ArrayMsa.
+
+  Vectorized equivalent of parse_a3m over the a3m byte buffer. Header lines and
+  whitespace are masked out, and the '>' starting each header is kept as a
+  sentinel column ahead of each sequence. Every lowercase (inserted) residue is
+  then counted towards the next kept position with a single bincount; counts
+  of insertions at the end of a sequence land on the next sentinel and are
+  dropped, as in parse_a3m.
+
+  Args:
+    a3m_string: The string contents of a a3m file. The first sequence in the
+      file should be the query sequence.
+
+  Returns:
+    An ArrayMsa of the aligned sequences, deletions and descriptions.
+  """
+  # The trailing '>' closes the final sequence like a header would.
+  buffer = np.frombuffer((a3m_string.strip() + '\n>').encode('ascii'),
+                         dtype=np.uint8)
+  gt = np.flatnonzero(buffer == ord('>'))
+  header_starts = gt[(gt == 0) | (buffer[gt - 1] == ord('\n'))]
+  num_seqs = header_starts.size - 1
+  if num_seqs <= 0:
+    return ArrayMsa(msa=np.zeros((0, 0), dtype=np.uint8),
+                    deletion_matrix=np.zeros((0, 0), dtype=np.int32),
+                    descriptions=[])
+  newlines = np.flatnonzero(buffer == ord('\n'))
+  header_ends = newlines[np.searchsorted(newlines, header_starts[:-1])]
+  descriptions = [
+      buffer[start + 1:end].tobytes().decode('ascii').strip()
+      for start, end in zip(header_starts[:-1], header_ends)
+  ]
+
+  # Drop whitespace and the description text of each header line.
+  keep = buffer > ord(' ')
+  header_lengths = header_ends - header_starts[:-1]
+  header_chars = (
+      np.arange(header_lengths.sum()) -
+      np.repeat(np.cumsum(header_lengths) - header_lengths, header_lengths) +
+      np.repeat(header_starts[:-1] + 1, header_lengths))
+  keep[header_chars] = False
+
+  is_lower = (buffer >= ord('a')) & (buffer <= ord('z')) & keep
+  aligned = keep & ~is_lower
+  residues = buffer[aligned]
+  # Rows of sentinel + residues, then the closing sentinel.
+  num_columns, remainder = divmod(residues.size - 1, num_seqs)
+  if (remainder or
+      np.any(residues[:-1:num_columns] != ord('>')) or
+      np.count_nonzero(residues == ord('>')) != num_seqs + 1):
+    raise ValueError('All a3m sequences must have the same number of aligned '
+                     'residues.')
+
+  # Position, among aligned positions, of the residue following each insertion.
+  aligned_before = np.cumsum(aligned, dtype=np.int32)
+  deletions = np.bincount(aligned_before[np.flatnonzero(is_lower)],
+                          minlength=residues.size)[:num_seqs * num_columns]
+  # Column 0 of each row is the sentinel.
+  msa = residues[:num_seqs * num_columns].reshape(num_seqs, num_columns)[:, 1:]
+  deletion_matrix = deletions.reshape(num_seqs, num_columns)[:, 1:]
+  return ArrayMsa(msa=np.ascontiguousarray(msa),
+                  deletion_matrix=deletion_matrix.astype(np.int32),
+                  descriptions=descriptions)
+
+
+def parse_stockholm_array(stockholm_string: str) -> ArrayMsa:
+  """Parses a stockholm format alignment into an ArrayMsa.
+
+  Vectorized equivalent of parse_stockholm: the full alignment is stacked into
+  a byte matrix, query gap columns are removed with a boolean mask and
+  deletions are taken from the cumulative count of residues in those columns.
+
+  Args:
+    stockholm_string: The string contents of a stockholm file. The first
+      sequence in the file should be the query sequence.
+
+  Returns:
+    An ArrayMsa of the aligned sequences, deletions and target names.
+  """
+  name_to_segments = collections.OrderedDict()
+  for line in stockholm_string.splitlines():
+    line = line.strip()
+    if not line or line.startswith(('#', '//')):
+      continue
+    name, sequence = line.split()
+    name_to_segments.setdefault(name, []).append(sequence)
+
+  if not name_to_segments:
+    return ArrayMsa(msa=np.zeros((0, 0), dtype=np.uint8),
+                    deletion_matrix=np.zeros((0, 0), dtype=np.int32),
+                    descriptions=[])
+  sequences = [''.join(segments) for segments in name_to_segments.values()]
+  width = len(sequences[0])
+  if any(len(s) != width for s in sequences):
+    raise ValueError('All stockholm sequences must have the same length.')
+  alignment = np.frombuffer(''.join(sequences).encode('ascii'),
+                            dtype=np.uint8).reshape(len(sequences), width)
+
+  keep_columns = alignment[0] != ord('-')
+  inserted = (~keep_columns)[None, :] & (alignment != ord('-'))
+  inserted_before = np.cumsum(inserted, axis=1, dtype=np.int64)[:, keep_columns]
+  deletion_matrix = np.diff(inserted_before, axis=1, prepend=0)
+  return ArrayMsa(msa=np.ascontiguousarray(alignment[:, keep_columns]),
+                  deletion_matrix=deletion_matrix.astype(np.int32),
+                  descriptions=list(name_to_segments.keys()))
+
+
 def _convert_sto_seq_to_a3m(
     query_non_gaps: Sequence[bool], sto_seq: str) -> Iterable[str]:
   for is_query_res_non_gap, sequence_res in zip(query_non_gaps, sto_seq):
@@ -254,6 +426,18 @@ def convert_stockholm_to_a3m(stockholm_format: str,
   return '\n'.join(fasta_chunks) + '\n'  # Include terminating newline.
 
 
+_STOCKHOLM_TAG = b'# STOCKHOLM'
+_GS_TAG = b'#=GS'
+_RF_TAG = b'#=GC RF'
+_END_TAG = b'//'
+
+
+def _is_separator(line: bytes) -> bool:
+  """Blank lines and the end tag, which close an alignment block."""
+  stripped = line.strip()
+  return not stripped or stripped == _END_TAG
+
+
 def _keep_line(line: str, seqnames: Set[str]) -> bool:
   """Function to decide which lines to keep."""
   if not line.strip():
@@ -274,122 +458,526 @@ def _keep_line(line: str, seqnames: Set[str]) -> bool:
     return seqname in seqnames
 
 
-def truncate_stockholm_msa(stockholm_msa_path: str, max_sequences: int) -> str:
-  """Reads + truncates a Stockholm file while preventing excessive RAM usage."""
-  seqnames = set()
-  filtered_lines = []
+def _keep_line_bytes(line: bytes, seqnames: Container[bytes]) -> bool:
+  """_keep_line for the binary lines of truncate_stockholm_msa_to_stream."""
+  if line[:1] == b'#':
+    if line.startswith((_STOCKHOLM_TAG, _RF_TAG)):  # Start tag, reference.
+      return True
+    if line[:4] == _GS_TAG:  # Description lines - keep if sequence in list.
+      return line.split(maxsplit=2)[1] in seqnames
+    return False  # Other markup - filter out.
+  if _is_separator(line):
+    return True
+  # Alignment data - keep if sequence in list.
+  return line.partition(b' ')[0] in seqnames
+
 
-  with open(stockholm_msa_path) as f:
-    for line in f:
-      if line.strip() and not line.startswith(('#', '//')):
-        # Ignore blank lines, markup and end symbols - remainder are alignment
-        # sequence parts.
-        seqname = line.partition(' ')[0]
-        seqnames.add(seqname)
+def _line_at(f: BinaryIO, offset: int, prefix: bytes) -> Optional[bytes]:
+  """Returns the line starting at offset if it begins with prefix."""
+  f.seek(offset - 1)
+  if f.read(1) != b'\n':
+    return None
+  line = f.readline()
+  return line if line.startswith(prefix) else None
+
+
+def truncate_stockholm_msa_to_stream(stockholm_msa_path: str,
+                                     max_sequences: int,
+                                     out: BinaryIO) -> int:
+  """Writes the first max_sequences sequences of a Stockholm file to out.
+
+  The file is read once. Kept lines are written as soon as the kept names are
+  known, i.e. after the first max_sequences rows of the first block: only those
+  rows and the header lines are held until then.
+
+  HMMER lays every full width block of an interleaved Stockholm file out the
+  same way, so the offset of the '#=GC RF' line in a block is learned from the
+  first block, and the rows of dropped sequences in later blocks are skipped
+  with a seek instead of being read. A block is only skipped when its kept rows
+  end at the same offset as in the first block and a '#=GC RF' line starts at
+  the expected offset; otherwise it is read line by line.
+
+  Args:
+    stockholm_msa_path: Path to the Stockholm file.
+    max_sequences: Number of sequences (including the query) to keep.
+    out: Binary stream to write the truncated Stockholm file to.
+
+  Returns:
+    The number of sequences kept.
+  """
+  seqnames = {}  # Kept names, in order.
+  # Lines held until the kept names are known, as (name, line); lines with a
+  # name are only written if it is kept.
+  pending = []
+  # '#=GS' lines are held for the first max_sequences names only, which covers
+  # the kept names when the header lists sequences in alignment order.
+  gs_names = set()
+  gs_dropped = False
+
+  with open(stockholm_msa_path, 'rb') as f:
+    offset = 0
+    first_row = None  # Offset of the first alignment row.
+    header_size = 0  # Number of pending lines before the first row.
+    kept_end = None  # Offset of the end of the last kept row.
+    line = f.readline()
+    while line:
+      if line[:4] == _GS_TAG:
+        name = line.split(maxsplit=2)[1]
+        if name in gs_names or len(gs_names) < max_sequences:
+          gs_names.add(name)
+          pending.append((name, line))
+        else:
+          gs_dropped = True
+      elif line[:1] == b'#' or _is_separator(line):
+        if seqnames and _is_separator(line):
+          break
+        if _keep_line_bytes(line, ()):
+          pending.append((None, line))
+      else:
+        name = line.partition(b' ')[0]
+        if name in seqnames:  # A new block began without a separator.
+          break
+        if first_row is None:
+          first_row = offset
+          header_size = len(pending)
+        seqnames[name] = None
+        pending.append((name, line))
+        kept_end = offset + len(line)
         if len(seqnames) >= max_sequences:
+          offset = kept_end
+          line = f.readline()
           break
+      offset += len(line)
+      line = f.readline()
+
+    if gs_dropped and not gs_names.issuperset(seqnames):
+      # The header does not list the sequences in alignment order: read the
+      # header again for the '#=GS' lines of the kept names.
+      f.seek(0)
+      header = f.read(first_row).splitlines(keepends=True)
+      pending = ([(None, l) for l in header if _keep_line_bytes(l, seqnames)] +
+                 pending[header_size:])
+      f.seek(offset)
+    for name, pending_line in pending:
+      if name is None or name in seqnames:
+        out.write(pending_line)
+    del pending
+
+    # Layout of the first block, relative to the offset of its first row.
+    kept_rows_size = None if kept_end is None else kept_end - first_row
+    rf_at = None
+    block_start = first_row
+    block_names = set(seqnames)
+    can_skip = False
+
+    # The rest of the file, starting with the line that ended the first loop.
+    while line:
+      if line[:1] == b'#':
+        if (rf_at is None and block_start is not None and
+            line.startswith(_RF_TAG)):
+          rf_at = offset - block_start
+        if _keep_line_bytes(line, seqnames):
+          out.write(line)
+      elif _is_separator(line):
+        out.write(line)
+        block_start = None
+      else:
+        name = line.partition(b' ')[0]
+        if block_start is None or name in block_names:
+          block_start = offset
+          block_names = set()
+          can_skip = rf_at is not None
+        block_names.add(name)
+        if name in seqnames:
+          out.write(line)
+          if (can_skip and len(block_names) == len(seqnames) and
+              offset + len(line) - block_start == kept_rows_size):
+            rf_line = _line_at(f, block_start + rf_at, _RF_TAG)
+            can_skip = False
+            if rf_line is None:
+              f.seek(offset + len(line))
+            else:
+              # Skip to the reference annotation, dropping the other rows.
+              out.write(rf_line)
+              offset = block_start + rf_at
+              line = rf_line
+        else:
+          can_skip = False
+      offset += len(line)
+      line = f.readline()
+
+  return len(seqnames)
+
+
+def truncate_stockholm_msa(stockholm_msa_path: str, max_sequences: int) -> str:
+  """Reads + truncates a Stockholm file while preventing excessive RAM usage."""
+  out = io.BytesIO()
+  truncate_stockholm_msa_to_stream(stockholm_msa_path, max_sequences, out)
+  return out.getvalue().decode('utf-8')
 
-    f.seek(0)
-    for line in f:
-      if _keep_line(line, seqnames):
-        filtered_lines.append(line)
 
-  return ''.join(filtered_lines)
+def _filter_empty_columns(
+    alignments: Sequence[str],
+    reference_alignment: str) -> Optional[Tuple[List[str], str]]:
+  """Removes the columns that are gaps in every alignment row of one block.
+
+  Args:
+    alignments: The aligned sequence of each row in the block.
+    reference_alignment: The '#=GC RF' annotation of the block.
+
+  Returns:
+    The masked alignments and reference annotation, or None if every column
+    of the block is empty.
+
+  Raises:
+    ValueError: If the rows of the block are not all as long as the reference
+      annotation.
+  """
+  width = len(reference_alignment)
+  if any(len(alignment) != width for alignment in alignments):
+    raise ValueError(
+        f'Alignment rows do not match the {width} columns of their #=GC RF '
+        'reference annotation.')
+  rows = np.frombuffer(''.join(alignments).encode('ascii'),
+                       dtype=np.uint8).reshape(len(alignments), width)
+  mask = (rows != ord('-')).any(axis=0)
+  if not mask.any():
+    return None
+  if mask.all():
+    return list(alignments), reference_alignment
+  kept = np.ascontiguousarray(rows[:, mask]).tobytes().decode('ascii')
+  num_kept = int(mask.sum())
+  masked = [kept[i * num_kept:(i + 1) * num_kept]
+            for i in range(len(alignments))]
+  reference = np.frombuffer(reference_alignment.encode('ascii'),
+                            dtype=np.uint8)[mask].tobytes().decode('ascii')
+  return masked, reference
+
+
+def _missing_reference_error() -> ValueError:
+  return ValueError(
+      'Alignment block is not followed by a #=GC RF reference annotation.')
 
 
 def remove_empty_columns_from_stockholm_msa(stockholm_msa: str) -> str:
-  """Removes empty columns (dashes-only) from a Stockholm MSA."""
-  processed_lines = {}
-  unprocessed_lines = {}
+  """Removes empty columns (dashes-only) from a Stockholm MSA.
+
+  Raises:
+    ValueError: If the rows of a block are not followed by its '#=GC RF'
+      reference annotation, or do not match its number of columns.
+  """
+  processed_lines = []
+  # (line index, prefix, alignment) of the alignment rows in the current block.
+  unprocessed_rows = []
+  unprocessed_names = set()
   for i, line in enumerate(stockholm_msa.splitlines()):
     if line.startswith('#=GC RF'):
-      reference_annotation_i = i
-      reference_annotation_line = line
       # Reached the end of this chunk of the alignment. Process chunk.
-      _, _, first_alignment = line.rpartition(' ')
-      mask = []
-      for j in range(len(first_alignment)):
-        for _, unprocessed_line in unprocessed_lines.items():
-          prefix, _, alignment = unprocessed_line.rpartition(' ')
-          if alignment[j] != '-':
-            mask.append(True)
-            break
-        else:  # Every row contained a hyphen - empty column.
-          mask.append(False)
-      # Add reference annotation for processing with mask.
-      unprocessed_lines[reference_annotation_i] = reference_annotation_line
-
-      if not any(mask):  # All columns were empty. Output empty lines for chunk.
-        for line_index in unprocessed_lines:
+      reference_prefix, _, reference_alignment = line.rpartition(' ')
+      filtered = _filter_empty_columns(
+          [alignment for _, _, alignment in unprocessed_rows],
+          reference_alignment)
+
+      if filtered is None:
+        # All columns were empty. Output empty lines for chunk.
+        for line_index, _, _ in unprocessed_rows:
           processed_lines[line_index] = ''
+        processed_lines.append('')
       else:
-        for line_index, unprocessed_line in unprocessed_lines.items():
-          prefix, _, alignment = unprocessed_line.rpartition(' ')
-          masked_alignment = ''.join(itertools.compress(alignment, mask))
+        masked, masked_reference = filtered
+        for (line_index, prefix, _), masked_alignment in zip(
+            unprocessed_rows, masked):
           processed_lines[line_index] = f'{prefix} {masked_alignment}'
+        processed_lines.append(f'{reference_prefix} {masked_reference}')
 
-      # Clear raw_alignments.
-      unprocessed_lines = {}
+      unprocessed_rows = []
+      unprocessed_names.clear()
     elif line.strip() and not line.startswith(('#', '//')):
-      unprocessed_lines[i] = line
+      prefix, _, alignment = line.rpartition(' ')
+      seqname = line.partition(' ')[0]
+      if seqname in unprocessed_names:
+        # A new block began before the reference annotation of this one.
+        raise _missing_reference_error()
+      unprocessed_names.add(seqname)
+      unprocessed_rows.append((i, prefix, alignment))
+      # Placeholder, replaced once the block is processed.
+      processed_lines.append(line)
     else:
-      processed_lines[i] = line
-  return '\n'.join((processed_lines[i] for i in range(len(processed_lines))))
+      if unprocessed_rows and line.startswith('//'):
+        raise _missing_reference_error()
+      processed_lines.append(line)
+  if unprocessed_rows:
+    raise _missing_reference_error()
+  return '\n'.join(processed_lines)
 
 
-def deduplicate_stockholm_msa(stockholm_msa: str) -> str:
-  """Remove duplicate sequences (ignoring insertions wrt query)."""
-  sequence_dict = collections.defaultdict(str)
+def deduplicate_stockholm_msa(stockholm_msa: str,
+                              max_sequences: Optional[int] = None) -> str:
+  """Remove duplicate sequences (ignoring insertions wrt query).
 
-  # First we must extract all sequences from the MSA.
-  for line in stockholm_msa.splitlines():
+  Sequences are compared by a 64-bit digest of their alignment restricted to
+  the query's non-gap columns, built up block by block, so the full sequences
+  are never concatenated or stored.
+
+  Args:
+    stockholm_msa: The string contents of a stockholm file. The first sequence
+      in the file should be the query sequence.
+    max_sequences: If given, keep only the first max_sequences unique
+      sequences. Once a prefix of the rows is known to contain them, later
+      rows are no longer hashed, and once every row of that prefix is known
+      to be unique the remaining blocks are not read.
+
+  Returns:
+    The Stockholm MSA with only the lines of the kept sequences.
+  """
+  lines = stockholm_msa.splitlines()
+
+  # Running digests of the masked alignments, in order of first appearance.
+  hashers = {}
+  row_index_of = {}
+  # Rows past this index can no longer be among the kept sequences.
+  cutoff = None
+  query_name = None
+  block = []
+  block_names = set()
+
+  def process_block():
+    nonlocal cutoff
+    if not block:
+      return False
+    query = block[0][1] if block[0][0] == query_name else None
+    if query is None:
+      raise ValueError('The query must be the first sequence of each block.')
+    width = len(query)
+    if any(len(alignment) != width for _, alignment in block):
+      raise ValueError('All alignment rows of a block must have the same '
+                       'length.')
+    rows = np.frombuffer(''.join(a for _, a in block).encode('ascii'),
+                         dtype=np.uint8).reshape(len(block), width)
+    # Mask is False for insertions.
+    masked = np.ascontiguousarray(rows[:, rows[0] != ord('-')])
+    for (seqname, _), masked_row in zip(block, masked):
+      hashers[seqname].update(masked_row.tobytes())
+    block.clear()
+    block_names.clear()
+
+    if max_sequences is None:
+      return False
+    # A row whose alignment so far differs from every earlier row is unique
+    # whatever follows; count those to find how many rows can still be kept.
+    seen = set()
+    n_unique = 0
+    for row_index, hasher in enumerate(hashers.values()):
+      if cutoff is not None and row_index >= cutoff:
+        break
+      digest = hasher.copy().digest()
+      if digest not in seen:
+        seen.add(digest)
+        n_unique += 1
+        if n_unique == max_sequences:
+          cutoff = row_index + 1
+          # Every kept row is already known to be unique: nothing left to do.
+          return cutoff == max_sequences
+    return False
+
+  for line in lines:
     # Only consider the alignments - ignore reference annotation, empty lines,
     # descriptions or markup.
     if line.strip() and not line.startswith(('#', '//')):
-      line = line.strip()
       seqname, alignment = line.split()
-      sequence_dict[seqname] += alignment
+      if seqname not in hashers:
+        if cutoff is not None:
+          continue
+        if query_name is None:
+          query_name = seqname
+        row_index_of[seqname] = len(hashers)
+        hashers[seqname] = hashlib.blake2b(digest_size=8)
+      elif cutoff is not None and row_index_of[seqname] >= cutoff:
+        continue
+      if seqname in block_names:
+        # New block without a separating line.
+        if process_block():
+          break
+      block.append((seqname, alignment))
+      block_names.add(seqname)
+    elif block and (not line.strip() or line.startswith(('#=GC', '//'))):
+      if process_block():
+        break
+  else:
+    process_block()
 
   seen_sequences = set()
   seqnames = set()
-  # First alignment is the query.
-  query_align = next(iter(sequence_dict.values()))
-  mask = [c != '-' for c in query_align]  # Mask is False for insertions.
-  for seqname, alignment in sequence_dict.items():
-    # Apply mask to remove all insertions from the string.
-    masked_alignment = ''.join(itertools.compress(alignment, mask))
-    if masked_alignment in seen_sequences:
+  for seqname, hasher in hashers.items():
+    digest = hasher.digest()
+    if digest in seen_sequences:
       continue
-    else:
-      seen_sequences.add(masked_alignment)
-      seqnames.add(seqname)
+    seen_sequences.add(digest)
+    seqnames.add(seqname)
+    if max_sequences is not None and len(seqnames) >= max_sequences:
+      break
 
   filtered_lines = []
-  for line in stockholm_msa.splitlines():
+  for line in lines:
     if _keep_line(line, seqnames):
       filtered_lines.append(line)
 
   return '\n'.join(filtered_lines) + '\n'
 
 
+def _parse_stockholm_rows(
+    stockholm_msa: str) -> Tuple[Dict[str, str], Dict[str, str]]:
+  """Returns name -> full alignment and name -> '#=GS DE' description."""
+  sequences = collections.OrderedDict()
+  descriptions = {}
+  for line in stockholm_msa.splitlines():
+    if line[:4] == '#=GS':
+      columns = line.split(maxsplit=3)
+      if len(columns) >= 3 and columns[2] == 'DE':
+        descriptions[columns[1]] = columns[3] if len(columns) == 4 else ''
+    elif line.strip() and not line.startswith(('#', '//')):
+      seqname, alignment = line.split()
+      sequences.setdefault(seqname, []).append(alignment)
+  return ({k: ''.join(v) for k, v in sequences.items()}, descriptions)
+
+
+def _split_at_match_columns(query: str, alignment: str) -> List[str]:
+  """Splits an alignment into [insert_0, match_1, insert_1, ..., insert_n].
+
+  Match columns are the columns where the query has a residue, so every
+  alignment against the same query has the same number of pieces.
+  """
+  pieces = []
+  insert = []
+  for query_res, res in zip(query, alignment):
+    if query_res == '-':
+      if res not in '-.':
+        insert.append(res)
+    else:
+      pieces.append(''.join(insert))
+      pieces.append(res)
+      insert = []
+  pieces.append(''.join(insert))
+  return pieces
+
+
+def merge_stockholm_msas(stockholm_msas: Sequence[str],
+                         e_values: Dict[str, float],
+                         max_sequences: Optional[int] = None) -> str:
+  """Merges Stockholm MSAs of one query against several database shards.
+
+  Every input must have the query as its first sequence. Hits are ordered by
+  E-value (looked up by target name, without the /start-end suffix), so the
+  E-values must be comparable across shards, e.g. by searching every shard
+  with the -Z of the full database. Insert columns are re-aligned across the
+  inputs, and the merged MSA is written as a single block.
+
+  Args:
+    stockholm_msas: The Stockholm MSAs to merge.
+    e_values: Target name to E-value, e.g. from parse_e_values_from_tblout.
+    max_sequences: If given, keep only the query and the best max_sequences - 1
+      hits.
+
+  Returns:
+    The merged MSA in Stockholm format.
+  """
+  query_name = None
+  query = None
+  hits = []
+  descriptions = {}
+  for order, stockholm_msa in enumerate(stockholm_msas):
+    sequences, msa_descriptions = _parse_stockholm_rows(stockholm_msa)
+    if not sequences:
+      continue
+    descriptions.update(msa_descriptions)
+    names = iter(sequences)
+    shard_query_name = next(names)
+    shard_query = sequences[shard_query_name]
+    if query_name is None:
+      query_name = shard_query_name
+      query = _split_at_match_columns(shard_query, shard_query)
+    for position, seqname in enumerate(names):
+      e_value = e_values.get(seqname.rpartition('/')[0] or seqname,
+                             float('inf'))
+      hits.append(((e_value, order, position), seqname,
+                   _split_at_match_columns(shard_query, sequences[seqname])))
+
+  if query_name is None:
+    return ''
+  hits.sort(key=lambda hit: hit[0])
+  if max_sequences is not None:
+    hits = hits[:max(max_sequences - 1, 0)]
+
+  rows = [(query_name, query)] + [(name, pieces) for _, name, pieces in hits]
+  insert_lengths = [
+      max(len(pieces[i]) for _, pieces in rows)
+      for i in range(0, len(query), 2)
+  ]
+
+  def render(pieces):
+    out = []
+    for i, piece in enumerate(pieces):
+      out.append(piece.ljust(insert_lengths[i // 2], '-') if i % 2 == 0
+                 else piece)
+    return ''.join(out)
+
+  reference = ''.join(
+      '.' * insert_lengths[i // 2] if i % 2 == 0 else 'x'
+      for i in range(len(query)))
+  name_width = max(len(name) for name, _ in rows)
+  lines = ['# STOCKHOLM 1.0', '']
+  for name, _ in rows:
+    if name in descriptions:
+      lines.append(f'#=GS {name} DE {descriptions[name]}'.rstrip())
+  lines.append('')
+  for name, pieces in rows:
+    lines.append(f'{name.ljust(name_width)} {render(pieces)}')
+  lines.append(f'{"#=GC RF".ljust(name_width)} {reference}')
+  lines.append('//')
+  return '\n'.join(lines) + '\n'
+
+
+_HHR_SUMMARY_RE = re.compile(
+    'Probab=(.*)[\t ]*E-value=(.*)[\t ]*Score=(.*)[\t ]*Aligned_cols=(.*)[\t'
+    ' ]*Identities=(.*)%[\t ]*Similarity=(.*)[\t ]*Sum_probs=(.*)[\t '
+    ']*Template_Neff=(.*)')
+# The first 17 characters of a sequence line are 'Q <query_name> ' or
+# 'T <hit_name> ', these match what follows:
+#                start    sequence       end     total_sequence_length
+_HHR_QUERY_LINE_RE = re.compile(
+    r'[\t ]*([0-9]*) ([A-Z-]*)[\t ]*([0-9]*) \([0-9]*\)')
+_HHR_HIT_LINE_RE = re.compile(r'[\t ]*([0-9]*) ([A-Z-]*)[\t ]*[0-9]* \([0-9]*\)')
+_HHR_SKIPPED_LINES = ('Q ss_dssp', 'Q ss_pred', 'Q Consensus',
+                      'T ss_dssp', 'T ss_pred', 'T Consensus')
+_GAP = ord('-')
+
+
 def _get_hhr_line_regex_groups(
-    regex_pattern: str, line: str) -> Sequence[Optional[str]]:
-  match = re.match(regex_pattern, line)
+    regex: re.Pattern, line: str) -> Sequence[Optional[str]]:
+  match = regex.match(line, 17)
   if match is None:
     raise RuntimeError(f'Could not parse query line {line}')
   return match.groups()
 
 
-def _update_hhr_residue_indices_list(
-    sequence: str, start_index: int, indices_list: List[int]):
-  """Computes the relative indices for each residue with respect to the original sequence."""
-  counter = start_index
-  for symbol in sequence:
-    if symbol == '-':
-      indices_list.append(-1)
-    else:
-      indices_list.append(counter)
-      counter += 1
+def _hhr_residue_indices(segments: Sequence[str],
+                         starts: Sequence[int]) -> np.ndarray:
+  """Computes the relative indices for each residue with respect to the original sequence.
+
+  Each segment counts on from its own start index, gaps get -1.
+  """
+  symbols = np.frombuffer(''.join(segments).encode('ascii'), dtype=np.uint8)
+  if not symbols.size:
+    return np.zeros(0, dtype=np.int64)
+  residues = symbols != _GAP
+  counts = np.cumsum(residues)
+  lengths = np.fromiter(map(len, segments), dtype=np.int64, count=len(segments))
+  ends = np.cumsum(lengths)
+  # Residues counted before each segment, so that each restarts at its start.
+  counted_before = counts[ends - lengths - 1]
+  counted_before[ends == lengths] = 0
+  indices = np.repeat(np.asarray(starts) - counted_before, lengths) + counts - 1
+  return np.where(residues, indices, -1)
 
 
 def _parse_hhr_hit(detailed_lines: Sequence[str]) -> TemplateHit:
@@ -412,11 +1000,7 @@ def _parse_hhr_hit(detailed_lines: Sequence[str]) -> TemplateHit:
   name_hit = detailed_lines[1][1:]
 
   # Parse the summary line.
-  pattern = (
-      'Probab=(.*)[\t ]*E-value=(.*)[\t ]*Score=(.*)[\t ]*Aligned_cols=(.*)[\t'
-      ' ]*Identities=(.*)%[\t ]*Similarity=(.*)[\t ]*Sum_probs=(.*)[\t '
-      ']*Template_Neff=(.*)')
-  match = re.match(pattern, detailed_lines[2])
+  match = _HHR_SUMMARY_RE.match(detailed_lines[2])
   if match is None:
     raise RuntimeError(
         'Could not parse section: %s. Expected this: \n%s to contain summary.' %
@@ -428,53 +1012,44 @@ def _parse_hhr_hit(detailed_lines: Sequence[str]) -> TemplateHit:
   # readable' format which has a fixed length. The strategy employed is to
   # assume that each block starts with the query sequence line, and to parse
   # that with a regexp in order to deduce the fixed length used for that block.
-  query = ''
-  hit_sequence = ''
-  indices_query = []
-  indices_hit = []
+  query_segments = []
+  query_starts = []
+  hit_segments = []
+  hit_starts = []
   length_block = None
 
   for line in detailed_lines[3:]:
-    # Parse the query sequence line
-    if (line.startswith('Q ') and not line.startswith('Q ss_dssp') and
-        not line.startswith('Q ss_pred') and
-        not line.startswith('Q Consensus')):
-      # Thus the first 17 characters must be 'Q <query_name> ', and we can parse
-      # everything after that.
-      #              start    sequence       end       total_sequence_length
-      patt = r'[\t ]*([0-9]*) ([A-Z-]*)[\t ]*([0-9]*) \([0-9]*\)'
-      groups = _get_hhr_line_regex_groups(patt, line[17:])
+    if line[:2] not in ('Q ', 'T ') or line.startswith(_HHR_SKIPPED_LINES):
+      continue
+    if line[0] == 'Q':
+      # Parse the query sequence line.
+      groups = _get_hhr_line_regex_groups(_HHR_QUERY_LINE_RE, line)
 
       # Get the length of the parsed block using the start and finish indices,
       # and ensure it is the same as the actual block length.
       start = int(groups[0]) - 1  # Make index zero based.
       delta_query = groups[1]
       end = int(groups[2])
-      num_insertions = len([x for x in delta_query if x == '-'])
+      num_insertions = delta_query.count('-')
       length_block = end - start + num_insertions
       assert length_block == len(delta_query)
 
-      # Update the query sequence and indices list.
-      query += delta_query
-      _update_hhr_residue_indices_list(delta_query, start, indices_query)
-
-    elif line.startswith('T '):
+      query_segments.append(delta_query)
+      query_starts.append(start)
+    else:
       # Parse the hit sequence.
-      if (not line.startswith('T ss_dssp') and
-          not line.startswith('T ss_pred') and
-          not line.startswith('T Consensus')):
-        # Thus the first 17 characters must be 'T <hit_name> ', and we can
-        # parse everything after that.
-        #              start    sequence       end     total_sequence_length
-        patt = r'[\t ]*([0-9]*) ([A-Z-]*)[\t ]*[0-9]* \([0-9]*\)'
-        groups = _get_hhr_line_regex_groups(patt, line[17:])
-        start = int(groups[0]) - 1  # Make index zero based.
-        delta_hit_sequence = groups[1]
-        assert length_block == len(delta_hit_sequence)
-
-        # Update the hit sequence and indices list.
-        hit_sequence += delta_hit_sequence
-        _update_hhr_residue_indices_list(delta_hit_sequence, start, indices_hit)
+      groups = _get_hhr_line_regex_groups(_HHR_HIT_LINE_RE, line)
+      start = int(groups[0]) - 1  # Make index zero based.
+      delta_hit_sequence = groups[1]
+      assert length_block == len(delta_hit_sequence)
+
+      hit_segments.append(delta_hit_sequence)
+      hit_starts.append(start)
+
+  # The indices of query and hit are computed together, in one pass.
+  query = ''.join(query_segments)
+  indices = _hhr_residue_indices(query_segments + hit_segments,
+                                 query_starts + hit_starts).tolist()
 
   return TemplateHit(
       index=number_of_hit,
@@ -482,28 +1057,31 @@ def _parse_hhr_hit(detailed_lines: Sequence[str]) -> TemplateHit:
       aligned_cols=int(aligned_cols),
       sum_probs=sum_probs,
       query=query,
-      hit_sequence=hit_sequence,
-      indices_query=indices_query,
-      indices_hit=indices_hit,
+      hit_sequence=''.join(hit_segments),
+      indices_query=indices[:len(query)],
+      indices_hit=indices[len(query):],
   )
 
 
-def parse_hhr(hhr_string: str) -> Sequence[TemplateHit]:
-  """Parses the content of an entire HHR file."""
-  lines = hhr_string.splitlines()
-
+def iter_hhr_hits(hhr_string: str) -> Iterator[TemplateHit]:
+  """Parses the hits of an HHR file one at a time, in file order."""
   # Each .hhr file starts with a results table, then has a sequence of hit
-  # "paragraphs", each paragraph starting with a line 'No <hit number>'. We
-  # iterate through each paragraph to parse each hit.
+  # "paragraphs", each paragraph starting with a line 'No <hit number>'.
+  paragraph = None
+  for line in hhr_string.splitlines():
+    if line.startswith('No '):
+      if paragraph is not None:
+        yield _parse_hhr_hit(paragraph)
+      paragraph = [line]
+    elif paragraph is not None:
+      paragraph.append(line)
+  if paragraph is not None:
+    yield _parse_hhr_hit(paragraph)
 
-  block_starts = [i for i, line in enumerate(lines) if line.startswith('No ')]
 
-  hits = []
-  if block_starts:
-    block_starts.append(len(lines))  # Add the end of the final block.
-    for i in range(len(block_starts) - 1):
-      hits.append(_parse_hhr_hit(lines[block_starts[i]:block_starts[i + 1]]))
-  return hits
+def parse_hhr(hhr_string: str) -> Sequence[TemplateHit]:
+  """Parses the content of an entire HHR file."""
+  return list(iter_hhr_hits(hhr_string))
 
 
 def parse_e_values_from_tblout(tblout: str) -> Dict[str, float]:
@@ -523,20 +1101,13 @@ def parse_e_values_from_tblout(tblout: str) -> Dict[str, float]:
 
 def _get_indices(sequence: str, start: int) -> List[int]:
   """Returns indices for non-gap/insert residues starting at the given index."""
-  indices = []
-  counter = start
-  for symbol in sequence:
-    # Skip gaps but add a placeholder so that the alignment is preserved.
-    if symbol == '-':
-      indices.append(-1)
-    # Skip deleted residues, but increase the counter.
-    elif symbol.islower():
-      counter += 1
-    # Normal aligned residue. Increase the counter and append to indices.
-    else:
-      indices.append(counter)
-      counter += 1
-  return indices
+  symbols = np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)
+  gaps = symbols == _GAP
+  # Deleted (lowercase) residues increase the counter but get no index, gaps
+  # get a -1 placeholder so that the alignment is preserved.
+  deleted = (symbols >= ord('a')) & (symbols <= ord('z'))
+  counter = start + np.cumsum(~gaps) - 1
+  return np.where(gaps, -1, counter)[~deleted].tolist()
 
 
 @dataclasses.dataclass(frozen=True)
@@ -549,13 +1120,15 @@ class HitMetadata:
   text: str
 
 
+_HMMSEARCH_DESCRIPTION_RE = re.compile(
+    r'^>?([a-z0-9]+)_(\w+)/([0-9]+)-([0-9]+).*protein length:([0-9]+) *(.*)$')
+
+
 def _parse_hmmsearch_description(description: str) -> HitMetadata:
   """Parses the hmmsearch A3M sequence description line."""
   # Example 1: >4pqx_A/2-217 [subseq from] mol:protein length:217  Free text
   # Example 2: >5g3r_A/1-55 [subseq from] mol:protein length:352
-  match = re.match(
-      r'^>?([a-z0-9]+)_(\w+)/([0-9]+)-([0-9]+).*protein length:([0-9]+) *(.*)$',
-      description.strip())
+  match = _HMMSEARCH_DESCRIPTION_RE.match(description.strip())
 
   if not match:
     raise ValueError(f'Could not parse description: "{description}".')
@@ -569,45 +1142,57 @@ def _parse_hmmsearch_description(description: str) -> HitMetadata:
       text=match[6])
 
 
-def parse_hmmsearch_a3m(query_sequence: str,
-                        a3m_string: str,
-                        skip_first: bool = True) -> Sequence[TemplateHit]:
-  """Parses an a3m string produced by hmmsearch.
+def iter_hmmsearch_a3m_hits(query_sequence: str,
+                            a3m_string: str,
+                            skip_first: bool = True) -> Iterator[TemplateHit]:
+  """Parses the hits of an a3m string produced by hmmsearch one at a time.
 
   Args:
     query_sequence: The query sequence.
     a3m_string: The a3m string produced by hmmsearch.
     skip_first: Whether to skip the first sequence in the a3m string.
 
-  Returns:
-    A sequence of `TemplateHit` results.
+  Yields:
+    `TemplateHit` results, in the order of the a3m.
   """
-  # Zip the descriptions and MSAs together, skip the first query sequence.
-  parsed_a3m = list(zip(*parse_fasta(a3m_string)))
-  if skip_first:
-    parsed_a3m = parsed_a3m[1:]
-
+  sequences, descriptions = parse_fasta(a3m_string)
   indices_query = _get_indices(query_sequence, start=0)
 
-  hits = []
-  for i, (hit_sequence, hit_description) in enumerate(parsed_a3m, start=1):
+  # Skip the first query sequence, keeping the numbering of the hits.
+  for i in range(1 if skip_first else 0, len(sequences)):
+    hit_description = descriptions[i]
     if 'mol:protein' not in hit_description:
       continue  # Skip non-protein chains.
+    hit_sequence = sequences[i]
     metadata = _parse_hmmsearch_description(hit_description)
+    symbols = np.frombuffer(hit_sequence.encode('ascii'), dtype=np.uint8)
     # Aligned columns are only the match states.
-    aligned_cols = sum([r.isupper() and r != '-' for r in hit_sequence])
-    indices_hit = _get_indices(hit_sequence, start=metadata.start - 1)
+    aligned_cols = int(
+        np.count_nonzero((symbols >= ord('A')) & (symbols <= ord('Z'))))
 
-    hit = TemplateHit(
-        index=i,
+    yield TemplateHit(
+        index=i if skip_first else i + 1,
         name=f'{metadata.pdb_id}_{metadata.chain}',
         aligned_cols=aligned_cols,
         sum_probs=None,
         query=query_sequence,
         hit_sequence=hit_sequence.upper(),
         indices_query=indices_query,
-        indices_hit=indices_hit,
+        indices_hit=_get_indices(hit_sequence, start=metadata.start - 1),
     )
-    hits.append(hit)
 
-  return hits
\ No newline at end of file
+
+def parse_hmmsearch_a3m(query_sequence: str,
+                        a3m_string: str,
+                        skip_first: bool = True) -> Sequence[TemplateHit]:
+  """Parses an a3m string produced by hmmsearch.
+
+  Args:
+    query_sequence: The query sequence.
+    a3m_string: The a3m string produced by hmmsearch.
+    skip_first: Whether to skip the first sequence in the a3m string.
+
+  Returns:
+    A sequence of `TemplateHit` results.
+  """
+  return list(iter_hmmsearch_a3m_hits(query_sequence, a3m_string, skip_first))
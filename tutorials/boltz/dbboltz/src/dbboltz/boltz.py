@@ -4,9 +4,17 @@ import yaml
 import json
 import os
 import numpy as np
-from typing import Optional, Union, Dict, List, Tuple, Callable, Any
+from typing import Optional, Union, Dict, List, Tuple, Callable, Any, Iterator
 from rdkit import Chem
 import re
+import io
+import copy
+import asyncio
+import contextlib
+import hashlib
+import multiprocessing
+import shutil
+import time
 import mlflow
 from collections import defaultdict
 
@@ -16,21 +24,30 @@ from dbboltz.alphafold.parsers import (
     remove_empty_columns_from_stockholm_msa
 )
 
-from dbboltz.alphafold.pipeline import run_msa_tool
+from dbboltz.msa_stream import convert_stockholm_file_to_a3m, stream_stockholm_to_a3m
 from dbboltz.alphafold import jackhmmer
+from dbboltz import target_db
+from dbboltz.result_cache import ResultCache, make_cache_key
 
 INT_INPUTS = [
     'msa_depth',
     'diffusion_samples',
     'recycling_steps',
     'sampling_steps',
+    'seed',
+    'sample_batch_size',
+    'stop_top_k',
+    'stop_patience',
 ]
 
 FLOAT_INPUTS = [
+    'jh_timeout',
+    'target_confidence',
 ]
 
 BOOL_INPUTS = [
     'use_msa_server',
+    'use_cache',
 ]
 
 CONFIDENCE_ENTRIES_KEEP_SERVING = [
@@ -51,6 +68,28 @@ DEFAULT_JH_PARAMS = {
     'mmseqs': {}
 }
 
+# residue names (as right aligned in PDB columns 18-20) that boltz tokenizes as one token per residue
+_STANDARD_RESIDUE_NAMES = np.array([
+    f"{name:>3}".encode('ascii') for name in [
+        'ALA', 'ARG', 'ASN', 'ASP', 'CYS', 'GLN', 'GLU', 'GLY', 'HIS', 'ILE',
+        'LEU', 'LYS', 'MET', 'PHE', 'PRO', 'SER', 'THR', 'TRP', 'TYR', 'VAL', 'UNK',
+        'A', 'G', 'C', 'U', 'N',
+        'DA', 'DG', 'DC', 'DT', 'DN',
+    ]
+], dtype='S3')
+
+# every micro-batch of diffusion samples is its own boltz_predict call, which reloads the checkpoint and
+# featurizes the inputs again (only the processed msas are reused): smaller micro-batches cost more than
+# early stopping can save
+MIN_SAMPLE_BATCH_SIZE = 4
+
+# boltz 0.4.0 caps each processed MSA at this depth
+BOLTZ_MAX_MSA_SEQS = 4096
+
+# protein MSAs already computed in this process, keyed by protein content (LRU, thread safe)
+PROTEIN_TRUNK_CACHE_SIZE = 32
+_PROTEIN_TRUNK_CACHE = ResultCache(max_entries=PROTEIN_TRUNK_CACHE_SIZE)
+
 DEFAULT_PARAMS = {
     'msa': 'no_msa',
     'msa_depth': 20,
@@ -61,72 +100,72 @@ DEFAULT_PARAMS = {
 }
 
 
-def convert_sto_to_a3m(sto_path=None, sto_str=None):
+def convert_sto_to_a3m(sto_path=None, sto_str=None, out_path=None, max_sequences=BOLTZ_MAX_MSA_SEQS):
+    """ Convert a Stockholm msa to a3m, returning the a3m text, or out_path if given
+
+    From sto_path the file is streamed once and memory is bounded by the kept msa (at most max_sequences
+    sequences, Boltz reads no more); with out_path the a3m is written there instead of returned as text.
+    """
     if sto_str is None:
         if sto_path is not None:
+            if out_path is not None:
+                convert_stockholm_file_to_a3m(sto_path, out_path, max_sequences=max_sequences)
+                return out_path
+            a3m = io.StringIO()
             with open(sto_path, 'r') as f:
-                msa_for_templates = f.read()
+                stream_stockholm_to_a3m(f, a3m, max_sequences=max_sequences)
+            return a3m.getvalue()
         else:
             raise ValueError("Either sto_path or msa_for_templates must be provided.")
     else:
         msa_for_templates = sto_str
     
     msa_for_templates = deduplicate_stockholm_msa(msa_for_templates)
-    try:
-        msa_for_templates = remove_empty_columns_from_stockholm_msa(
-            msa_for_templates)
-    except:
-        pass
+    # a malformed block raises here rather than passing an unfiltered msa on silently
+    msa_for_templates = remove_empty_columns_from_stockholm_msa(
+        msa_for_templates)
     msa_as_a3m = convert_stockholm_to_a3m(msa_for_templates)
     return msa_as_a3m
 
 @mlflow.trace(span_type='TOOL')
-def get_fasta_contents(file):
-    with open(file, 'r') as f:
-        file_contents = f.read()
-    return file_contents
-
-@mlflow.trace(span_type='TOOL')
-def get_jackhmmer_alignment(
-    query: str, 
+def get_jackhmmer_alignments(
+    queries: List[str], 
     sequences: Union[List[str], str], 
     jackhmmer_binary_path: str, 
-    as_a3m: Optional[bool] =True,
-    jh_kwargs: Optional[Dict]= None
-    ):
+    jh_kwargs: Optional[Dict]= None,
+    max_sto_sequences: int = 100,
+    timeout: Optional[float] = None,
+    ) -> List[str]:
     """
-    Run jackhmmer on a list of sequences, or a fasta file and return the alignment as a3m
+    Run jackhmmer for several query sequences against the same sequences in one batch, returning one a3m per query
+
+    Identical queries are searched once, and the distinct queries run concurrently against the database
+    (see Jackhmmer.query_batch) so the database is read once for the whole batch rather than once per query.
 
     Args:
-        query (str): The query protein sequence
+        queries (List[str]): The query protein sequences
         sequences (Union[List[str], str]): A list of sequences or if single str a path fo a fasta file
         jackhmmer_binary_path (str): Path to jackhmmer binary
-        as_a3m (Optional[bool]): If True, return the alignment as a3m, otherwise return the alignment as a fasta file
         jh_kwargs (Optional[Dict]): Keyword arguments for jackhmmer
+        max_sto_sequences (int): Maximum number of sequences kept from each jackhmmer alignment
+        timeout (Optional[float]): If given, run the searches through a ToolRunner and kill them (raising ToolTimeoutError) after this many seconds
+            - the searches run to completion in asyncio.run inside this synchronous call, so under pyfunc serving only
+              the timeout stops them: a client disconnect (or closing a predict_stream generator) does not cancel them
 
     Returns:
-        a3m_text (str): The alignment as a3m
+        a3m_texts (List[str]): The alignment of each query as a3m, in the order of queries
     """
-    # TODO make jackhmmer optional by using which jackhmmer?
-
     if jh_kwargs is None:
         jh_kwargs = dict()
 
-    # Create temporary input and output files
-    with tempfile.NamedTemporaryFile(mode='w+', suffix='.fasta') as in_file, \
-        tempfile.NamedTemporaryFile(mode='w+', suffix='.fasta') as q_file, \
-        tempfile.NamedTemporaryFile(mode='w+', suffix='.sto') as out_file:
+    unique_queries = list(dict.fromkeys(queries))
+
+    with tempfile.TemporaryDirectory() as q_dir, contextlib.ExitStack() as leases:
 
         if isinstance(sequences, list):
-            for name, seq in sequences:
-                if name.startswith('>'):
-                    name_ = name[1:]
-                else:
-                    name_ = name
-                in_file.write(f">{name_}\n{seq}\n")
-            in_file.flush()
-            infasta = get_fasta_contents(in_file.name)
-            in_file_name = in_file.name
+            # the same custom library is written to disk once and reused by later requests,
+            # the lease keeps it from being evicted while this search runs
+            in_file_name = leases.enter_context(target_db.get_default_registry().lease(sequences))
         elif isinstance(sequences, str):
             if os.path.exists(sequences):
                 in_file_name = sequences
@@ -135,65 +174,109 @@ def get_jackhmmer_alignment(
         else:
             raise ValueError("sequences must be a list of sequences or a path to a fasta file")
 
-        jackhmmer_uniref90_runner = jackhmmer.Jackhmmer(
+        jackhmmer_runner = jackhmmer.Jackhmmer(
             binary_path=jackhmmer_binary_path,
             database_path=in_file_name,
             **jh_kwargs
         )
 
-        input_sequence = query 
         input_description = "protein"
+        q_paths = []
+        for i, input_sequence in enumerate(unique_queries):
+            q_path = os.path.join(q_dir, f"query_{i}.fasta")
+            with open(q_path, 'w') as q_file:
+                q_file.write(f">{input_description}\n{input_sequence}\n")
+            q_paths.append(q_path)
+
+        if timeout is None:
+            jackhmmer_results = jackhmmer_runner.query_batch(q_paths, max_sto_sequences)
+        else:
+            jackhmmer_results = asyncio.run(
+                jackhmmer_runner.query_batch_async(q_paths, max_sto_sequences, timeout=timeout)
+            )
 
-        q_file.write(f">{input_description}\n{input_sequence}\n")
-        q_file.flush()
-
-        out_path = out_file.name
-        jackhmmer_uniref90_result = run_msa_tool(
-            msa_runner=jackhmmer_uniref90_runner,
-            input_fasta_path=q_file.name,
-            msa_out_path=out_path,
-            msa_format='sto',
-            use_precomputed_msas=False,
-            max_sto_sequences=100
-        )
-        a3m_text = convert_sto_to_a3m(out_path)
-    return a3m_text
+        a3m_by_query = {}
+        for i, (input_sequence, chunk_results) in enumerate(zip(unique_queries, jackhmmer_results)):
+            out_path = os.path.join(q_dir, f"query_{i}.sto")
+            with open(out_path, 'w') as out_file:
+                out_file.write(chunk_results[0]['sto'])
+            a3m_by_query[input_sequence] = convert_sto_to_a3m(out_path)
+    return [a3m_by_query[q] for q in queries]
 
 @mlflow.trace(span_type='TOOL')
-def post_process_boltz_results(dir, yaml_name, expected_result_count : int =0):
-    preds_dir = f"{dir}/boltz_results_{yaml_name}/predictions/{yaml_name}"
+def get_jackhmmer_alignment(
+    query: str, 
+    sequences: Union[List[str], str], 
+    jackhmmer_binary_path: str, 
+    as_a3m: Optional[bool] =True,
+    jh_kwargs: Optional[Dict]= None
+    ):
+    """
+    Run jackhmmer on a list of sequences, or a fasta file and return the alignment as a3m
 
-    boltz_results = []
+    Args:
+        query (str): The query protein sequence
+        sequences (Union[List[str], str]): A list of sequences or if single str a path fo a fasta file
+        jackhmmer_binary_path (str): Path to jackhmmer binary
+        as_a3m (Optional[bool]): If True, return the alignment as a3m, otherwise return the alignment as a fasta file
+        jh_kwargs (Optional[Dict]): Keyword arguments for jackhmmer
+
+    Returns:
+        a3m_text (str): The alignment as a3m
+    """
+    # TODO make jackhmmer optional by using which jackhmmer?
+    return get_jackhmmer_alignments(
+        [query],
+        sequences,
+        jackhmmer_binary_path,
+        jh_kwargs=jh_kwargs,
+    )[0]
+
+@mlflow.trace(span_type='TOOL')
+def post_process_boltz_results(dir, yaml_name, expected_result_count : int =0, run_name : Optional[str] = None):
+    # when boltz is given a directory of inputs, results are grouped under the directory name
+    if run_name is None:
+        run_name = yaml_name
+    preds_dir = f"{dir}/boltz_results_{run_name}/predictions/{yaml_name}"
+
+    pdb_texts = []
+    confidences = []
+    plddts = []
     for i in range(expected_result_count):
         with open(os.path.join(preds_dir, f"{yaml_name}_model_{i}.pdb"), 'r') as pdbfile:
-            pdb_text = pdbfile.read()
-            
+            pdb_texts.append(pdbfile.read())
         with open(os.path.join(preds_dir, f"confidence_{yaml_name}_model_{i}.json"),'r') as cf:
-            confidence = json.load(cf)
-        
-        plddt = np.load(
-            os.path.join(preds_dir, f"plddt_{yaml_name}_model_{i}.npz")
-        )['plddt']
-        
-        this_out_dict = {
+            confidences.append(json.load(cf))
+        with np.load(os.path.join(preds_dir, f"plddt_{yaml_name}_model_{i}.npz")) as npz:
+            plddts.append(npz['plddt'])
+
+    if not plddts:
+        return []
+    # all samples of one input have the same tokens: each result holds a view into one (samples, tokens) array
+    plddts = np.stack(plddts)
+
+    boltz_results = []
+    for pdb_text, confidence, plddt in zip(pdb_texts, confidences, plddts):
+        boltz_results.append({
             'pdb':pdb_text,
             'confidence':confidence,
             'plddt':plddt
-        }
-        boltz_results.append(this_out_dict)
-
+        })
     return boltz_results
 
-@mlflow.trace(span_type='TOOL')
-def process_boltz_inputs(
-    config: Dict,
-    boltz_yaml_file_path: str,
-    tmp_file_path: str,
+def make_boltz_input_dict(
     sequences: Dict[str, List[Tuple]],
     msa_file_paths: Optional[List[str]] = None,
-    cache: Optional[str] = None
-    ):
+    ) -> Dict:
+    """ Build the content of a Boltz input yaml
+
+    Args:
+        sequences : Dict with optional keys: ['protein', 'ligand', 'dna', 'rna'], and values lists of tuples (ids, sequence)
+        msa_file_paths : one msa path per protein sequence (or "empty"), or None to let Boltz use the msa server
 
+    Returns:
+        input_dict : dictionary to be dumped as the Boltz input yaml
+    """
     protein_sequences = sequences.get('protein', None)
 
     if msa_file_paths is not None and protein_sequences is not None:
@@ -214,65 +297,73 @@ def process_boltz_inputs(
         if msa_file_path is not None:
             out_d['protein'].update({"msa": msa_file_path})
         return out_d
-    
-    with mlflow.start_span("Boltz input dict", span_type='TOOL') as span:
-        span.set_inputs({"sequences": sequences, "msa_paths": msa_file_paths})
-        input_dict = {'sequences': []}
-
-        if protein_sequences is not None:
-            if msa_file_paths is not None:
-                for i,(s,msa_fp) in enumerate(zip(protein_sequences, msa_file_paths)):
-                    # set chain_id to be letter of alphabet at position i
-                    input_dict["sequences"].append(
-                        process_single_protein_chain(
-                            f"{str(list(s[0]))}",
-                            s[1], 
-                            msa_fp
-                            )
-                    )
-            else:
-                for i,s in enumerate(protein_sequences):
-                    input_dict["sequences"].append(
-                        process_single_protein_chain(
-                            f"{str(list(s[0]))}",
-                            s[1],
-                            None
-                            )
-                    )
-        naming_conv = {
-            'dna':'sequence',
-            'rna':'sequence',
-            'ligand':'smiles'
-        }
-        for t in ['dna', 'rna', 'ligand']:
-            seqs = sequences.get(t, None)
-            if seqs:
-                for s in seqs:
-                    input_dict["sequences"].append({
-                        t: {
-                            'id': f"{str(list(s[0]))}",
-                            naming_conv[t]: s[1],
-                        }
-                    })
-        span.set_outputs({"Boltz input yaml content": input_dict})
 
-    with open(boltz_yaml_file_path, 'w') as file:
-        yaml.dump(input_dict, file)
-
-    arg = boltz_yaml_file_path
+    input_dict = {'sequences': []}
+
+    if protein_sequences is not None:
+        if msa_file_paths is not None:
+            for i,(s,msa_fp) in enumerate(zip(protein_sequences, msa_file_paths)):
+                # set chain_id to be letter of alphabet at position i
+                input_dict["sequences"].append(
+                    process_single_protein_chain(
+                        f"{str(list(s[0]))}",
+                        s[1], 
+                        msa_fp
+                        )
+                )
+        else:
+            for i,s in enumerate(protein_sequences):
+                input_dict["sequences"].append(
+                    process_single_protein_chain(
+                        f"{str(list(s[0]))}",
+                        s[1],
+                        None
+                        )
+                )
+    naming_conv = {
+        'dna':'sequence',
+        'rna':'sequence',
+        'ligand':'smiles'
+    }
+    for t in ['dna', 'rna', 'ligand']:
+        seqs = sequences.get(t, None)
+        if seqs:
+            for s in seqs:
+                input_dict["sequences"].append({
+                    t: {
+                        'id': f"{str(list(s[0]))}",
+                        naming_conv[t]: s[1],
+                    }
+                })
+    return input_dict
+
+def make_boltz_args(
+    config: Dict,
+    data_path: str,
+    tmp_file_path: str,
+    msa_file_paths: Optional[List[str]] = None,
+    cache: Optional[str] = None,
+    diffusion_samples: Optional[int] = None,
+    seed: Optional[int] = None,
+    ) -> List:
+    """ Build the Boltz cli argument list for an input yaml or a directory of input yamls """
+    if diffusion_samples is None:
+        diffusion_samples = config['diffusion_samples']
     kwargs = {
         'out_dir' : tmp_file_path,
         'devices' : 1,
         'accelerator' : config['compute_type'], 
         'recycling_steps' : config['recycling_steps'],
         'sampling_steps' : config['sampling_steps'],
-        'diffusion_samples' : config['diffusion_samples'],
+        'diffusion_samples' : diffusion_samples,
         'output_format' : "pdb"
     }
     if cache:
         kwargs.update({'cache': cache})
+    if seed is not None:
+        kwargs.update({'seed': seed})
 
-    in_list = [arg]
+    in_list = [data_path]
     for k, v in kwargs.items():
         in_list.append('--'+k)
         in_list.append(v)
@@ -282,96 +373,511 @@ def process_boltz_inputs(
     
     return in_list
 
-
-@mlflow.trace(span_type='CHAIN')
-def run_boltz(
-    sequences : Dict[str, List[Tuple]], 
+@mlflow.trace(span_type='TOOL')
+def process_boltz_inputs(
     config: Dict,
+    boltz_yaml_file_path: str,
+    tmp_file_path: str,
+    sequences: Dict[str, List[Tuple]],
+    msa_file_paths: Optional[List[str]] = None,
+    cache: Optional[str] = None,
+    diffusion_samples: Optional[int] = None,
+    seed: Optional[int] = None,
     ):
-    """ Run vectorboltz protein
+
+    with mlflow.start_span("Boltz input dict", span_type='TOOL') as span:
+        span.set_inputs({"sequences": sequences, "msa_paths": msa_file_paths})
+        input_dict = make_boltz_input_dict(sequences, msa_file_paths)
+        span.set_outputs({"Boltz input yaml content": input_dict})
+
+    with open(boltz_yaml_file_path, 'w') as file:
+        yaml.dump(input_dict, file)
+
+    return make_boltz_args(
+        config,
+        boltz_yaml_file_path,
+        tmp_file_path,
+        msa_file_paths=msa_file_paths,
+        cache=cache,
+        diffusion_samples=diffusion_samples,
+        seed=seed,
+    )
+
+@mlflow.trace(span_type='TOOL')
+def get_protein_msas(
+    protein_sequences: List[Tuple],
+    config: Dict,
+    ) -> List[str]:
+    """ Compute one msa (a3m text, or "empty") per protein sequence according to config['msa'] """
+    # parse out any jackhmmer kwargs
+    jh_kwargs = {k.split('jh__')[1]:v for k,v in config.items() if k.startswith('jh__')}
+    # params arrive as strings, the counts are used in arithmetic by Jackhmmer
+    for k in ('n_cpu', 'n_iter', 'num_shards', 'num_streamed_chunks'):
+        if jh_kwargs.get(k) is not None:
+            jh_kwargs[k] = int(jh_kwargs[k])
+
+    if config['msa']=='jh':
+        # all chains are searched in one batch
+        msas = get_jackhmmer_alignments(
+            queries=[sequence[1] for sequence in protein_sequences], 
+            sequences=config['index_name'], 
+            jackhmmer_binary_path=config['jackhmmer_binary_path'],
+            jh_kwargs=jh_kwargs,
+            timeout=config.get('jh_timeout'),
+        )
+
+    elif config['msa']=='no_msa':
+        msas = []
+        for sequence in protein_sequences:
+            msa_text = "empty" #f">protein\n{sequence[1]}\n"
+            msas.append(msa_text)
+    elif config['msa']=='mmseqs':
+        msas = []
+    else:
+        raise ValueError("msa must be one of ['jh', 'no_msa', 'mmseqs']")
+    return msas
+
+def write_msa_files(
+    protein_sequences: List[Tuple],
+    msas: List[str],
+    msa_dir: str,
+    ) -> List[str]:
+    """ Write each msa to msa_dir as {chain}.a3m, returning the paths to hand to Boltz """
+    msa_paths = []
+    for i, (s,msa_text) in enumerate(zip(protein_sequences, msas)):
+        if msa_text=='empty':
+            msa_paths.append(msa_text)
+        else:
+            id_ = s[0] # this is a tuple of ids
+            chain = id_[0] # we only use the first - ok because there is only one a3m per sequence (not per id)
+            tmp_f = os.path.join(msa_dir, f"{chain}.a3m")
+            msa_paths.append(tmp_f)
+            with open(tmp_f, 'w') as tmp_f_write:
+                tmp_f_write.write(msa_text)
+    return msa_paths
+
+class SamplingController:
+    """ Collects diffusion samples as they arrive in micro-batches, ranks them and decides when to stop
+
+    Sampling stops once max_samples have been drawn, or earlier when:
+     - the best confidence_score reaches target_confidence, or
+     - the top_k ranked samples stayed the same for patience micro-batches in a row
+    """
+    def __init__(
+        self,
+        max_samples: int,
+        target_confidence: Optional[float] = None,
+        top_k: Optional[int] = None,
+        patience: int = 1,
+        ):
+        self.max_samples = max_samples
+        self.target_confidence = target_confidence
+        self.top_k = top_k
+        self.patience = patience
+        self.ranked = []
+        self.n_batches = 0
+        self._stable_batches = 0
+        self.stop_reason = None
+
+    @property
+    def n_samples(self) -> int:
+        return len(self.ranked)
+
+    def _top_k_ids(self) -> List[int]:
+        return [id(r) for r in self.ranked[:self.top_k]]
+
+    def add(self, results: List[Dict]):
+        """ add the results of one micro-batch and re-rank by confidence_score (best first) """
+        top_before = self._top_k_ids() if self.top_k else None
+        self.ranked = sorted(
+            self.ranked + list(results),
+            key=lambda r: r['confidence']['confidence_score'],
+            reverse=True,
+        )
+        self.n_batches += 1
+        if self.top_k and len(top_before) == self.top_k and self._top_k_ids() == top_before:
+            self._stable_batches += 1
+        else:
+            self._stable_batches = 0
+
+    def done(self) -> bool:
+        if self.n_samples >= self.max_samples:
+            self.stop_reason = 'max_samples'
+        elif self.target_confidence is not None and self.ranked and \
+                self.ranked[0]['confidence']['confidence_score'] >= self.target_confidence:
+            self.stop_reason = 'target_confidence'
+        elif self.top_k and self._stable_batches >= self.patience:
+            self.stop_reason = 'top_k_stable'
+        return self.stop_reason is not None
+
+    def next_batch_size(self, batch_size: int) -> int:
+        return min(batch_size, self.max_samples - self.n_samples)
+
+def _link_processed_msas(from_out_dir: str, to_out_dir: str, run_name: str):
+    """ Reuse the processed msas of an earlier Boltz run on the same input, so Boltz does not parse the a3m again """
+    src_dir = os.path.join(from_out_dir, f"boltz_results_{run_name}", "processed", "msa")
+    dst_dir = os.path.join(to_out_dir, f"boltz_results_{run_name}", "processed", "msa")
+    if not os.path.isdir(src_dir):
+        return
+    os.makedirs(dst_dir, exist_ok=True)
+    for name in os.listdir(src_dir):
+        try:
+            os.link(os.path.join(src_dir, name), os.path.join(dst_dir, name))
+        except OSError:
+            shutil.copyfile(os.path.join(src_dir, name), os.path.join(dst_dir, name))
+
+def _boltz_predict_process(in_list: List):
+    boltz_predict(in_list, standalone_mode=False)
+
+def _run_boltz_predict_watched(in_list: List, processed_manifest: str, poll_interval: float = 0.5):
+    """ Run boltz_predict in a worker process, yielding 'featurization' once Boltz has written its processed inputs
+
+    The worker is a process rather than a thread so it can be stopped: closing the generator (e.g. a client
+    that stops reading a stream) kills the Boltz run before the caller cleans up its input and output dirs.
+    """
+    worker = multiprocessing.get_context('spawn').Process(
+        target=_boltz_predict_process, args=(in_list,), name="boltz-predict", daemon=True
+    )
+    worker.start()
+    try:
+        featurized = False
+        while worker.is_alive():
+            worker.join(poll_interval)
+            if not featurized and os.path.exists(processed_manifest):
+                featurized = True
+                yield 'featurization'
+        if worker.exitcode != 0:
+            raise RuntimeError(f"Boltz predict failed with exit code {worker.exitcode}, see its stderr")
+        if not featurized:
+            yield 'featurization'
+    finally:
+        if worker.is_alive():
+            worker.kill()
+        worker.join()
+
+def iter_boltz_stages(
+    sequences : Dict[str, List[Tuple]],
+    config: Dict,
+    watch_progress: bool = False,
+    ) -> Iterator[Dict]:
+    """ Run Boltz as in run_boltz, yielding an event dict as each stage finishes
+
+    Events have a 'stage' entry and the seconds since the start in 'elapsed':
+     - 'msa': the msas of all protein chains are computed
+     - 'featurization': Boltz has processed its inputs (once, for the first micro-batch, only if watch_progress)
+     - 'sample': a diffusion sample is written, in 'result' (samples of one micro-batch arrive together)
+     - 'done': sampling stopped (see 'stop_reason'), 'results' holds all samples, best confidence_score first
 
     Args:
-        sequences : Dict with optional keys: ['protein', 'ligand', 'dna', 'rna'], and values lists of tuples (ids, sequence), ids is a tuple of ids
-        config : A dictionary of model configuration parameters.
+        sequences : as in run_boltz
+        config : as in run_boltz
+        watch_progress : run boltz_predict in a worker process and watch its output dir for the end of featurization,
+            closing the generator early stops the worker
     """
-    
+    tic = time.time()
+    controller = SamplingController(
+        max_samples=config['diffusion_samples'],
+        target_confidence=config.get('target_confidence'),
+        top_k=config.get('stop_top_k'),
+        patience=config.get('stop_patience', 1),
+    )
+    batch_size = config.get('sample_batch_size') or config['diffusion_samples']
+    batch_size = max(batch_size, MIN_SAMPLE_BATCH_SIZE)
+    seed = config.get('seed')
+
     with tempfile.NamedTemporaryFile(suffix='.yaml') as f, \
          tempfile.TemporaryDirectory() as tmp_outdir:
 
-        # parse out any jackhmmer kwargs
-        jh_kwargs = {k.split('jh__')[1]:v for k,v in config.items() if k.startswith('jh__')}
-
-        if config['msa']=='jh':
-            msas=[]
-            for sequence in sequences['protein']:
-                msa_text = get_jackhmmer_alignment(
-                    query=sequence[1], 
-                    sequences=config['index_name'], 
-                    jackhmmer_binary_path=config['jackhmmer_binary_path'],
-                    jh_kwargs=jh_kwargs,
-                )
-                msas.append(msa_text)
-
-        elif config['msa']=='no_msa':
-            msas = []
-            for sequence in sequences['protein']:
-                msa_text = "empty" #f">protein\n{sequence[1]}\n"
-                msas.append(msa_text)
-        elif config['msa']=='mmseqs':
-            msas = []
-        else:
-            raise ValueError("msa must be one of ['jh', 'no_msa', 'mmseqs']")
+        msas = get_protein_msas(sequences['protein'], config)
+        yaml_name = f.name.split(os.sep)[-1].split('.')[0]
+        yield {'stage': 'msa', 'elapsed': time.time() - tic}
 
         # write msas to file for each sequence
         with tempfile.TemporaryDirectory() as tmp_dir:
-            msa_paths = []
-            for i, (s,msa_text) in enumerate(zip(sequences['protein'], msas)):
-                if msa_text=='empty':
-                    msa_paths.append(msa_text)
-                else:
-                    id_ = s[0] # this is a tuple of ids
-                    chain = id_[0] # we only use the first - ok because there is only one a3m per sequence (not per id)
-                    tmp_f = os.path.join(tmp_dir, f"{chain}.a3m")
-                    msa_paths.append(tmp_f)
-                    with open(tmp_f, 'w') as tmp_f_write:
-                        tmp_f_write.write(msa_text)
+            msa_paths = write_msa_files(sequences['protein'], msas, tmp_dir)
 
             if len(msas)==0:
                 msa_paths=None
                 if config['msa']!='mmseqs':
-                    raise ValueError(f"No msa sequences generated, this should not occur unless msa is set to 'mmseqs', it is set to {params['msa']}")
-
-            in_list = process_boltz_inputs(
-                config=config,
-                boltz_yaml_file_path= f.name,
-                tmp_file_path= tmp_outdir,
-                sequences=sequences,
-                msa_file_paths=msa_paths,
-                cache=config.get('cache')
-            )
+                    raise ValueError(f"No msa sequences generated, this should not occur unless msa is set to 'mmseqs', it is set to {config['msa']}")
+
+            batch_outdirs = []
+            while not controller.done():
+                n_samples = controller.next_batch_size(batch_size)
+                # each micro-batch writes to its own dir: boltz skips inputs with existing predictions
+                batch_outdir = os.path.join(tmp_outdir, f"batch_{controller.n_batches}")
+                if batch_outdirs and msa_paths is not None:
+                    _link_processed_msas(batch_outdirs[0], batch_outdir, yaml_name)
+                batch_outdirs.append(batch_outdir)
+
+                in_list = process_boltz_inputs(
+                    config=config,
+                    boltz_yaml_file_path= f.name,
+                    tmp_file_path= batch_outdir,
+                    sequences=sequences,
+                    msa_file_paths=msa_paths,
+                    cache=config.get('cache'),
+                    diffusion_samples=n_samples,
+                    seed=None if seed is None else seed + controller.n_batches,
+                )
 
-            # use span so can log other variables too
-            with mlflow.start_span("Boltz-1", span_type='LLM') as span:
-                span.set_inputs({"input kwargs": in_list, "sequences": sequences})
-                boltz_predict(in_list, standalone_mode=False)
-                span.set_outputs({"Boltz-1 raw results": tmp_outdir})
-            
-            yaml_name = f.name.split(os.sep)[-1].split('.')[0]
-            boltz_results = post_process_boltz_results(
-                tmp_outdir, 
-                yaml_name, 
-                expected_result_count=config['diffusion_samples']
+                # use span so can log other variables too
+                with mlflow.start_span("Boltz-1", span_type='LLM') as span:
+                    span.set_inputs({"input kwargs": in_list, "sequences": sequences})
+                    if watch_progress:
+                        manifest = os.path.join(batch_outdir, f"boltz_results_{yaml_name}", "processed", "manifest.json")
+                        # closing makes the worker stop before the temporary dirs are removed
+                        with contextlib.closing(_run_boltz_predict_watched(in_list, manifest)) as stages:
+                            for stage in stages:
+                                if controller.n_batches == 0:
+                                    yield {'stage': stage, 'elapsed': time.time() - tic}
+                    else:
+                        boltz_predict(in_list, standalone_mode=False)
+                    span.set_outputs({"Boltz-1 raw results": batch_outdir})
+
+                batch_results = post_process_boltz_results(
+                    batch_outdir, 
+                    yaml_name, 
+                    expected_result_count=n_samples
+                )
+                for i, r in enumerate(batch_results):
+                    yield {
+                        'stage': 'sample',
+                        'elapsed': time.time() - tic,
+                        'sample': controller.n_samples + i,
+                        'confidence_score': r['confidence']['confidence_score'],
+                        'result': r,
+                    }
+                controller.add(batch_results)
+
+            with mlflow.start_span("Diffusion sample ranking", span_type='TOOL') as span:
+                span.set_inputs({"diffusion_samples": config['diffusion_samples'], "sample_batch_size": batch_size})
+                span.set_outputs({
+                    "samples_drawn": controller.n_samples,
+                    "sample_batches": controller.n_batches,
+                    "stop_reason": controller.stop_reason,
+                    "confidence_scores": [r['confidence']['confidence_score'] for r in controller.ranked],
+                })
+
+        yield {
+            'stage': 'done',
+            'elapsed': time.time() - tic,
+            'stop_reason': controller.stop_reason,
+            'results': controller.ranked,
+        }
+
+@mlflow.trace(span_type='CHAIN')
+def run_boltz(
+    sequences : Dict[str, List[Tuple]], 
+    config: Dict,
+    ):
+    """ Run vectorboltz protein
+
+    Diffusion samples are drawn in micro-batches of config['sample_batch_size'] (default: all
+    config['diffusion_samples'] at once) and ranked by confidence_score as they arrive. Sampling stops
+    early once the best sample reaches config['target_confidence'], or once the config['stop_top_k'] best
+    samples have not changed for config['stop_patience'] (default 1) micro-batches.
+
+    Micro-batches are not free: each one is a separate Boltz run that loads the checkpoint and featurizes
+    the inputs again (the processed msas are reused). sample_batch_size is therefore raised to at least
+    MIN_SAMPLE_BATCH_SIZE, and early stopping pays off when a micro-batch samples for much longer than
+    that fixed cost, i.e. for many sampling_steps or large complexes.
+
+    Args:
+        sequences : Dict with optional keys: ['protein', 'ligand', 'dna', 'rna'], and values lists of tuples (ids, sequence), ids is a tuple of ids
+        config : A dictionary of model configuration parameters.
+
+    Returns:
+        The results of the drawn samples, best confidence_score first
+    """
+    for event in iter_boltz_stages(sequences, config):
+        if event['stage'] == 'done':
+            return event['results']
+
+def protein_trunk_key(protein_sequences: List[Tuple], config: Dict) -> str:
+    """ Hash of the protein chains and the msa settings that determine their msas """
+    msa_settings = {k:v for k,v in config.items() if k in ('msa', 'index_name') or k.startswith('jh__')}
+    content = json.dumps(
+        {
+            'protein': [[list(ids), seq] for ids, seq in protein_sequences],
+            'msa_settings': msa_settings,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def get_cached_protein_msas(protein_sequences: List[Tuple], config: Dict) -> List[str]:
+    """ get_protein_msas, but reusing msas already computed in this process for identical proteins """
+    key = protein_trunk_key(protein_sequences, config)
+    # concurrent requests for the same proteins wait for one search rather than each running it
+    return _PROTEIN_TRUNK_CACHE.get_or_compute(key, lambda: get_protein_msas(protein_sequences, config))
+
+def _seed_processed_msas(
+    msa_paths: List[str],
+    processed_msa_dir: str,
+    target_ids: List[str],
+    ):
+    """ Parse each protein a3m once and place the processed msa where Boltz expects it for every target
+
+    Boltz names processed msas {target_id}_{msa_idx}.npz, with msa_idx the position of the msa path in the
+    sorted msa paths of the target. Every screening target shares the same protein msa paths, so one parsed
+    msa can be linked in for all targets and Boltz skips parsing the a3m per ligand.
+    """
+    from boltz.data.parse.a3m import parse_a3m
+
+    os.makedirs(processed_msa_dir, exist_ok=True)
+    unique_paths = sorted({p for p in msa_paths if p != 'empty'})
+    for msa_idx, msa_path in enumerate(unique_paths):
+        first = os.path.join(processed_msa_dir, f"{target_ids[0]}_{msa_idx}.npz")
+        msa = parse_a3m(msa_path, taxonomy=None, max_seqs=BOLTZ_MAX_MSA_SEQS)
+        msa.dump(first)
+        for target_id in target_ids[1:]:
+            other = os.path.join(processed_msa_dir, f"{target_id}_{msa_idx}.npz")
+            try:
+                os.link(first, other)
+            except OSError:
+                shutil.copyfile(first, other)
+
+def _next_chain_id(used_ids: List[str]) -> str:
+    for c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ':
+        if c not in used_ids:
+            return c
+    raise ValueError("No free chain id left for the ligand")
+
+@mlflow.trace(span_type='CHAIN')
+def run_boltz_screen(
+    protein_sequences : List[Tuple],
+    ligands : List[str],
+    config: Dict,
+    ) -> List[List[Dict]]:
+    """ Run Boltz for one protein specification against many ligands
+
+    The protein msas are computed once (and cached per process by protein content), written once, and
+    parsed once into Boltz's processed msa format. All ligand complexes are then predicted in a single
+    Boltz call, so the model is only loaded once and per-ligand cost is the ligand dependent work.
+
+    Args:
+        protein_sequences : list of tuples (ids, sequence) for the protein chains, as in run_boltz
+        ligands : list of SMILES strings, each screened against the protein in its own complex
+        config : A dictionary of model configuration parameters.
+
+    Returns:
+        A list (one entry per ligand, in input order) of lists of results, one for each diffusion sample.
+    """
+    if config['msa']=='mmseqs':
+        raise ValueError("screening requires precomputed msas, msa must be one of ['jh', 'no_msa']")
+
+    used_ids = [i for ids, _ in protein_sequences for i in ids]
+    ligand_id = (_next_chain_id(used_ids),)
+
+    msas = get_cached_protein_msas(protein_sequences, config)
+
+    run_name = 'screen'
+    with tempfile.TemporaryDirectory() as tmp_outdir, \
+         tempfile.TemporaryDirectory() as tmp_dir:
+
+        msa_paths = write_msa_files(protein_sequences, msas, tmp_dir)
+
+        input_dir = os.path.join(tmp_dir, run_name)
+        os.makedirs(input_dir)
+        target_ids = [f"ligand_{j}" for j in range(len(ligands))]
+        for target_id, smiles in zip(target_ids, ligands):
+            input_dict = make_boltz_input_dict(
+                {'protein': protein_sequences, 'ligand': [(ligand_id, smiles)]},
+                msa_paths
             )
+            with open(os.path.join(input_dir, f"{target_id}.yaml"), 'w') as file:
+                yaml.dump(input_dict, file)
 
-        return boltz_results
+        _seed_processed_msas(
+            msa_paths,
+            os.path.join(tmp_outdir, f"boltz_results_{run_name}", "processed", "msa"),
+            target_ids
+        )
+
+        in_list = make_boltz_args(
+            config,
+            input_dir,
+            tmp_outdir,
+            msa_file_paths=msa_paths,
+            cache=config.get('cache')
+        )
+
+        with mlflow.start_span("Boltz-1 screen", span_type='LLM') as span:
+            span.set_inputs({"input kwargs": in_list, "protein": protein_sequences, "ligands": ligands})
+            boltz_predict(in_list, standalone_mode=False)
+            span.set_outputs({"Boltz-1 raw results": tmp_outdir})
+
+        screen_results = []
+        for target_id in target_ids:
+            screen_results.append(
+                post_process_boltz_results(
+                    tmp_outdir,
+                    target_id,
+                    expected_result_count=config['diffusion_samples'],
+                    run_name=run_name
+                )
+            )
+    return screen_results
 
 def place_plddt_in_pdb(pdb : str, plddt : np.ndarray) -> str:
-    pass
+    """ Write per token pLDDT into the B-factor column of the ATOM/HETATM records of a Boltz PDB
+
+    Boltz has one token per standard residue and one token per atom of ligands and non standard
+    residues, in the order the atoms are written out. pLDDT (0-1) is written scaled to 0-100.
+    All atom records are rewritten at once on the bytes of the PDB, which has fixed width columns.
+
+    Args:
+        pdb: PDB text as written by Boltz
+        plddt: pLDDT of each token
+
+    Returns:
+        the PDB text with pLDDT as B-factors
+    """
+    buf = np.frombuffer(pdb.encode('ascii'), dtype=np.uint8).copy()
+    newlines = np.flatnonzero(buf == ord('\n'))
+    line_starts = np.concatenate(([0], newlines + 1))
+    line_ends = np.concatenate((newlines, [buf.size]))
+    # the B-factor is in columns 61-66
+    line_starts = line_starts[line_ends - line_starts >= 66]
+    if line_starts.size == 0:
+        return pdb
+
+    records = np.ascontiguousarray(buf[line_starts[:, None] + np.arange(6)]).view('S6').ravel()
+    is_hetatm = records == b'HETATM'
+    atom_starts = line_starts[(records == b'ATOM  ') | is_hetatm]
+    is_hetatm = is_hetatm[(records == b'ATOM  ') | is_hetatm]
+    if atom_starts.size == 0:
+        return pdb
+
+    # residue name, chain, residue number and insertion code (columns 18-27) identify a residue
+    residue_fields = buf[atom_starts[:, None] + np.arange(17, 27)]
+    new_residue = np.ones(atom_starts.size, dtype=bool)
+    new_residue[1:] = (residue_fields[1:] != residue_fields[:-1]).any(axis=1)
+    residue_names = np.ascontiguousarray(residue_fields[:, :3]).view('S3').ravel()
+    per_atom = is_hetatm | ~np.isin(residue_names, _STANDARD_RESIDUE_NAMES)
+    token_index = np.cumsum(new_residue | per_atom) - 1
+
+    plddt = np.asarray(plddt, dtype=np.float64).ravel()
+    if token_index[-1] >= plddt.size:
+        raise ValueError(
+            f"The PDB has {token_index[-1] + 1} tokens but only {plddt.size} pLDDT values were given"
+        )
+    b_factors = np.char.mod('%6.2f', 100 * plddt[token_index]).astype('S6')
+    buf[atom_starts[:, None] + np.arange(60, 66)] = b_factors.view(np.uint8).reshape(-1, 6)
+    return buf.tobytes().decode('ascii')
 
 class Boltz(mlflow.pyfunc.PythonModel):
     def load_context(self, context):
         self.artifacts = context.artifacts
         self.model_config = context.model_config
+        # identical requests (same complex and params) are served from here, see predict
+        self.result_cache = ResultCache(
+            max_entries=int(self.model_config.get('result_cache_size', 128)),
+            ttl=float(self.model_config.get('result_cache_ttl', 24 * 3600)),
+            disk_dir=self.model_config.get('result_cache_dir'),
+        )
         # NOTE: eventaully want to reqrite Boltz so that model load to GPU happens
         # only at this point and not on inference. This is a more major effort. 
     
@@ -414,33 +920,8 @@ class Boltz(mlflow.pyfunc.PythonModel):
                 pass
         return params
     
-    def _enforce_out_schema(self, results):
-        new_results = []
-        for r in results:
-            # TODO: place plddt per residue in pdb - but have to be careful - per residue and also multi chain, rna, ligand etc
-            # new_pdb = place_plddt_in_pdb(r['pdb'], r['plddt'])
-            new_pdb = r['pdb']
-            tmp_r = {}
-            tmp_r['pdb'] = new_pdb
-            for k,v in r['confidence'].items():
-                if k in CONFIDENCE_ENTRIES_KEEP_SERVING:
-                    tmp_r[k] = "{:.7f}".format(v)
-            new_results.append(tmp_r)
-        return new_results
-
-    def predict(self, context, model_input: List[Dict[str,str]], params:Optional[Dict[str,Any]]=None) -> List[Dict[str,str]]:
-        """ predicts one structure specification on each call - can be multipledissuion samoples out though
-
-        Args:
-            model_input: A list of protein/nucleotide/small_molecule sequences in one single structure. Each sequence can be formatted as "{entity_name}_{sequence}", e.g "protein_CASTTR", "dna_CCGGAT", "rna_UCG", "smiles_C1CCCCC1". If no entityis provided, assumes protein.
-            
-            params: dictionary of parameters for the model - can be chosen at runtime. includes: 'msa': 'vs' (default), 'jh' or 'no_msa', 'l2_distance_threshold': 2.0 (default), 'jh__evalue', 'jh__filter_f{1/2/3}".
-
-        
-        Returns:
-            A list of dictionaries containing the structure and confidence scores, one list entry for each diffusion sample.
-
-        """ 
+    def _prep_request(self, model_input: List[Dict[str,str]]) -> Tuple[Dict[str, List[Tuple]], Dict, bool]:
+        """ split a predict request into its sequences, run config and whether to use the result cache """
         if len(model_input)>1:
             raise ValueError("Only one sequence at a time")
 
@@ -449,8 +930,34 @@ class Boltz(mlflow.pyfunc.PythonModel):
         params = {k:v for k,v in model_input.items() if k!='input'}
         model_input = model_input['input']
 
-        sequences = self._prep_input_sequences(model_input)
+        # the same normalized sequences are hashed for the result cache and passed to Boltz
+        sequences = self._normalize_sequences(self._prep_input_sequences(model_input))
             
+        mc = self._make_config(params)
+        use_cache = mc.pop('use_cache', True)
+        return sequences, mc, use_cache
+
+    def _normalize_sequences(self, sequences: Dict[str, List[Tuple]]) -> Dict[str, List[Tuple]]:
+        """ complex specification with surrounding whitespace removed from ids and sequences """
+        return {
+            t: [(tuple(i.strip() for i in ids), seq.strip()) for ids, seq in entries]
+            for t, entries in sequences.items()
+        }
+
+    def _enforce_out_schema(self, results):
+        new_results = []
+        for r in results:
+            tmp_r = {}
+            tmp_r['pdb'] = place_plddt_in_pdb(r['pdb'], r['plddt'])
+            for k,v in r['confidence'].items():
+                if k in CONFIDENCE_ENTRIES_KEEP_SERVING:
+                    tmp_r[k] = float(v)
+            tmp_r['plddt'] = r['plddt'].tolist()
+            new_results.append(tmp_r)
+        return new_results
+
+    def _make_config(self, params: Dict[str,str]) -> Dict:
+        """ merge defaults, user params and the model config into the run config """
         parsed_params = self._prep_input_params(params)
         # update params with user-provided params
         params_ = DEFAULT_PARAMS.copy()
@@ -470,33 +977,105 @@ class Boltz(mlflow.pyfunc.PythonModel):
         # allow user to overwrite config (copy) during inference (this may later be changed)
         mc = self.model_config.copy()
         mc.update(params_)
+        return mc
 
-        # run the model with desired params, inc. msa type
-        boltz_results = run_boltz(
-            sequences,
-            config = mc,
-        )
-        boltz_results = self._enforce_out_schema(boltz_results)
-        return boltz_results
-                
-
-
-
-
-
-
-
-
-
-
-
-
-
+    def predict(self, context, model_input: List[Dict[str,str]], params:Optional[Dict[str,Any]]=None) -> List[Dict[str,Any]]:
+        """ predicts one structure specification on each call - can be multipledissuion samoples out though
 
+        Args:
+            model_input: A list of protein/nucleotide/small_molecule sequences in one single structure. Each sequence can be formatted as "{entity_name}_{sequence}", e.g "protein_CASTTR", "dna_CCGGAT", "rna_UCG", "smiles_C1CCCCC1". If no entityis provided, assumes protein.
+            
+            params: dictionary of parameters for the model - can be chosen at runtime. includes: 'msa': 'vs' (default), 'jh' or 'no_msa', 'l2_distance_threshold': 2.0 (default), 'jh__evalue', 'jh__filter_f{1/2/3}", 'jh_timeout' (seconds before a jackhmmer search is killed), 'diffusion_samples' (the maximum number of samples), 'sample_batch_size', 'target_confidence', 'stop_top_k', 'stop_patience' and 'seed' (see run_boltz), 'use_cache': 'True' (default) to return the cached result of an identical earlier request.
+                These are passed as entries of the model_input dict, next to 'input'.
+                The `params` argument (the signature's params) takes 'ligands': a list of SMILES to screen against the protein chains of the input (see screen), the input must then hold only protein chains.
 
+        
+        Returns:
+            A list of dictionaries containing the structure (with pLDDT as B-factors), the confidence scores as floats and the per token pLDDT, one list entry for each diffusion sample drawn, best confidence_score first.
+            With 'ligands', the samples of every ligand in ligand order, each with the SMILES of its ligand in 'ligand'.
 
+        """ 
+        ligands = (params or {}).get('ligands')
+        if ligands:
+            if len(model_input)>1:
+                raise ValueError("Only one sequence at a time")
+            screen_results = self.screen(model_input[0], list(ligands))
+            return [
+                dict(r, ligand=smiles)
+                for smiles, results in zip(ligands, screen_results)
+                for r in results
+            ]
+
+        sequences, mc, use_cache = self._prep_request(model_input)
+
+        def _predict():
+            # run the model with desired params, inc. msa type
+            boltz_results = run_boltz(
+                sequences,
+                config = mc,
+            )
+            return self._enforce_out_schema(boltz_results)
 
+        if not use_cache:
+            return _predict()
+        key = make_cache_key('predict', sequences, mc)
+        return self.result_cache.get_or_compute(key, _predict)
 
+    def predict_stream(self, context, model_input: List[Dict[str,str]], params:Optional[Dict[str,Any]]=None) -> Iterator[Dict[str,Any]]:
+        """ predict, yielding an event as each stage finishes so clients can show progress and use early samples
 
+        Args:
+            model_input: as in predict, the params are the same too
+
+        Yields:
+            dicts with the 'stage' that finished and the seconds since the start in 'elapsed':
+             - 'msa': the msas are computed
+             - 'featurization': Boltz has processed its inputs
+             - 'sample': a diffusion sample is done, its 'confidence_score' and its 'result' (as in predict) are included
+             - 'done': always last, 'results' holds all samples as predict returns them, 'stop_reason' why sampling stopped
+            A cached result is yielded straight away as a single 'done' event with 'cached': True.
+            Closing the generator early (e.g. after the first sample) stops the running Boltz process.
+        """
+        sequences, mc, use_cache = self._prep_request(model_input)
+        key = make_cache_key('predict', sequences, mc)
+        if use_cache:
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                yield {'stage': 'done', 'elapsed': 0.0, 'cached': True, 'stop_reason': None, 'results': cached}
+                return
+
+        with contextlib.closing(iter_boltz_stages(sequences, mc, watch_progress=True)) as events:
+            for event in events:
+                if event['stage'] == 'sample':
+                    event['result'] = self._enforce_out_schema([event['result']])[0]
+                elif event['stage'] == 'done':
+                    event['results'] = self._enforce_out_schema(event['results'])
+                    event['cached'] = False
+                    if use_cache:
+                        self.result_cache.put(key, copy.deepcopy(event['results']))
+                yield event
+
+    def screen(self, model_input: Dict[str,str], ligands: List[str]) -> List[List[Dict[str,Any]]]:
+        """ screens many ligands against one protein specification, reusing the protein msas across ligands
+
+        Served models reach it through predict with the 'ligands' param.
 
+        Args:
+            model_input: A dictionary with an 'input' entry holding only protein chains, in the same format as predict, and optional params.
+            ligands: A list of SMILES strings
 
+        Returns:
+            A list (one entry per ligand) of lists of dictionaries containing the structure and confidence scores, one for each diffusion sample.
+        """
+        params = {k:v for k,v in model_input.items() if k!='input'}
+        sequences = self._normalize_sequences(self._prep_input_sequences(model_input['input']))
+        if set(sequences.keys()) != {'protein'}:
+            raise ValueError("screening input should only contain protein chains")
+
+        mc = self._make_config(params)
+        screen_results = run_boltz_screen(
+            sequences['protein'],
+            ligands,
+            config = mc,
+        )
+        return [self._enforce_out_schema(r) for r in screen_results]
@@ -0,0 +1,234 @@
+""" Streaming Stockholm to A3M conversion
+
+The functions in dbboltz.alphafold.parsers work on the full Stockholm text, and chaining
+deduplicate -> remove empty columns -> convert to a3m holds several copies of the alignment.
+Here the Stockholm file is read once, line by line, and passed through composable stages
+that each work on one alignment block at a time:
+
+    read_stockholm_blocks -> remove_empty_columns -> convert_blocks_to_a3m -> write_a3m
+
+Only the a3m fragments of the kept sequences are held until the end of the file (a sequence
+is spread over every block in an interleaved Stockholm file, so it cannot be written before
+the last block has been read).
+"""
+import hashlib
+import string
+from typing import Dict, IO, Iterable, Iterator, List, Optional, Tuple
+
+# a block is an ordered mapping of sequence name to its aligned segment in that block
+Block = Dict[str, str]
+
+_GAPS = '-.'
+_DELETE_LOWER = str.maketrans('', '', string.ascii_lowercase)
+_DELETE_GAPS = str.maketrans('', '', _GAPS)
+
+
+def read_stockholm_blocks(
+    lines: Iterable[str],
+    descriptions: Optional[Dict[str, str]] = None
+    ) -> Iterator[Block]:
+    """ Yield the alignment blocks of a Stockholm file from an iterable of its lines
+
+    Args:
+        lines: lines of a Stockholm file, e.g. an open file handle
+        descriptions: if given, filled with name -> description from the '#=GS <name> DE' lines as they are read
+
+    Yields:
+        blocks, as dicts of sequence name -> aligned segment, in file order
+    """
+    block = {}
+    for line in lines:
+        if line[:4] == '#=GS':
+            if descriptions is not None:
+                # example format is:
+                # #=GS UniRef90_Q9H5Z4/4-78            DE [subseq from] cDNA: FLJ22755 ...
+                columns = line.split(maxsplit=3)
+                if len(columns) >= 3 and columns[2] == 'DE':
+                    descriptions[columns[1]] = columns[3].rstrip('\n') if len(columns) == 4 else ''
+            continue
+        stripped = line.strip()
+        if not stripped or stripped == '//':
+            # blank lines and the end tag separate blocks
+            if block:
+                yield block
+                block = {}
+            continue
+        if line.startswith('#'):
+            # other markup (#=GR, #=GC, header) carries nothing needed for a3m
+            continue
+        seqname, aligned_seq = stripped.split(maxsplit=1)
+        if seqname in block:
+            # a repeated name means a new block began without a blank separator
+            yield block
+            block = {}
+        block[seqname] = aligned_seq
+    if block:
+        yield block
+
+
+def remove_empty_columns(blocks: Iterable[Block]) -> Iterator[Block]:
+    """ Drop the columns of each block that are gaps ('-') in every row """
+    for block in blocks:
+        rows = iter(block.values())
+        # a column with a residue in the first row is never empty, so only its gap columns are candidates
+        empty = [j for j, res in enumerate(next(rows)) if res == '-']
+        for r in rows:
+            if not empty:
+                break
+            empty = [j for j in empty if r[j] == '-']
+        if not empty:
+            yield block
+            continue
+        empty = set(empty)
+        yield {
+            name: ''.join(res for j, res in enumerate(r) if j not in empty)
+            for name, r in block.items()
+        }
+
+
+def _column_runs(query_segment: str) -> List[Tuple[int, int, bool]]:
+    """ split the query segment into runs of (start, end, is_match) columns """
+    runs = []
+    start = 0
+    for j in range(1, len(query_segment) + 1):
+        if j == len(query_segment) or (query_segment[j] in _GAPS) != (query_segment[start] in _GAPS):
+            runs.append((start, j, query_segment[start] not in _GAPS))
+            start = j
+    return runs
+
+
+def convert_blocks_to_a3m(blocks: Iterable[Block]) -> Iterator[Block]:
+    """ Convert each block's Stockholm segments to a3m fragments
+
+    The first sequence of the first block is the query. Columns where the query has a residue are
+    match states and are kept as is; other columns are insertions, kept as lowercase residues with
+    gaps dropped. A3M conversion is column local, so each block can be converted on its own.
+    """
+    query_name = None
+    for block in blocks:
+        if query_name is None:
+            query_name = next(iter(block))
+        runs = _column_runs(block[query_name])
+        a3m_block = {}
+        for name, segment in block.items():
+            pieces = []
+            for start, end, is_match in runs:
+                piece = segment[start:end]
+                if is_match:
+                    pieces.append(piece.replace('.', '-'))
+                else:
+                    pieces.append(piece.translate(_DELETE_GAPS).lower())
+            a3m_block[name] = ''.join(pieces)
+        yield a3m_block
+
+
+def write_a3m(
+    a3m_blocks: Iterable[Block],
+    out: IO[str],
+    descriptions: Optional[Dict[str, str]] = None,
+    deduplicate: bool = True,
+    max_sequences: Optional[int] = None,
+    ) -> int:
+    """ Assemble a3m fragments into full sequences and write them to out
+
+    Memory is O(kept msa): cap it with max_sequences. When deduplicating, the
+    cap counts unique sequences: rows are held until a prefix of the alignment
+    is known to contain max_sequences unique sequences, and later rows are dropped.
+
+    Args:
+        a3m_blocks: blocks of a3m fragments, e.g. from convert_blocks_to_a3m
+        out: text stream to write the a3m to
+        descriptions: name -> description, written after the name in each header
+        deduplicate: drop sequences whose match states (ignoring insertions wrt the query) were already seen
+        max_sequences: keep only the first max_sequences (unique, if deduplicating) sequences of the alignment
+
+    Returns:
+        number of sequences written
+    """
+    if descriptions is None:
+        descriptions = {}
+    fragments = {}
+    digests = {}
+    # number of leading rows that can still be kept, once known
+    cutoff = None
+    for block in a3m_blocks:
+        for name, fragment in block.items():
+            if name not in fragments:
+                if cutoff is not None:
+                    continue
+                if not deduplicate and max_sequences is not None and len(fragments) >= max_sequences:
+                    continue
+                fragments[name] = []
+                digests[name] = hashlib.blake2b(digest_size=8)
+            fragments[name].append(fragment)
+            if deduplicate:
+                digests[name].update(fragment.translate(_DELETE_LOWER).encode('ascii'))
+
+        if deduplicate and max_sequences is not None and cutoff is None:
+            # a row whose match states so far differ from every earlier row is
+            # unique whatever follows: once max_sequences of those are seen, no
+            # later row can be kept
+            seen = set()
+            for row_index, digest in enumerate(d.digest() for d in digests.values()):
+                seen.add(digest)
+                if len(seen) == max_sequences:
+                    cutoff = row_index + 1
+                    for name in list(fragments)[cutoff:]:
+                        del fragments[name]
+                        del digests[name]
+                    break
+
+    seen = set()
+    n_written = 0
+    for name, pieces in fragments.items():
+        if max_sequences is not None and n_written >= max_sequences:
+            break
+        if deduplicate:
+            digest = digests[name].digest()
+            if digest in seen:
+                continue
+            seen.add(digest)
+        out.write(f">{name} {descriptions.get(name, '')}\n")
+        for piece in pieces:
+            out.write(piece)
+        out.write('\n')
+        n_written += 1
+    return n_written
+
+def stream_stockholm_to_a3m(
+    lines: Iterable[str],
+    out: IO[str],
+    deduplicate: bool = True,
+    remove_empty: bool = True,
+    max_sequences: Optional[int] = None,
+    ) -> int:
+    """ Run the full dedupe/empty column removal/a3m conversion pipeline over Stockholm lines """
+    descriptions = {}
+    blocks = read_stockholm_blocks(lines, descriptions)
+    if remove_empty:
+        blocks = remove_empty_columns(blocks)
+    return write_a3m(
+        convert_blocks_to_a3m(blocks),
+        out,
+        descriptions=descriptions,
+        deduplicate=deduplicate,
+        max_sequences=max_sequences,
+    )
+
+
+def convert_stockholm_file_to_a3m(
+    sto_path: str,
+    a3m_path: str,
+    deduplicate: bool = True,
+    remove_empty: bool = True,
+    max_sequences: Optional[int] = None,
+    ) -> int:
+    """ Read a Stockholm file once and write it out as a3m, returning the number of sequences written """
+    with open(sto_path, 'r') as f_in, open(a3m_path, 'w') as f_out:
+        return stream_stockholm_to_a3m(
+            f_in,
+            f_out,
+            deduplicate=deduplicate,
+            remove_empty=remove_empty,
+            max_sequences=max_sequences,
+        )
@@ -0,0 +1,179 @@
+""" Request level result cache with coalescing of identical in-flight requests
+
+Identical requests (app users clicking twice, pipelines retrying) would otherwise rerun MSA search
+and structure prediction. ResultCache keeps results:
+ - in memory, LRU with a time to live
+ - optionally on disk as json, so results survive restarts and are shared by workers on one host
+and while a result is being computed, identical requests in other threads wait for it instead of
+starting their own computation.
+"""
+import concurrent.futures
+import copy
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(*parts: Any) -> str:
+    """ Hash of json serializable parts, independent of dict key order """
+    content = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """ LRU + TTL memory cache with an optional disk tier and in-flight request coalescing """
+
+    def __init__(
+        self,
+        max_entries: int = 128,
+        ttl: Optional[float] = 24 * 3600,
+        disk_dir: Optional[str] = None,
+        max_disk_entries: int = 1024,
+        ):
+        """
+        Args:
+            max_entries: results kept in memory
+            ttl: seconds a result stays valid (in memory and on disk), None to never expire
+            disk_dir: directory for the disk tier, None to keep results in memory only
+            max_disk_entries: results kept on disk, least recently written are removed first
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        self._memory = OrderedDict()  # key -> (time stored, result)
+        self._in_flight = {}  # key -> Future of the result
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        if self.disk_dir is not None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f'{key}.json')
+
+    def _get_memory(self, key: str):
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        if self._expired(entry[0]):
+            del self._memory[key]
+            return None
+        self._memory.move_to_end(key)
+        return entry
+
+    def _put_memory(self, key: str, result: Any, stored_at: float):
+        self._memory[key] = (stored_at, result)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _get_disk(self, key: str):
+        if self.disk_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            stored_at = os.path.getmtime(path)
+            if self._expired(stored_at):
+                os.remove(path)
+                return None
+            with open(path, 'r') as f:
+                return stored_at, json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _put_disk(self, key: str, result: Any):
+        if self.disk_dir is None:
+            return
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix='.json.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(result, f)
+            os.replace(tmp_path, self._disk_path(key))
+        except (TypeError, ValueError) as e:
+            # results that are not json serializable are only cached in memory
+            logger.warning('Not caching result %s on disk: %s', key, e)
+            os.remove(tmp_path)
+            return
+        entries = sorted(
+            (os.path.getmtime(os.path.join(self.disk_dir, n)), n)
+            for n in os.listdir(self.disk_dir) if n.endswith('.json')
+        )
+        for _, name in entries[:max(0, len(entries) - self.max_disk_entries)]:
+            try:
+                os.remove(os.path.join(self.disk_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: str) -> Optional[Any]:
+        """ A copy of the cached result for key, or None """
+        with self._lock:
+            entry = self._get_memory(key)
+        if entry is None:
+            entry = self._get_disk(key)
+            if entry is not None:
+                with self._lock:
+                    self._put_memory(key, entry[1], entry[0])
+        return None if entry is None else copy.deepcopy(entry[1])
+
+    def put(self, key: str, result: Any):
+        with self._lock:
+            self._put_memory(key, result, time.time())
+        self._put_disk(key, result)
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any]) -> Any:
+        """ Return the cached result for key, or compute it once however many threads ask at the same time
+
+        Errors are not cached: every request waiting on a failed computation gets its exception.
+        """
+        result = self.get(key)
+        if result is not None:
+            with self._lock:
+                self.hits += 1
+            return result
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self._in_flight[key] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return copy.deepcopy(future.result())
+
+        try:
+            result = compute()
+            self.put(key, result)
+            future.set_result(result)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        return copy.deepcopy(result)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'memory_entries': len(self._memory),
+            }
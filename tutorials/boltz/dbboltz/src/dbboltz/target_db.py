@@ -0,0 +1,217 @@
+""" Registry of jackhmmer target databases built from user supplied sequence lists
+
+A request can pass its own library of (name, sequence) tuples to search against. Rather than
+serializing that list to a fresh temporary FASTA on every call, each distinct list is written once,
+keyed by a hash of its content, as a FASTA with a samtools style .fai index next to it. Later
+requests with the same list reuse the file. The least recently used databases are evicted once
+the registry holds more than max_entries databases or max_bytes of FASTA, together with any
+jackhmmer shards made from them. Databases leased by a running search of this process are never
+evicted (use lease() rather than get() around the search).
+
+Databases are published with an atomic rename, so several serving workers can share one root dir.
+"""
+import contextlib
+import glob
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROOT = os.environ.get(
+    'DBBOLTZ_TARGET_DB_DIR',
+    os.path.join(tempfile.gettempdir(), 'dbboltz_target_dbs'),
+)
+DEFAULT_MAX_ENTRIES = 32
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+
+def _clean_name(name: str) -> str:
+    return name[1:] if name.startswith('>') else name
+
+
+def target_db_key(sequences: Sequence[Tuple[str, str]]) -> str:
+    """ Content hash of a sequence list: equal lists (same names, sequences and order) share a key """
+    h = hashlib.blake2b(digest_size=16)
+    for name, seq in sequences:
+        h.update(_clean_name(name).encode('utf-8'))
+        h.update(b'\0')
+        h.update(seq.encode('ascii'))
+        h.update(b'\n')
+    return h.hexdigest()
+
+
+def read_fasta_index(fai_path: str) -> Dict[str, Tuple[int, int]]:
+    """ Read a .fai index into name -> (sequence length, byte offset of the sequence) """
+    index = {}
+    with open(fai_path, 'r') as f:
+        for line in f:
+            name, length, offset, _, _ = line.rstrip('\n').split('\t')
+            index[name] = (int(length), int(offset))
+    return index
+
+
+def fetch_sequence(fasta_path: str, name: str, index: Optional[Dict[str, Tuple[int, int]]] = None) -> str:
+    """ Read a single sequence from an indexed FASTA without scanning the file """
+    if index is None:
+        index = read_fasta_index(fasta_path + '.fai')
+    length, offset = index[name]
+    with open(fasta_path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length).decode('ascii')
+
+
+class TargetDatabaseRegistry:
+    """ Materializes sequence lists as indexed FASTA files on local disk and reuses them across requests """
+
+    def __init__(
+        self,
+        root: str = DEFAULT_ROOT,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        ):
+        """
+        Args:
+            root: directory the databases are written to
+            max_entries: maximum number of databases kept
+            max_bytes: maximum total size of the kept FASTA files
+        """
+        self.root = root
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # path -> number of searches using the database, guarded by _lock
+        self._leases: Dict[str, int] = {}
+        os.makedirs(self.root, exist_ok=True)
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.root, f'{key}.fasta')
+
+    def _write(self, sequences: Sequence[Tuple[str, str]], path: str):
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.fasta.tmp')
+        index_lines = []
+        offset = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for name, seq in sequences:
+                    header = f'>{_clean_name(name)}\n'.encode('utf-8')
+                    seq_bytes = seq.encode('ascii')
+                    offset += len(header)
+                    index_lines.append(
+                        f'{_clean_name(name)}\t{len(seq_bytes)}\t{offset}\t{len(seq_bytes)}\t{len(seq_bytes) + 1}\n'
+                    )
+                    f.write(header)
+                    f.write(seq_bytes)
+                    f.write(b'\n')
+                    offset += len(seq_bytes) + 1
+            with open(tmp_path + '.fai', 'w') as f:
+                f.writelines(index_lines)
+            # index first, so a published fasta always has its index
+            os.replace(tmp_path + '.fai', path + '.fai')
+            os.replace(tmp_path, path)
+        except BaseException:
+            for p in (tmp_path, tmp_path + '.fai'):
+                if os.path.exists(p):
+                    os.remove(p)
+            raise
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        for file_name in os.listdir(self.root):
+            if not file_name.endswith('.fasta'):
+                continue
+            path = os.path.join(self.root, file_name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+        return entries
+
+    def evict(self, keep: Optional[str] = None):
+        """ Remove least recently used databases until the registry is within its limits
+
+        Databases with an active lease are skipped.
+
+        Args:
+            keep: path of a database that must not be evicted (e.g. the one just requested)
+        """
+        entries = sorted(self._entries())
+        total_bytes = sum(size for _, size, _ in entries)
+        n_entries = len(entries)
+        for _, size, path in entries:
+            if n_entries <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            if path == keep or self._leases.get(path):
+                continue
+            # the index and any jackhmmer shards of the database share its file name as prefix
+            for p in [path] + glob.glob(glob.escape(path) + '.*'):
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    pass
+            logger.info('Evicted target database %s', path)
+            n_entries -= 1
+            total_bytes -= size
+
+    def get(self, sequences: Sequence[Tuple[str, str]]) -> str:
+        """ Path of the indexed FASTA holding sequences, writing it only if it is not in the registry yet
+
+        Args:
+            sequences: (name, sequence) tuples, names with or without a leading '>'
+
+        Returns:
+            path to the FASTA file (its index is at path + '.fai')
+        """
+        with self._lock:
+            return self._get_locked(sequences)
+
+    def _get_locked(self, sequences: Sequence[Tuple[str, str]]) -> str:
+        key = target_db_key(sequences)
+        path = self.path_for(key)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stat = None
+        if stat is not None:
+            # atime records the last use for LRU eviction; mtime is left alone since
+            # jackhmmer shard manifests are keyed on it
+            os.utime(path, (time.time(), stat.st_mtime))
+            return path
+        logger.info('Writing target database %s with %d sequences', path, len(sequences))
+        self._write(sequences, path)
+        self.evict(keep=path)
+        return path
+
+    @contextlib.contextmanager
+    def lease(self, sequences: Sequence[Tuple[str, str]]) -> Iterator[str]:
+        """ Like get, but the database is not evicted until the with block exits
+
+        Usage:
+            with registry.lease(sequences) as path:
+                ... search path ...
+        """
+        with self._lock:
+            path = self._get_locked(sequences)
+            self._leases[path] = self._leases.get(path, 0) + 1
+        try:
+            yield path
+        finally:
+            with self._lock:
+                self._leases[path] -= 1
+                if not self._leases[path]:
+                    del self._leases[path]
+
+
+_DEFAULT_REGISTRY = None
+
+
+def get_default_registry() -> TargetDatabaseRegistry:
+    global _DEFAULT_REGISTRY
+    if _DEFAULT_REGISTRY is None:
+        _DEFAULT_REGISTRY = TargetDatabaseRegistry()
+    return _DEFAULT_REGISTRY
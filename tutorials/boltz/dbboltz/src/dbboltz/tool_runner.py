@@ -0,0 +1,170 @@
+""" Async execution of MSA tool binaries (jackhmmer, hhblits, hmmsearch, ...)
+
+A search run with subprocess.Popen(...).communicate() blocks the calling serving worker until the
+binary exits, however long that takes. ToolRunner runs the binary as an asyncio subprocess instead:
+ - a per call timeout kills the binary and raises ToolTimeoutError
+ - cancelling the awaiting task (e.g. when the client disconnects) kills the binary
+ - a per process limit bounds how many tool processes run at once, across runners and event loops
+   (each serving worker process has its own limit)
+ - stderr is streamed line by line into events of an mlflow span while the tool runs
+"""
+import asyncio
+import dataclasses
+import logging
+import threading
+import time
+from typing import List, Optional, Sequence
+
+import mlflow
+from mlflow.entities import SpanEvent
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONCURRENT_TOOLS = 4
+
+# one semaphore per process: the runners and event loops of a serving worker share it, separate
+# worker processes do not
+_HOST_SLOTS = threading.BoundedSemaphore(DEFAULT_MAX_CONCURRENT_TOOLS)
+_HOST_SLOTS_LOCK = threading.Lock()
+_HOST_SLOTS_USED = False
+
+
+def set_max_concurrent_tools(max_concurrent: int):
+    """ Set the per process limit on concurrently running tool processes, only at startup
+
+    Raises:
+        RuntimeError: a tool has already been run with the current limit
+    """
+    global _HOST_SLOTS
+    with _HOST_SLOTS_LOCK:
+        if _HOST_SLOTS_USED:
+            raise RuntimeError('set_max_concurrent_tools must be called before any tool is run')
+        _HOST_SLOTS = threading.BoundedSemaphore(max_concurrent)
+
+
+class ToolTimeoutError(RuntimeError):
+    pass
+
+
+@dataclasses.dataclass
+class ToolResult:
+    returncode: int
+    stdout: bytes
+    stderr: bytes
+    duration: float
+
+
+async def _acquire_host_slot(poll_interval: float = 0.05) -> threading.BoundedSemaphore:
+    # polling (rather than a blocking acquire in a thread) keeps waiting cancellable and loop independent
+    global _HOST_SLOTS_USED
+    with _HOST_SLOTS_LOCK:
+        # the limit is frozen from here on, so every caller releases the semaphore it acquired
+        _HOST_SLOTS_USED = True
+        slots = _HOST_SLOTS
+    while not slots.acquire(blocking=False):
+        await asyncio.sleep(poll_interval)
+    return slots
+
+
+async def _kill(process: asyncio.subprocess.Process):
+    if process.returncode is None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+
+class ToolRunner:
+    """ Runs tool binaries as asyncio subprocesses with timeouts, cancellation and stderr streaming """
+
+    def __init__(self, timeout: Optional[float] = None, capture_stdout: bool = False):
+        """
+        Args:
+            timeout: default timeout in seconds for each call, None for no timeout
+            capture_stdout: keep stdout of the tool (otherwise it is discarded)
+        """
+        self.timeout = timeout
+        self.capture_stdout = capture_stdout
+
+    async def _stream_stderr(self, stream: asyncio.StreamReader, span, lines: List[bytes]):
+        async for line in stream:
+            lines.append(line)
+            if span is not None:
+                span.add_event(SpanEvent(
+                    name='stderr',
+                    attributes={'line': line.decode('utf-8', errors='replace').rstrip('\n')}
+                ))
+
+    async def run(
+        self,
+        cmd: Sequence[str],
+        timeout: Optional[float] = None,
+        span_name: Optional[str] = None,
+        ) -> ToolResult:
+        """ Run cmd and wait for it to finish
+
+        Args:
+            cmd: the command, binary first
+            timeout: timeout in seconds for this call, defaults to the runner timeout
+            span_name: name of the mlflow span that records the call and its stderr lines
+
+        Returns:
+            ToolResult with the return code, stdout (if captured) and stderr of the tool
+
+        Raises:
+            ToolTimeoutError: the tool did not finish within the timeout (it has been killed)
+            asyncio.CancelledError: the awaiting task was cancelled (the tool has been killed)
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if span_name is None:
+            span_name = cmd[0].split('/')[-1]
+
+        with mlflow.start_span(span_name, span_type='TOOL') as span:
+            span.set_inputs({'cmd': list(cmd), 'timeout': timeout})
+            slots = await _acquire_host_slot()
+            try:
+                logger.info('Launching subprocess "%s"', ' '.join(cmd))
+                tic = time.time()
+                process = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdout=asyncio.subprocess.PIPE if self.capture_stdout else asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+                stderr_lines = []
+                stdout_task = asyncio.ensure_future(
+                    process.stdout.read() if self.capture_stdout else asyncio.sleep(0, result=b'')
+                )
+                stderr_task = asyncio.ensure_future(
+                    self._stream_stderr(process.stderr, span, stderr_lines)
+                )
+                try:
+                    await asyncio.wait_for(
+                        asyncio.gather(stdout_task, stderr_task, process.wait()),
+                        timeout=timeout,
+                    )
+                except asyncio.TimeoutError:
+                    await _kill(process)
+                    span.set_outputs({'timeout': True})
+                    raise ToolTimeoutError(
+                        f'{span_name} did not finish within {timeout} seconds and was killed'
+                    )
+                except asyncio.CancelledError:
+                    await _kill(process)
+                    raise
+            finally:
+                slots.release()
+
+            result = ToolResult(
+                returncode=process.returncode,
+                stdout=stdout_task.result(),
+                stderr=b''.join(stderr_lines),
+                duration=time.time() - tic,
+            )
+            span.set_outputs({'returncode': result.returncode, 'duration': result.duration})
+        return result
+
+    def run_sync(self, cmd: Sequence[str], timeout: Optional[float] = None, span_name: Optional[str] = None) -> ToolResult:
+        """ run() for callers without an event loop """
+        return asyncio.run(self.run(cmd, timeout=timeout, span_name=span_name))
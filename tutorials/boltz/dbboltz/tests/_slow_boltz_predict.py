@@ -0,0 +1,13 @@
+""" Stand-in for boltz_predict in a worker process: records its pid, marks featurization done and keeps running """
+import os
+import time
+
+
+def run(in_list):
+    pid_path, manifest_path = in_list
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path, 'w') as f:
+        f.write('{}')
+    with open(pid_path, 'w') as f:
+        f.write(str(os.getpid()))
+    time.sleep(600)
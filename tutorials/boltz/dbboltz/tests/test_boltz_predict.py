@@ -0,0 +1,84 @@
+""" Boltz pyfunc request routing, with the Boltz run itself replaced """
+import os
+
+import pytest
+
+pytest.importorskip('boltz')
+pytest.importorskip('rdkit')
+
+from dbboltz import boltz
+
+import _slow_boltz_predict
+
+
+def _model():
+    model = boltz.Boltz()
+    model.artifacts = {'CACHE_DIR': None}
+    model.model_config = {}
+    model.result_cache = boltz.ResultCache()
+    return model
+
+
+def test_predict_with_ligands_screens(monkeypatch):
+    calls = []
+
+    def fake_screen(protein_sequences, ligands, config):
+        calls.append((protein_sequences, ligands))
+        return [[{'smiles': smiles}] for smiles in ligands]
+
+    monkeypatch.setattr(boltz, 'run_boltz_screen', fake_screen)
+    monkeypatch.setattr(boltz.Boltz, '_enforce_out_schema', lambda self, results: results)
+
+    results = _model().predict(None, [{'input': 'protein_A:MKTAYIAKQR'}], params={'ligands': ['CCO', 'C1CCCCC1']})
+
+    assert calls == [([(('A',), 'MKTAYIAKQR')], ['CCO', 'C1CCCCC1'])]
+    assert [r['ligand'] for r in results] == ['CCO', 'C1CCCCC1']
+    assert [r['smiles'] for r in results] == ['CCO', 'C1CCCCC1']
+
+
+def test_predict_with_ligands_rejects_non_protein_input():
+    with pytest.raises(ValueError):
+        _model().predict(None, [{'input': 'protein_A:MKTAYIAKQR;ligand_B:CCO'}], params={'ligands': ['CCO']})
+
+
+def test_closing_predict_stream_stops_boltz(monkeypatch, tmp_path):
+    pid_path = str(tmp_path / 'pid')
+
+    def fake_inputs(config, boltz_yaml_file_path, tmp_file_path, **kwargs):
+        yaml_name = boltz_yaml_file_path.split(os.sep)[-1].split('.')[0]
+        manifest = os.path.join(tmp_file_path, f"boltz_results_{yaml_name}", "processed", "manifest.json")
+        return [pid_path, manifest]
+
+    monkeypatch.setattr(boltz, 'get_protein_msas', lambda protein_sequences, config: [])
+    monkeypatch.setattr(boltz, 'process_boltz_inputs', fake_inputs)
+    monkeypatch.setattr(boltz, '_boltz_predict_process', _slow_boltz_predict.run)
+
+    stream = _model().predict_stream(
+        None, [{'input': 'protein_A:MKTAYIAKQR', 'msa': 'mmseqs', 'use_cache': 'False'}]
+    )
+    assert next(stream)['stage'] == 'msa'
+    assert next(stream)['stage'] == 'featurization'
+    stream.close()
+
+    with open(pid_path) as f:
+        pid = int(f.read())
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
+
+
+def test_predict_normalizes_sequences_for_cache_and_run(monkeypatch):
+    runs = []
+
+    def fake_run_boltz(sequences, config):
+        runs.append(sequences)
+        return [{'sample': len(runs)}]
+
+    monkeypatch.setattr(boltz, 'run_boltz', fake_run_boltz)
+    monkeypatch.setattr(boltz.Boltz, '_enforce_out_schema', lambda self, results: results)
+    model = _model()
+
+    first = model.predict(None, [{'input': 'protein_A: MKTAYIAKQR \n'}])
+    second = model.predict(None, [{'input': 'protein_A:MKTAYIAKQR'}])
+
+    assert runs == [{'protein': [(('A',), 'MKTAYIAKQR')]}]
+    assert first == second
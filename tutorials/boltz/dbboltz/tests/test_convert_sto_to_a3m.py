@@ -0,0 +1,60 @@
+""" Stockholm -> a3m conversion used by the jackhmmer MSA path """
+import io
+
+import pytest
+
+from dbboltz.alphafold import parsers
+from dbboltz.msa_stream import stream_stockholm_to_a3m
+
+STOCKHOLM = """# STOCKHOLM 1.0
+
+#=GS query/1-10 DE query sequence
+#=GS hit1/3-12  DE first hit
+#=GS hit2/3-12  DE duplicate of the first hit
+#=GS hit3/1-8   DE second hit
+
+query/1-10        MKT-AYIAKQ
+hit1/3-12         MKTGAYIVKQ
+hit2/3-12         MKTgAYIVKQ
+hit3/1-8          MR--AY-AK-
+#=GC RF           xxx.xxxxxx
+
+query/1-10        RQ
+hit1/3-12         RQ
+hit2/3-12         RQ
+hit3/1-8          R-
+#=GC RF           xx
+//
+"""
+
+
+def test_deduplicate_stockholm_msa_str():
+    deduplicated = parsers.deduplicate_stockholm_msa(STOCKHOLM)
+    names = [line.split()[0] for line in deduplicated.splitlines() if line and not line.startswith(('#', '//'))]
+    assert 'hit2/3-12' not in names
+    assert names[:3] == ['query/1-10', 'hit1/3-12', 'hit3/1-8']
+
+
+def test_convert_sto_to_a3m_from_string():
+    pytest.importorskip('boltz')
+    pytest.importorskip('rdkit')
+    from dbboltz.boltz import convert_sto_to_a3m
+
+    a3m = convert_sto_to_a3m(sto_str=STOCKHOLM)
+    headers = [line for line in a3m.splitlines() if line.startswith('>')]
+    assert [h.split()[0] for h in headers] == ['>query/1-10', '>hit1/3-12', '>hit3/1-8']
+
+    streamed = io.StringIO()
+    stream_stockholm_to_a3m(io.StringIO(STOCKHOLM), streamed)
+    assert [l for l in a3m.splitlines() if not l.startswith('>')] == \
+        [l for l in streamed.getvalue().splitlines() if not l.startswith('>')]
+
+
+@pytest.mark.parametrize('max_sequences', [1, 2, 3, 4])
+def test_stream_max_sequences_counts_unique_sequences(max_sequences):
+    # hit2 duplicates hit1 in the first rows: the cap counts the kept rows
+    streamed = io.StringIO()
+    n_written = stream_stockholm_to_a3m(io.StringIO(STOCKHOLM), streamed, max_sequences=max_sequences)
+    names = [line.split()[0] for line in streamed.getvalue().splitlines() if line.startswith('>')]
+    assert names == ['>query/1-10', '>hit1/3-12', '>hit3/1-8'][:max_sequences]
+    assert n_written == len(names)
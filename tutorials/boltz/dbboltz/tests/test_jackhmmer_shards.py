@@ -0,0 +1,107 @@
+""" Sharding of FASTA databases for the sharded jackhmmer search """
+import os
+from concurrent import futures
+
+import pytest
+
+# jackhmmer runs tools through dbboltz.tool_runner, which traces with mlflow
+pytest.importorskip('mlflow')
+
+from dbboltz.alphafold import jackhmmer
+
+
+def _write_fasta(path, n):
+    with open(path, 'w') as f:
+        for i in range(n):
+            f.write(f'>seq{i}\nMKTAYIAKQR{"A" * i}\n')
+    with open(path) as f:
+        return f.read()
+
+
+def _read_shards(manifest):
+    text = ''
+    for p in manifest['shards']:
+        with open(p) as f:
+            text += f.read()
+    return text
+
+
+def test_shards_cover_the_database(tmp_path):
+    db = str(tmp_path / 'db' / 'targets.fasta')
+    os.makedirs(os.path.dirname(db))
+    content = _write_fasta(db, 20)
+    shard_dir = str(tmp_path / 'shards')
+
+    manifest = jackhmmer.shard_fasta_database(db, 4, shard_dir)
+
+    assert manifest['num_sequences'] == 20
+    assert len(manifest['shards']) == 4
+    assert all(os.path.dirname(p) == shard_dir for p in manifest['shards'])
+    assert _read_shards(manifest) == content
+    # nothing is written next to the database
+    assert os.listdir(os.path.dirname(db)) == ['targets.fasta']
+    # a second call reuses the shards
+    assert jackhmmer.shard_fasta_database(db, 4, shard_dir) == manifest
+
+
+def test_fewer_sequences_than_shards(tmp_path):
+    db = str(tmp_path / 'targets.fasta')
+    content = _write_fasta(db, 3)
+
+    manifest = jackhmmer.shard_fasta_database(db, 8, str(tmp_path / 'shards'))
+
+    assert len(manifest['shards']) == 3
+    assert all(os.path.getsize(p) > 0 for p in manifest['shards'])
+    assert _read_shards(manifest) == content
+
+
+def test_concurrent_sharding(tmp_path):
+    db = str(tmp_path / 'targets.fasta')
+    content = _write_fasta(db, 50)
+    shard_dir = str(tmp_path / 'shards')
+
+    with futures.ThreadPoolExecutor(8) as executor:
+        manifests = list(executor.map(lambda _: jackhmmer.shard_fasta_database(db, 5, shard_dir), range(8)))
+
+    assert all(m == manifests[0] for m in manifests)
+    assert _read_shards(manifests[0]) == content
+    assert not [n for n in os.listdir(shard_dir) if n.endswith('.tmp')]
+
+
+FAKE_JACKHMMER = """#!/usr/bin/env python
+# reports every record of the database as a hit, with E-value 1e-<record number>
+import sys
+args = sys.argv[1:]
+query, database = args[-2], args[-1]
+query_seq = open(query).read().split('\\n')[1]
+names = [l[1:].split()[0] for l in open(database) if l.startswith('>')]
+rows = ['query ' + query_seq] + [n + ' ' + query_seq for n in names]
+with open(args[args.index('-A') + 1], 'w') as f:
+    f.write('# STOCKHOLM 1.0\\n\\n' + '\\n'.join(rows) + '\\n#=GC RF ' + 'x' * len(query_seq) + '\\n//\\n')
+if '--tblout' in args:
+    with open(args[args.index('--tblout') + 1], 'w') as f:
+        for n in names:
+            f.write(n + ' - query - 1e-' + n[3:] + ' 1 1\\n')
+"""
+
+
+def test_sharded_async_search_matches_sync(tmp_path):
+    import asyncio
+    import stat
+
+    binary = tmp_path / 'jackhmmer'
+    binary.write_text(FAKE_JACKHMMER)
+    binary.chmod(binary.stat().st_mode | stat.S_IEXEC)
+    db = str(tmp_path / 'targets.fasta')
+    _write_fasta(db, 12)
+    query = tmp_path / 'query.fasta'
+    query.write_text('>query\nMKTAYIAKQR\n')
+
+    runner = jackhmmer.Jackhmmer(
+        binary_path=str(binary), database_path=db, num_shards=3, shard_dir=str(tmp_path / 'shards'))
+    sync = runner.query_multiple([str(query)], max_sequences=5)
+    async_ = asyncio.run(runner.query_batch_async([str(query)], max_sequences=5, timeout=30))
+
+    assert async_[0][0]['sto'] == sync[0][0]['sto']
+    # the best hits across the shards are kept
+    assert 'seq11 ' in sync[0][0]['sto'] and 'seq0 ' not in sync[0][0]['sto']
@@ -0,0 +1,199 @@
+""" Vectorized and streaming Stockholm/a3m parsers, checked against the plain Python parsers """
+import io
+import random
+
+import pytest
+
+from dbboltz.alphafold import parsers
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def make_stockholm(num_seqs, length, width=60, seed=0, duplicates=0):
+    """ An interleaved Stockholm MSA as jackhmmer writes it; the query has gap columns (insertions) """
+    rnd = random.Random(seed)
+    names = ['query'] + [f'hit{i}/{i + 1}-{i + 40}' for i in range(num_seqs - 1)]
+    query = ''.join(rnd.choice(AMINO_ACIDS + '--') for _ in range(length))
+    seqs = {'query': query}
+    for name in names[1:]:
+        seqs[name] = ''.join(
+            rnd.choice(AMINO_ACIDS + '-') if q != '-' else rnd.choice(AMINO_ACIDS.lower() + '----')
+            for q in query
+        )
+    # copies of earlier hits, differing only in the columns that are gaps in the query
+    for i in range(duplicates):
+        source = seqs[names[1 + i]]
+        seqs[names[-1 - i]] = ''.join(
+            c if q != '-' else rnd.choice(AMINO_ACIDS.lower() + '-') for c, q in zip(source, query)
+        )
+    pad = max(map(len, names)) + 2
+    lines = ['# STOCKHOLM 1.0\n', '#=GF ID query-i1\n', '\n']
+    lines += [f'#=GS {name:<{pad}} DE description of {name}\n' for name in names[1:]]
+    lines.append('\n')
+    for start in range(0, length, width):
+        for name in names:
+            segment = seqs[name][start:start + width]
+            lines.append(f'{name:<{pad}}{segment}\n')
+            lines.append(f'#=GR {name:<{pad - 5}} PP {"*" * len(segment)}\n')
+        lines.append(f'#=GC {"RF":<{pad - 5}} {"x" * len(segment)}\n')
+        lines.append('\n' if start + width < length else '//\n')
+    return ''.join(lines)
+
+
+def to_a3m(stockholm):
+    return parsers.convert_stockholm_to_a3m(stockholm)
+
+
+def assert_same_msa(array_msa, msa):
+    assert array_msa.sequences == list(msa.sequences)
+    assert array_msa.deletion_matrix.tolist() == [list(row) for row in msa.deletion_matrix]
+    assert list(array_msa.descriptions) == list(msa.descriptions)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_parse_stockholm_array(seed):
+    stockholm = make_stockholm(30, 150, seed=seed)
+    assert_same_msa(parsers.parse_stockholm_array(stockholm), parsers.parse_stockholm(stockholm))
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_parse_a3m_array(seed):
+    a3m = to_a3m(make_stockholm(30, 150, seed=seed))
+    assert_same_msa(parsers.parse_a3m_array(a3m), parsers.parse_a3m(a3m))
+
+
+def test_parse_a3m_array_drops_trailing_insertions():
+    a3m = '>query\nMKT\n>hit1 a hit\nMkKTaa\n'
+    array_msa = parsers.parse_a3m_array(a3m)
+    assert_same_msa(array_msa, parsers.parse_a3m(a3m))
+    assert array_msa.deletion_matrix.tolist() == [[0, 0, 0], [0, 1, 0]]
+
+
+def test_array_msa_truncate_and_to_msa():
+    stockholm = make_stockholm(10, 40)
+    array_msa = parsers.parse_stockholm_array(stockholm).truncate(4)
+    msa = parsers.parse_stockholm(stockholm).truncate(4)
+    assert len(array_msa) == 4
+    assert array_msa.to_msa() == parsers.Msa(
+        sequences=list(msa.sequences),
+        deletion_matrix=[list(row) for row in msa.deletion_matrix],
+        descriptions=list(msa.descriptions),
+    )
+
+
+def test_parse_array_empty_and_ragged():
+    assert len(parsers.parse_stockholm_array('# STOCKHOLM 1.0\n//\n')) == 0
+    assert len(parsers.parse_a3m_array('')) == 0
+    with pytest.raises(ValueError):
+        parsers.parse_a3m_array('>query\nMKT\n>hit\nMK\n')
+    with pytest.raises(ValueError):
+        parsers.parse_stockholm_array('query MKT\nhit MK\n')
+
+
+def _legacy_keep_line(line, seqnames):
+    # parsers._keep_line before the streaming rewrite
+    if not line.strip() or line.strip() == '//' or line.startswith(('# STOCKHOLM', '#=GC RF')):
+        return True
+    if line[:4] == '#=GS':
+        return line.split(maxsplit=2)[1] in seqnames
+    if line.startswith('#'):
+        return False
+    return line.partition(' ')[0] in seqnames
+
+
+def _legacy_truncate(path, max_sequences):
+    seqnames = set()
+    with open(path) as f:
+        for line in f:
+            if line.strip() and not line.startswith(('#', '//')):
+                seqnames.add(line.partition(' ')[0])
+                if len(seqnames) >= max_sequences:
+                    break
+        f.seek(0)
+        return ''.join(line for line in f if _legacy_keep_line(line, seqnames))
+
+
+def _legacy_unique_names(stockholm):
+    # the names deduplicate_stockholm_msa kept before hashing, in order
+    sequences = {}
+    for line in stockholm.splitlines():
+        if line.strip() and not line.startswith(('#', '//')):
+            name, alignment = line.split()
+            sequences[name] = sequences.get(name, '') + alignment
+    query = next(iter(sequences.values()))
+    seen, names = set(), []
+    for name, alignment in sequences.items():
+        masked = ''.join(c for c, q in zip(alignment, query) if q != '-')
+        if masked not in seen:
+            seen.add(masked)
+            names.append(name)
+    return names
+
+
+@pytest.mark.parametrize('max_sequences', [1, 2, 7, 25, 40])
+@pytest.mark.parametrize('width', [50, 300])
+def test_truncate_stockholm_msa_matches_legacy(tmp_path, max_sequences, width):
+    path = tmp_path / 'msa.sto'
+    path.write_text(make_stockholm(25, 200, width=width))
+    assert parsers.truncate_stockholm_msa(str(path), max_sequences) == _legacy_truncate(str(path), max_sequences)
+
+
+def test_truncate_stockholm_msa_to_stream_counts(tmp_path):
+    path = tmp_path / 'msa.sto'
+    path.write_text(make_stockholm(25, 200))
+    out = io.BytesIO()
+    assert parsers.truncate_stockholm_msa_to_stream(str(path), 10, out) == 10
+    assert out.getvalue().decode() == _legacy_truncate(str(path), 10)
+
+
+def test_deduplicate_stockholm_msa_matches_legacy():
+    stockholm = make_stockholm(30, 150, duplicates=5)
+    names = _legacy_unique_names(stockholm)
+    assert len(names) == 25
+    expected = '\n'.join(l for l in stockholm.splitlines() if _legacy_keep_line(l, set(names))) + '\n'
+    assert parsers.deduplicate_stockholm_msa(stockholm) == expected
+
+
+@pytest.mark.parametrize('max_sequences', [1, 5, 24, 25, 100])
+def test_deduplicate_stockholm_msa_max_sequences(max_sequences):
+    # deduplicating with max_sequences equals deduplicating and then keeping the first max_sequences
+    stockholm = make_stockholm(30, 150, duplicates=5)
+    names = set(_legacy_unique_names(stockholm)[:max_sequences])
+    expected = '\n'.join(l for l in stockholm.splitlines() if _legacy_keep_line(l, names)) + '\n'
+    assert parsers.deduplicate_stockholm_msa(stockholm, max_sequences=max_sequences) == expected
+
+
+def _legacy_remove_empty_columns(stockholm):
+    """ remove_empty_columns_from_stockholm_msa before it was vectorized, for well-formed input """
+    processed = {}
+    unprocessed = {}
+    for i, line in enumerate(stockholm.splitlines()):
+        if line.startswith('#=GC RF'):
+            unprocessed[i] = line
+            columns = [line.rpartition(' ')[2] for line in unprocessed.values()]
+            mask = [any(c[j] != '-' for c in columns[:-1]) for j in range(len(columns[-1]))]
+            for j, row in unprocessed.items():
+                prefix, _, alignment = row.rpartition(' ')
+                masked = ''.join(c for c, keep in zip(alignment, mask) if keep)
+                processed[j] = f'{prefix} {masked}' if any(mask) else ''
+            unprocessed = {}
+        elif line.strip() and not line.startswith(('#', '//')):
+            unprocessed[i] = line
+        else:
+            processed[i] = line
+    return '\n'.join(processed[i] for i in range(len(processed)))
+
+
+def test_remove_empty_columns_matches_legacy():
+    stockholm = make_stockholm(20, 150, width=50, seed=3)
+    assert parsers.remove_empty_columns_from_stockholm_msa(stockholm) == _legacy_remove_empty_columns(stockholm)
+
+
+@pytest.mark.parametrize('block', [0, 1, 2])
+def test_remove_empty_columns_requires_reference_annotation(block):
+    # drop the '#=GC RF' line of one block: its rows must not pass through unfiltered
+    lines = make_stockholm(5, 150, width=50).splitlines(keepends=True)
+    rf_lines = [i for i, line in enumerate(lines) if line.startswith('#=GC RF')]
+    del lines[rf_lines[block]]
+    with pytest.raises(ValueError, match='#=GC RF'):
+        parsers.remove_empty_columns_from_stockholm_msa(''.join(lines))
@@ -0,0 +1,133 @@
+""" Request level result cache: LRU, time to live, disk tier and coalescing of in-flight requests """
+import os
+import threading
+import time
+from concurrent import futures
+
+import pytest
+
+from dbboltz import result_cache
+from dbboltz.result_cache import ResultCache, make_cache_key
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(result_cache.time, 'time', clock)
+    return clock
+
+
+def test_make_cache_key_ignores_dict_order():
+    assert make_cache_key('predict', {'a': 1, 'b': [1, 2]}) == make_cache_key('predict', {'b': [1, 2], 'a': 1})
+    assert make_cache_key('predict', {'a': 1}) != make_cache_key('predict', {'a': 2})
+
+
+def test_lru_eviction():
+    cache = ResultCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1  # a is now the most recently used
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats()['memory_entries'] == 2
+
+
+def test_get_returns_copies():
+    cache = ResultCache()
+    cache.put('a', {'pdb': 'x'})
+    cache.get('a')['pdb'] = 'changed'
+    assert cache.get('a') == {'pdb': 'x'}
+
+
+def test_ttl(clock):
+    cache = ResultCache(ttl=10)
+    cache.put('a', 1)
+    clock.now += 9
+    assert cache.get('a') == 1
+    clock.now += 2
+    assert cache.get('a') is None
+    assert cache.stats()['memory_entries'] == 0
+
+
+def test_disk_tier(tmp_path):
+    disk_dir = str(tmp_path / 'cache')
+    ResultCache(disk_dir=disk_dir).put('a', {'score': 0.5})
+    # a new cache (another worker, or after a restart) reads the result from disk
+    other = ResultCache(disk_dir=disk_dir)
+    assert other.get('a') == {'score': 0.5}
+    assert other.stats()['memory_entries'] == 1
+
+
+def test_disk_tier_is_bounded(tmp_path):
+    disk_dir = str(tmp_path / 'cache')
+    cache = ResultCache(disk_dir=disk_dir, max_disk_entries=3)
+    for i in range(5):
+        cache.put(f'key{i}', i)
+        # distinct mtimes, so the oldest files are removed first
+        os.utime(os.path.join(disk_dir, f'key{i}.json'), (i, i))
+    assert sorted(os.listdir(disk_dir)) == ['key2.json', 'key3.json', 'key4.json']
+
+
+def test_disk_tier_expires(tmp_path, clock):
+    disk_dir = str(tmp_path / 'cache')
+    ResultCache(ttl=10, disk_dir=disk_dir).put('a', 1)
+    path = os.path.join(disk_dir, 'a.json')
+    os.utime(path, (clock.now - 20, clock.now - 20))
+    assert ResultCache(ttl=10, disk_dir=disk_dir).get('a') is None
+    assert not os.path.exists(path)
+
+
+def test_unserializable_results_stay_in_memory(tmp_path):
+    disk_dir = str(tmp_path / 'cache')
+    cache = ResultCache(disk_dir=disk_dir)
+    cache.put('a', {'value': object()})
+    assert cache.get('a') is not None
+    assert os.listdir(disk_dir) == []
+
+
+def test_get_or_compute_coalesces_in_flight_requests():
+    cache = ResultCache()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {'pdb': 'x'}
+
+    with futures.ThreadPoolExecutor(4) as pool:
+        leader = pool.submit(cache.get_or_compute, 'a', compute)
+        assert started.wait(5)
+        followers = [pool.submit(cache.get_or_compute, 'a', compute) for _ in range(3)]
+        # the followers wait on the leader's computation
+        while cache.stats()['coalesced'] < 3:
+            time.sleep(0.01)
+        release.set()
+        results = [leader.result()] + [f.result() for f in followers]
+
+    assert calls == [1]
+    assert results == [{'pdb': 'x'}] * 4
+    assert cache.get_or_compute('a', compute) == {'pdb': 'x'}
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'coalesced': 3, 'memory_entries': 1}
+
+
+def test_get_or_compute_does_not_cache_errors():
+    cache = ResultCache()
+
+    def fail():
+        raise RuntimeError('boom')
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_compute('a', fail)
+    assert cache.get_or_compute('a', lambda: 1) == 1
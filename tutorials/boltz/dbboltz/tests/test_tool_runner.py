@@ -0,0 +1,77 @@
+""" Async tool runner: timeouts and cancellation kill the tool, stderr is captured """
+import asyncio
+import os
+import time
+
+import pytest
+
+pytest.importorskip('mlflow')
+
+from dbboltz import tool_runner
+from dbboltz.tool_runner import ToolRunner, ToolTimeoutError
+
+
+def _sleeper(pid_path, seconds=30):
+    # exec, so the recorded pid is the one of the sleeping tool
+    return ['sh', '-c', f'echo $$ > {pid_path}; exec sleep {seconds}']
+
+
+def _assert_killed(pid_path):
+    with open(pid_path) as f:
+        pid = int(f.read())
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
+
+
+async def _wait_for_file(path):
+    while not os.path.exists(path) or not os.path.getsize(path):
+        await asyncio.sleep(0.01)
+
+
+def test_run_captures_output():
+    result = ToolRunner(capture_stdout=True).run_sync(['sh', '-c', 'echo out; echo err >&2; exit 3'])
+    assert result.returncode == 3
+    assert result.stdout == b'out\n'
+    assert result.stderr == b'err\n'
+
+
+def test_timeout_kills_the_tool(tmp_path):
+    pid_path = str(tmp_path / 'pid')
+    tic = time.time()
+    with pytest.raises(ToolTimeoutError):
+        ToolRunner(timeout=0.5).run_sync(_sleeper(pid_path))
+    assert time.time() - tic < 10
+    _assert_killed(pid_path)
+
+
+def test_cancel_kills_the_tool(tmp_path):
+    pid_path = str(tmp_path / 'pid')
+
+    async def main():
+        task = asyncio.ensure_future(ToolRunner().run(_sleeper(pid_path)))
+        await asyncio.wait_for(_wait_for_file(pid_path), 10)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    _assert_killed(pid_path)
+
+
+def test_slots_are_released_after_timeouts(tmp_path):
+    runner = ToolRunner(timeout=0.1)
+    for i in range(tool_runner.DEFAULT_MAX_CONCURRENT_TOOLS + 1):
+        with pytest.raises(ToolTimeoutError):
+            runner.run_sync(_sleeper(str(tmp_path / f'pid{i}')))
+    # a leaked slot would make this wait forever
+    result = asyncio.run(asyncio.wait_for(ToolRunner().run(['true']), 10))
+    assert result.returncode == 0
+
+
+def test_limit_is_only_set_before_tools_run(monkeypatch):
+    monkeypatch.setattr(tool_runner, '_HOST_SLOTS_USED', False)
+    monkeypatch.setattr(tool_runner, '_HOST_SLOTS', tool_runner._HOST_SLOTS)
+    tool_runner.set_max_concurrent_tools(2)
+    ToolRunner().run_sync(['true'])
+    with pytest.raises(RuntimeError):
+        tool_runner.set_max_concurrent_tools(3)
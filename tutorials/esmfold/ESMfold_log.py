@@ -2,7 +2,7 @@
 # MAGIC %md
 # MAGIC ## Download ESMfold and Store Runtime Logic in MLflow
 # MAGIC - Tested on DBR 15.4LTS ML (CPU or GPU)
-# MAGIC - Note: Loading and using the model later requires a GPU (a small T4 GPU is sufficient)
+# MAGIC - Note: Loading and using the model later is best done on a GPU (a small T4 GPU is sufficient), without one the model falls back to a (slow) CPU path
 # MAGIC
 # MAGIC ### Steps:
 # MAGIC - Define an **MLflow** PyFunc model that wraps the ESMfold model
@@ -29,12 +29,25 @@ import accelerate; print(accelerate.__version__)
 
 import mlflow
 from mlflow.models import infer_signature
+import base64
+import collections
+import hashlib
+import itertools
+import json
+import numpy as np
 import os
+import random
+import tempfile
+import threading
+import time
 
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 # COMMAND ----------
 
+# set to true to check and benchmark the wrapper on CPU before logging the model
+dbutils.widgets.dropdown("run_wrapper_benchmark", "false", ["true", "false"])
+
 CATALOG = 'protein_folding'
 SCHEMA = 'esmfold'
 MODEL_NAME = 'esmfold'
@@ -52,69 +65,550 @@ MODEL_NAME = 'esmfold'
 # MAGIC   - useful for serving as users do not need to know about this
 # MAGIC     - useful to consider for other models if one wants to include other processing steps:
 # MAGIC       - e.g. additional relaxation of structures
+# MAGIC   - folded structures are cached by sequence (and model revision), so repeated sequences skip the forward pass
+# MAGIC     - `ESMFoldPyFunc(disk_cache=True)` also keeps them on disk under the `cache` artifact directory
 
 # COMMAND ----------
 
-class ESMFoldPyFunc(mlflow.pyfunc.PythonModel):
-    def load_context(self, context):
-        CACHE_DIR = context.artifacts['cache']
+def _pdb_lookup_tables():
+    """ atom names (padded as in the PDB name columns), elements and residue names, indexed as in the atom37 / aatype encoding """
+    residue_constants = transformers.models.esm.openfold_utils.residue_constants
+    atom_names = np.array([a if len(a) == 4 else f" {a}" for a in residue_constants.atom_types])
+    elements = np.array([a[0] for a in residue_constants.atom_types])
+    res_names = np.array([
+        residue_constants.restype_1to3.get(r, "UNK") for r in residue_constants.restypes + ["X"]
+    ])
+    return atom_names, elements, res_names
+
+
+# one ATOM record, column for column as written by openfold_utils.protein.to_pdb (single chain "A")
+_ATOM_LINE = "ATOM  %5d %-4s %3s A%4d    %8.3f%8.3f%8.3f  1.00%6.2f           %s  "
+_TER_LINE = "TER   %5d      %3s A%4d"
+
+
+def atoms_to_pdbs(
+    atom_positions: np.ndarray,
+    atom_mask: np.ndarray,
+    aatype: np.ndarray,
+    residue_index: np.ndarray,
+    b_factors: np.ndarray,
+    lengths: List[int],
+    ) -> List[str]:
+    """ render a batch of single chain atom37 structures to PDB strings
+
+    Produces the same text as openfold_utils.protein.to_pdb, but selects atoms and gathers their fields with numpy
+    and formats all records of a structure with a single string formatting call instead of one f-string per atom.
+
+    Args:
+        atom_positions: (batch, residues, 37, 3)
+        atom_mask: (batch, residues, 37), atoms with mask >= 0.5 are written
+        aatype: (batch, residues)
+        residue_index: (batch, residues), residue numbers as written to the PDB
+        b_factors: (batch, residues, 37)
+        lengths: number of residues of each structure to write (the rest is padding)
+    """
+    atom_names, elements, res_names = _pdb_lookup_tables()
+    pdbs = []
+    for i, n in enumerate(lengths):
+        if np.any(aatype[i, :n] > len(res_names) - 1):
+            raise ValueError("Invalid aatypes.")
+        # C order of nonzero matches to_pdb: residue by residue, atoms in atom37 order
+        res, atom = np.nonzero(atom_mask[i, :n] >= 0.5)
+        n_atoms = len(res)
+        resnum = residue_index[i, :n].astype(np.int32)
+        pos = atom_positions[i, res, atom]
+        columns = [
+            range(1, n_atoms + 1),
+            atom_names[atom].tolist(),
+            res_names[aatype[i, res]].tolist(),
+            resnum[res].tolist(),
+            pos[:, 0].tolist(),
+            pos[:, 1].tolist(),
+            pos[:, 2].tolist(),
+            b_factors[i, res, atom].tolist(),
+            elements[atom].tolist(),
+        ]
+        fields = tuple(itertools.chain.from_iterable(zip(*columns)))
+        lines = [
+            "PARENT N/A",
+            "\n".join([_ATOM_LINE] * n_atoms) % fields if n_atoms else None,
+            _TER_LINE % (n_atoms + 1, res_names[aatype[i, n - 1]], resnum[n - 1]),
+            "END",
+            "",
+        ]
+        pdbs.append("\n".join(line for line in lines if line is not None))
+    return pdbs
 
-        self.tokenizer = transformers.AutoTokenizer.from_pretrained(
-            "facebook/esmfold_v1",
-            cache_dir=CACHE_DIR
-        )
-        self.model = transformers.EsmForProteinFolding.from_pretrained(
-            "facebook/esmfold_v1", 
-            low_cpu_mem_usage=True,
-            cache_dir=CACHE_DIR
-        )
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC #### Model factories
+# MAGIC   - the pyfunc builds its tokenizer and model with a factory, `esmfold_v1_factory` (the released weights) by default
+# MAGIC   - `tiny_esmfold_factory` builds a tiny randomly initialized ESMFold that runs in seconds on CPU
+# MAGIC     - its structures are meaningless, but it exercises all of the wrapper logic (tokenization, batching, post-processing, caching)
+
+# COMMAND ----------
 
-        self.model = self.model.cuda()
-        self.model.esm = self.model.esm.half()
-        torch.backends.cuda.matmul.allow_tf32 = True
+def esmfold_v1_factory(cache_dir: Optional[str]) -> Tuple[Any, Any]:
+    """ tokenizer and model of the released ESMFold weights, from the Hugging Face cache in cache_dir """
+    tokenizer = transformers.AutoTokenizer.from_pretrained(
+        "facebook/esmfold_v1",
+        cache_dir=cache_dir
+    )
+    model = transformers.EsmForProteinFolding.from_pretrained(
+        "facebook/esmfold_v1", 
+        low_cpu_mem_usage=True,
+        cache_dir=cache_dir
+    )
+    return tokenizer, model
+
+
+def tiny_esmfold_factory(cache_dir: Optional[str] = None, seed: int = 0) -> Tuple[Any, Any]:
+    """ tokenizer and a tiny, randomly initialized ESMFold (same architecture and outputs as the real model) """
+    vocab_list = transformers.models.esm.configuration_esm.get_default_vocab_list()
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+        f.write("\n".join(vocab_list))
+        vocab_file = f.name
+    tokenizer = transformers.EsmTokenizer(vocab_file)
+    os.remove(vocab_file)
+
+    config = transformers.EsmConfig(
+        vocab_size=len(vocab_list),
+        pad_token_id=vocab_list.index("<pad>"),
+        mask_token_id=vocab_list.index("<mask>"),
+        hidden_size=32,
+        num_hidden_layers=1,
+        num_attention_heads=4,
+        intermediate_size=37,
+        position_embedding_type="rotary",
+        is_folding_model=True,
+        vocab_list=vocab_list,
+        esmfold_config={
+            "fp16_esm": False,
+            "lddt_head_hid_dim": 16,
+            "trunk": {
+                "num_blocks": 2,
+                "sequence_state_dim": 64,
+                "pairwise_state_dim": 16,
+                "sequence_head_width": 4,
+                "pairwise_head_width": 4,
+                "position_bins": 4,
+                "max_recycles": 1,
+                "structure_module": {
+                    "sequence_dim": 48,
+                    "pairwise_dim": 16,
+                    "ipa_dim": 16,
+                    "resnet_dim": 16,
+                    "num_heads_ipa": 4,
+                    "num_blocks": 2,
+                },
+            },
+        },
+    )
+    torch.manual_seed(seed)
+    model = transformers.EsmForProteinFolding(config)
+    return tokenizer, model
 
-    def _post_process(self, outputs):
-        """ postprocess ESMFold output to standard PDB string
+# COMMAND ----------
+
+class ESMFoldPyFunc(mlflow.pyfunc.PythonModel):
+    # trunk chunk sizes tried, largest first (None runs the trunk without chunking)
+    CHUNK_SIZES = [None, 512, 256, 128, 64, 32, 16, 8, 4]
+    # bump when the fields of a cached result change, so stale cache entries are not served
+    RESULT_VERSION = 3
+
+    def __init__(
+        self,
+        max_tokens_sq: int = 1024**2,
+        memory_fraction: float = 0.8,
+        cache_size: int = 1024,
+        disk_cache: bool = False,
+        model_factory: Callable[[Optional[str]], Tuple[Any, Any]] = esmfold_v1_factory,
+        device: Optional[str] = None,
+        ):
+        """
+        Args:
+            max_tokens_sq: budget for one forward pass, as batch size x (longest sequence length)^2
+                - the folding trunk's pair representation grows with the square of the padded length
+                - a sequence longer than the budget allows is still folded, on its own
+            memory_fraction: share of the free device memory a forward pass may plan to use when picking the trunk chunk size
+            cache_size: number of folded structures kept in memory, 0 to disable the in-memory cache
+                - a PAE, folded only when requested, is a separate entry of the same cache
+            disk_cache: also store folded structures as json files under the model's `cache` artifact directory
+                - they survive restarts and are shared by workers using the same artifact directory
+            model_factory: called with the `cache` artifact directory (None without one), returns (tokenizer, model)
+                - e.g. tiny_esmfold_factory to test or benchmark the wrapper on CPU
+            device: device to run the model on, by default a GPU if there is one, else the CPU
+        """
+        self.max_tokens_sq = max_tokens_sq
+        self.memory_fraction = memory_fraction
+        self.cache_size = cache_size
+        self.disk_cache = disk_cache
+        self.model_factory = model_factory
+        self.device_name = device
 
-        this method as per part of code here https://github.com/huggingface/notebooks/blob/main/examples/protein_folding.ipynb
-        (copyright huggingface/notebooks, Apache 2.0, http://www.apache.org/licenses/LICENSE-2.0)
+    def load_context(self, context):
+        # context is None when the wrapper is used directly (tests, benchmarks) rather than loaded by mlflow
+        CACHE_DIR = context.artifacts.get('cache') if context is not None else None
+
+        self.tokenizer, self.model = self.model_factory(CACHE_DIR)
+
+        device_name = self.device_name or ("cuda" if torch.cuda.is_available() else "cpu")
+        if device_name.startswith("cuda"):
+            self.device = torch.device(device_name)
+            self.model = self.model.to(self.device)
+            self.model.esm = self.model.esm.half()
+            torch.backends.cuda.matmul.allow_tf32 = True
+        else:
+            # CPU fallback: slow, but the same logged model runs (and can be tested) without a GPU
+            # the language model runs in float32 as half precision is poorly supported on CPU
+            # (from_pretrained may already have halved it when the config sets fp16_esm)
+            self.device = torch.device("cpu")
+            self.model.esm = self.model.esm.float()
+        self.model.eval()
+
+        # results are only valid for the weights that produced them
+        self.model_revision = getattr(self.model.config, "_commit_hash", None) or self.model.config.name_or_path
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_dir = os.path.join(CACHE_DIR, "esmfold_results") if self.disk_cache and CACHE_DIR else None
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _cache_key(self, sequence: str, part: str = "result") -> str:
+        """ key of a cached part of the result of sequence: "result" (pdb and scores) or "pae" """
+        return hashlib.sha256(
+            f"{self.RESULT_VERSION}:{self.model_revision}:{part}:{sequence}".encode("utf-8")
+        ).hexdigest()
+
+    def _cache_get(self, key: str) -> Optional[Dict[str, Any]]:
+        """ cached result for key from memory, else from disk, or None """
+        with self._cache_lock:
+            result = self._cache.get(key)
+            if result is not None:
+                self._cache.move_to_end(key)
+                return result
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(os.path.join(self.cache_dir, f"{key}.json"), "r") as f:
+                result = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        self._cache_put(key, result, to_disk=False)
+        return result
+
+    def _cache_put(self, key: str, result: Dict[str, Any], to_disk: bool = True):
+        if self.cache_size > 0:
+            with self._cache_lock:
+                self._cache[key] = result
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        if to_disk and self.cache_dir is not None:
+            # write then rename, so other workers never read a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".json.tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(result, f)
+            os.replace(tmp_path, os.path.join(self.cache_dir, f"{key}.json"))
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """ hit and miss counts of the result cache, counted per requested sequence """
+        requests = self.cache_hits + self.cache_misses
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "hit_rate": self.cache_hits / requests if requests else 0.0,
+            "memory_entries": len(self._cache),
+        }
+
+    def _available_memory(self) -> int:
+        """ free bytes on the device the model runs on """
+        if self.device.type == "cuda":
+            free, _ = torch.cuda.mem_get_info(self.device)
+            return free
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+    def _estimate_trunk_memory(self, batch_size: int, length: int, chunk_size: Optional[int]) -> int:
+        """ rough peak activation bytes of the folding trunk for a padded batch
+
+        The pair representation (batch x L x L x c_z) and its updates grow with L^2, while triangle attention
+        logits (batch x rows x heads x L x L) grow with L^3 unless rows are processed in chunks.
+        """
+        trunk_config = self.model.config.esmfold_config.trunk
+        c_z = trunk_config.pairwise_state_dim
+        heads = c_z // trunk_config.pairwise_head_width
+        rows = length if chunk_size is None else min(chunk_size, length)
+        pair_bytes = 8 * batch_size * length**2 * c_z * 4
+        attention_bytes = batch_size * rows * heads * length**2 * 4
+        return pair_bytes + attention_bytes
+
+    def _pick_chunk_size(self, batch_size: int, length: int) -> Optional[int]:
+        """ largest trunk chunk size whose estimated memory fits in the available memory """
+        budget = self.memory_fraction * self._available_memory()
+        for chunk_size in self.CHUNK_SIZES:
+            if self._estimate_trunk_memory(batch_size, length, chunk_size) <= budget:
+                return chunk_size
+        return self.CHUNK_SIZES[-1]
+
+    def _length_buckets(self, lengths: List[int]) -> List[List[int]]:
+        """ group input indices, sorted by length, into buckets of at most max_tokens_sq padded residue pairs """
+        buckets = []
+        bucket = []
+        for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+            # sorted ascending, so the new sequence sets the padded length of the bucket
+            if bucket and (len(bucket) + 1) * lengths[i]**2 > self.max_tokens_sq:
+                buckets.append(bucket)
+                bucket = []
+            bucket.append(i)
+        if bucket:
+            buckets.append(bucket)
+        return buckets
+
+    def _post_process(self, outputs, lengths: List[int], return_pae: bool = False) -> List[Dict[str, Any]]:
+        """ postprocess ESMFold output to standard PDB strings and confidence metrics
+
+        Only the tensors a PDB needs are copied off the device (the model output also holds pair representations,
+        frames, angles, ...), and the PDB text of every structure is rendered in one vectorized pass.
+
+        lengths: the unpadded length of each sequence in the batch, padding is dropped from the structures
+        return_pae: also copy and encode the predicted aligned error (an L x L matrix per sequence)
+
+        Returns one dict per sequence with
+            pdb: the PDB string, pLDDT in the B-factor column
+            plddt: per residue pLDDT (of the CA atom), on the model's 0-1 scale
+            mean_plddt: mean of plddt
+            ptm: predicted TM score
+            pae: with return_pae, predicted aligned error, L x L float16 (little endian, row major) encoded as base64
         """
         final_atom_positions = transformers.models.esm.openfold_utils.feats.atom14_to_atom37(
             outputs["positions"][-1], 
             outputs
         )
-        outputs = {k: v.to("cpu").numpy() for k, v in outputs.items()}
-        final_atom_positions = final_atom_positions.cpu().numpy()
-        final_atom_mask = outputs["atom37_atom_exists"]
-        pdbs = []
-        for i in range(outputs["aatype"].shape[0]):
-            aa = outputs["aatype"][i]
-            pred_pos = final_atom_positions[i]
-            mask = final_atom_mask[i]
-            resid = outputs["residue_index"][i] + 1
-            pred = transformers.models.esm.openfold_utils.protein.Protein(
-                aatype=aa,
-                atom_positions=pred_pos,
-                atom_mask=mask,
-                residue_index=resid,
-                b_factors=outputs["plddt"][i],
-                chain_index=outputs["chain_index"][i] if "chain_index" in outputs else None,
+        needed = {
+            "positions": final_atom_positions,
+            "atom_mask": outputs["atom37_atom_exists"],
+            "aatype": outputs["aatype"],
+            "residue_index": outputs["residue_index"],
+            "plddt": outputs["plddt"],
+        }
+        if "chain_index" in outputs:
+            needed["chain_index"] = outputs["chain_index"]
+        # the model's ptm is a single value for the whole padded batch: score each sequence on its own residues
+        needed["ptm"] = torch.stack([
+            transformers.models.esm.openfold_utils.loss.compute_tm(
+                outputs["ptm_logits"][i, :n, :n],
+                max_bin=31,
+                no_bins=outputs["ptm_logits"].shape[-1],
             )
-            pdbs.append(transformers.models.esm.openfold_utils.protein.to_pdb(pred))
-        return pdbs
-
-    def predict(self, context, model_input : List[str], params=None) -> List[str]:
-        tokenized_input = self.tokenizer(
-            model_input, 
+            for i, n in enumerate(lengths)
+        ])
+        if return_pae:
+            needed["pae"] = outputs["predicted_aligned_error"].half()
+        arrays = {k: v.detach().to("cpu").numpy() for k, v in needed.items()}
+
+        if "chain_index" in arrays:
+            # multi chain output needs TER records and headers between chains: use the OpenFold writer
+            pdbs = [
+                transformers.models.esm.openfold_utils.protein.to_pdb(
+                    transformers.models.esm.openfold_utils.protein.Protein(
+                        aatype=arrays["aatype"][i][:n],
+                        atom_positions=arrays["positions"][i][:n],
+                        atom_mask=arrays["atom_mask"][i][:n],
+                        residue_index=arrays["residue_index"][i][:n] + 1,
+                        b_factors=arrays["plddt"][i][:n],
+                        chain_index=arrays["chain_index"][i][:n],
+                    )
+                )
+                for i, n in enumerate(lengths)
+            ]
+        else:
+            pdbs = atoms_to_pdbs(
+                arrays["positions"],
+                arrays["atom_mask"],
+                arrays["aatype"],
+                arrays["residue_index"] + 1,
+                arrays["plddt"],
+                lengths,
+            )
+        ca = transformers.models.esm.openfold_utils.residue_constants.atom_order["CA"]
+        results = []
+        for i, (pdb, n) in enumerate(zip(pdbs, lengths)):
+            plddt = arrays["plddt"][i, :n, ca]
+            result = {
+                "pdb": pdb,
+                "plddt": plddt.tolist(),
+                "mean_plddt": float(plddt.mean()),
+                "ptm": float(arrays["ptm"][i]),
+            }
+            if return_pae:
+                pae = np.ascontiguousarray(arrays["pae"][i, :n, :n], dtype="<f2")
+                result["pae"] = base64.b64encode(pae.tobytes()).decode("ascii")
+            results.append(result)
+        return results
+
+    def _tokenize(self, sequences: List[str]):
+        """ padded input ids and attention mask of a bucket, on the model's device """
+        tokenized = self.tokenizer(
+            sequences, 
             return_tensors="pt", 
             add_special_tokens=False,
             padding=True
-        )['input_ids']
-        tokenized_input = tokenized_input.cuda()
-        with torch.no_grad():
-            output = self.model(tokenized_input)
-        pdbs = self._post_process(output)
-        return pdbs
+        )
+        input_ids = tokenized['input_ids'].to(self.device)
+        # without the mask, padding would be folded as residues of the shorter sequences
+        attention_mask = tokenized['attention_mask'].to(self.device)
+        return input_ids, attention_mask
+
+    def _forward(self, input_ids, attention_mask):
+        chunk_size = self._pick_chunk_size(*input_ids.shape)
+        while True:
+            self.model.trunk.set_chunk_size(chunk_size)
+            try:
+                with torch.no_grad():
+                    output = self.model(input_ids, attention_mask=attention_mask)
+                break
+            except torch.cuda.OutOfMemoryError:
+                # the estimate was too optimistic: retry with the next smaller chunk size
+                smaller = [c for c in self.CHUNK_SIZES[1:] if chunk_size is None or c < chunk_size]
+                if not smaller:
+                    raise
+                chunk_size = smaller[0]
+                torch.cuda.empty_cache()
+        return output
+
+    def _fold(self, sequences: List[str], return_pae: bool = False) -> List[Dict[str, Any]]:
+        """ fold one bucket of sequences in a single forward pass """
+        output = self._forward(*self._tokenize(sequences))
+        return self._post_process(output, [len(s) for s in sequences], return_pae=return_pae)
+
+    def _cached_result(self, sequence: str, return_pae: bool) -> Optional[Dict[str, Any]]:
+        """ cached result of sequence, with its PAE if return_pae, or None """
+        result = self._cache_get(self._cache_key(sequence))
+        if result is None or not return_pae:
+            return result
+        pae = self._cache_get(self._cache_key(sequence, "pae"))
+        if pae is None:
+            return None
+        return dict(result, pae=pae["pae"])
+
+    def predict(self, context, model_input : List[str], params=None) -> List[Any]:
+        """ fold sequences
+
+        params:
+            structured: return a dict per sequence instead of the PDB string, with keys
+                pdb, mean_plddt, ptm and plddt (per residue), so callers can rank structures without parsing PDBs
+            return_pae: with structured, also return the predicted aligned error as base64 encoded float16 (L x L)
+        """
+        params = params or {}
+        # the PAE is L x L per sequence: only computed, copied and cached when it is returned
+        return_pae = params.get("structured", False) and params.get("return_pae", False)
+        if hasattr(model_input, 'iloc'):
+            # a pandas DataFrame after signature enforcement: sequences are in the first column
+            model_input = model_input.iloc[:, 0].tolist()
+        results = [None] * len(model_input)
+        # sequences to fold -> their positions in the input, so repeats within a request are folded once
+        to_fold = {}
+        for i, sequence in enumerate(model_input):
+            cached = self._cached_result(sequence, return_pae)
+            if cached is not None:
+                results[i] = cached
+            else:
+                to_fold.setdefault(sequence, []).append(i)
+        with self._cache_lock:
+            self.cache_hits += len(model_input) - sum(len(v) for v in to_fold.values())
+            self.cache_misses += sum(len(v) for v in to_fold.values())
+
+        # fold length sorted buckets one after another, so short sequences are not padded to the longest
+        unique = list(to_fold)
+        for bucket in self._length_buckets([len(s) for s in unique]):
+            for j, result in zip(bucket, self._fold([unique[j] for j in bucket], return_pae=return_pae)):
+                self._cache_put(self._cache_key(unique[j]), {k: v for k, v in result.items() if k != "pae"})
+                if return_pae:
+                    self._cache_put(self._cache_key(unique[j], "pae"), {"pae": result["pae"]})
+                for i in to_fold[unique[j]]:
+                    results[i] = result
+
+        if not params.get("structured", False):
+            return [result["pdb"] for result in results]
+        keys = ["pdb", "mean_plddt", "ptm", "plddt"]
+        if return_pae:
+            keys.append("pae")
+        return [{k: result[k] for k in keys} for result in results]
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC #### Check and benchmark the wrapper on CPU
+# MAGIC   - with the tiny model the forward pass is cheap, so the timings show the overhead of the wrapper itself
+# MAGIC   - rerun after changing the wrapper: tokenization and post-processing should stay small next to the forward pass of the real model
+# MAGIC   - off by default so logging the model does not build and benchmark the tiny model: set the `run_wrapper_benchmark` widget to true to run it
+
+# COMMAND ----------
+
+def benchmark_wrapper(
+    pyfunc: ESMFoldPyFunc,
+    batch_sizes: List[int] = [1, 4, 16],
+    lengths: List[int] = [64, 256],
+    repeats: int = 3,
+    seed: int = 0,
+    ):
+    """ median seconds per wrapper stage for random batches of each batch size and maximum length
+
+    Sequences in a batch are between half and the full maximum length, so padding is exercised.
+    render is the PDB rendering part of post_process.
+    """
+    import pandas as pd
+
+    rng = random.Random(seed)
+    alphabet = "ACDEFGHIKLMNPQRSTVWY"
+    rows = []
+    for batch_size in batch_sizes:
+        for length in lengths:
+            sequences = [
+                "".join(rng.choices(alphabet, k=rng.randint(length // 2, length))) for _ in range(batch_size)
+            ]
+            seq_lengths = [len(seq) for seq in sequences]
+            timings = collections.defaultdict(list)
+            for _ in range(repeats):
+                tic = time.perf_counter()
+                input_ids, attention_mask = pyfunc._tokenize(sequences)
+                timings["tokenize"].append(time.perf_counter() - tic)
+
+                tic = time.perf_counter()
+                output = pyfunc._forward(input_ids, attention_mask)
+                timings["forward"].append(time.perf_counter() - tic)
+
+                tic = time.perf_counter()
+                pyfunc._post_process(output, seq_lengths)
+                timings["post_process"].append(time.perf_counter() - tic)
+
+                positions = transformers.models.esm.openfold_utils.feats.atom14_to_atom37(output["positions"][-1], output)
+                arrays = [
+                    v.detach().cpu().numpy()
+                    for v in (positions, output["atom37_atom_exists"], output["aatype"], output["residue_index"], output["plddt"])
+                ]
+                tic = time.perf_counter()
+                atoms_to_pdbs(*arrays, seq_lengths)
+                timings["render"].append(time.perf_counter() - tic)
+
+            row = {"batch_size": batch_size, "max_length": length}
+            row.update({f"{stage}_s": float(np.median(t)) for stage, t in timings.items()})
+            row["wrapper_share"] = (row["tokenize_s"] + row["post_process_s"]) / (
+                row["tokenize_s"] + row["forward_s"] + row["post_process_s"]
+            )
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+# COMMAND ----------
+
+if dbutils.widgets.get("run_wrapper_benchmark") == "true":
+    tiny_esmfold = ESMFoldPyFunc(cache_size=0, model_factory=tiny_esmfold_factory, device="cpu")
+    tiny_esmfold.load_context(None)
+    assert tiny_esmfold.predict(None, ["MKTAYIAKQR", "MKT"])[1].startswith("PARENT N/A")
+    display(benchmark_wrapper(tiny_esmfold))
 
 # COMMAND ----------
 
@@ -142,11 +636,16 @@ esmfold_model = ESMFoldPyFunc()
 # COMMAND ----------
 
 test_input = ["MADVQLQESGGGSVQAGGSLRLSCVASGVTSTRPCIGWFRQAPGKEREGVAVVNFRGDSTYITDSVKGRFTISRDEDSDTVYLQMNSLKPEDTATYYCAADVNRGGFCYIEDWYFSYWGQGTQVTVSSAAAHHHHHH"]
-from mlflow.types.schema import ColSpec, Schema
+from mlflow.types.schema import ColSpec, ParamSchema, ParamSpec, Schema
 signature = mlflow.models.signature.ModelSignature(
     inputs = Schema([ColSpec(type="string")]),
+    # the output schema covers the default mode only (one PDB string per sequence):
+    # structured=True returns dicts with pdb, mean_plddt, ptm and plddt (and pae with return_pae=True) instead
     outputs = Schema([ColSpec(type="string")]),
-    params=None
+    params=ParamSchema([
+        ParamSpec("structured", "boolean", False),
+        ParamSpec("return_pae", "boolean", False),
+    ])
 )
 
 # COMMAND ----------
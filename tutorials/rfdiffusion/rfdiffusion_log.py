@@ -16,65 +16,197 @@
 # COMMAND ----------
 
 import subprocess
+import itertools
+import math
 import os
 import tempfile
+import numpy as np
 import mlflow
-from mlflow.types.schema import ColSpec, Schema
-from typing import Any, Dict, List, Optional
+from mlflow.types.schema import ColSpec, ParamSchema, ParamSpec, Schema
+from typing import Any, Dict, List, Optional, Tuple
 
 import logging
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC ## Model definition for RFDiffusion for Unconstrained Problem
-# MAGIC  - this is for predicting a backbone with only the protein legth being a constraint.
-# MAGIC  - We use the mlflow PythonModel as the base class
-# MAGIC  - Although RFDiffusion expects to run from command line, we set Hydra config within python to be able to run the main function from within our python code
+# MAGIC ## Shared base: resident RFdiffusion samplers
+# MAGIC  - RFdiffusion's `run_inference.main` builds a sampler, and so reloads the checkpoint, on every call
+# MAGIC  - here the hydra config is composed once and a sampler per checkpoint is kept in memory from `load_context`
+# MAGIC    - a request only updates the config (contigs, input pdb) of the resident sampler and runs the denoising steps
+# MAGIC  - requests can set the number of diffusion steps, partial diffusion (`partial_T`) and a seed as params
+# MAGIC    - a latency model (length x steps, calibrated on the served runs) downgrades or rejects requests that would exceed `max_latency`
+# MAGIC  - input structures are parsed in memory and designs are rendered to pdb text directly, without temporary files
 
 # COMMAND ----------
 
-class RFDiffusionUnconditional(mlflow.pyfunc.PythonModel):
+class LatencyModel:
+    """ runtime of a design estimated as overhead + seconds_per_residue_step x length x steps
+
+    seconds_per_residue_step starts from a prior and follows the observed runs (exponential moving average),
+    so the estimate adapts to the GPU the model is served on.
+    """
+    def __init__(self, seconds_per_residue_step: float = 5e-3, overhead: float = 2.0, smoothing: float = 0.2):
+        self.seconds_per_residue_step = seconds_per_residue_step
+        self.overhead = overhead
+        self.smoothing = smoothing
+
+    @staticmethod
+    def _rounds(num_designs: int, concurrency: int) -> int:
+        # as in RFDiffusionBase._sample: the first design runs alone, the others in rounds of concurrency designs
+        return 1 + math.ceil((num_designs - 1) / max(concurrency, 1)) if num_designs > 1 else num_designs
+
+    def estimate(self, length: int, steps: int, num_designs: int = 1, concurrency: int = 1) -> float:
+        """ seconds to sample num_designs designs, up to concurrency of them at a time
+
+        designs sampled together are counted as taking as long as one alone (the GPU has room for them), with
+        concurrency=1 this is the time of sampling them one after another
+        """
+        rounds = self._rounds(num_designs, concurrency)
+        return rounds * (self.overhead + self.seconds_per_residue_step * length * steps)
+
+    def max_steps(self, length: int, budget: float, num_designs: int = 1, concurrency: int = 1) -> int:
+        """ most steps per design that fit in budget seconds """
+        rounds = self._rounds(num_designs, concurrency)
+        return int((budget / rounds - self.overhead) / (self.seconds_per_residue_step * length))
+
+    def observe(self, length: int, steps: int, seconds: float):
+        if length * steps == 0:
+            return
+        rate = max(seconds - self.overhead, 0.0) / (length * steps)
+        self.seconds_per_residue_step += self.smoothing * (rate - self.seconds_per_residue_step)
+
+# COMMAND ----------
+
+def make_inpainting_contig(pdb_idx: List[Tuple[str, int]], start_idx: int, end_idx: int, chain: Optional[str] = None) -> str:
+    """ contig keeping every residue of the input except residues start_idx..end_idx of chain, which are redesigned
+
+    parameters
+    -----------
+    pdb_idx:
+        (chain, residue number) of each residue of the input pdb, in file order
+    chain:
+        chain of the masked residues, by default the first chain of the pdb
+
+    Runs of consecutively numbered residues become contig segments, so gaps in the numbering split a chain
+    into segments instead of referring to residues that do not exist. Chains are separated by chain breaks (/0).
+    e.g. "A1-11/11-11/A23-60/A65-120/0 B1-80"
+    """
+    if chain is None:
+        chain = pdb_idx[0][0]
+    x_len = end_idx - start_idx + 1
+    chains = []  # [chain id, its segments]
+    run = None  # [chain id, first, last] residue numbers of the segment being extended
+    masked = False
+    for ch, num in list(pdb_idx) + [(None, None)]:
+        in_mask = ch == chain and start_idx <= num <= end_idx
+        if run is not None and (ch != run[0] or in_mask or num != run[2] + 1):
+            chains[-1][1].append(f'{run[0]}{run[1]}-{run[2]}')
+            run = None
+        if ch is None:
+            break
+        if not chains or chains[-1][0] != ch:
+            chains.append([ch, []])
+        if in_mask:
+            if not masked:
+                chains[-1][1].append(f'{x_len}-{x_len}')
+                masked = True
+        elif run is None:
+            run = [ch, num, num]
+        else:
+            run[2] = num
+    if not masked:
+        raise ValueError(f"no residues of chain {chain} between {start_idx} and {end_idx} in the input pdb")
+    return '/0 '.join('/'.join(segments) for _, segments in chains)
+
+
+# one ATOM record as written by rfdiffusion.util.writepdb
+_ATOM_LINE = "ATOM  %5d %4s %3s %s%4d    %8.3f%8.3f%8.3f  1.00%6.2f\n"
+_BACKBONE_ATOMS = np.array([" N  ", " CA ", " C  ", " O  "])
+
+
+def backbone_to_pdb(xyz: np.ndarray, seq: np.ndarray, bfacts: np.ndarray, chains: List[str], num2aa: List[str]) -> str:
+    """ pdb text of a backbone (N, CA, C, O per residue), the same as rfdiffusion.util.writepdb without the file
+
+    parameters
+    -----------
+    xyz: (L, 4, 3) backbone coordinates
+    seq: (L,) residue type indices
+    bfacts: (L,) b-factors, clamped to [0, 1]
+    chains: chain id of each residue
+    num2aa: residue type index -> 3 letter residue name
+    """
+    n_res = len(seq)
+    res = np.repeat(np.arange(n_res), 4)
+    pos = xyz.reshape(-1, 3)
+    columns = [
+        range(1, 4 * n_res + 1),
+        np.tile(_BACKBONE_ATOMS, n_res).tolist(),
+        np.array(num2aa)[seq][res].tolist(),
+        np.array(chains)[res].tolist(),
+        (res + 1).tolist(),
+        pos[:, 0].tolist(),
+        pos[:, 1].tolist(),
+        pos[:, 2].tolist(),
+        np.clip(np.asarray(bfacts, dtype=float), 0, 1)[res].tolist(),
+    ]
+    return (_ATOM_LINE * (4 * n_res)) % tuple(itertools.chain.from_iterable(zip(*columns)))
+
+# COMMAND ----------
+
+class RFDiffusionBase(mlflow.pyfunc.PythonModel):
+    steps = 20 # rfdiffusion repo suggests 20steps is usually sufficient
+    # designs of one request sampled at the same time, if GPU memory allows
+    max_concurrent_designs = 4
+    # share of the free GPU memory concurrent designs may use
+    memory_fraction = 0.8
+    # guardrails on the request level diffusion schedule
+    min_steps = 10
+    max_steps = 50
+    # serving SLA: requests estimated to take longer are downgraded to fewer steps or rejected
+    max_latency = 120.0
+
     def load_context(self, context):
         self.model_path = context.artifacts['model_path']
         self.script_path = context.artifacts['script_path']
-        self.example_path = context.artifacts['example_path']
-        
+        self.example_path = context.artifacts.get('example_path')
+
         import sys
         import os
+        import threading
+        import hydra
+        from omegaconf import OmegaConf
+        from hydra.core.hydra_config import HydraConfig
         self.config_path = context.artifacts['config_path']
         self.rel_config_path = os.path.relpath("/", sys.argv[0])[:-3] + self.config_path
 
-    def _validate_input(self,plen):
-        if not isinstance(plen,int):
-            try:
-                plen = int(plen)
-            except:
-                raise TypeError("plen should be an int (and less than 180)")
-        if plen>180:
-            raise ValueError("plen must be less than 180, {plen} was passed")
-        if plen==0:
-            raise ValueError("protein length must be greater than 0")
-        return plen
-    
-    def _make_config(self,plen:int,outpath:str='out'):
-        """ creates a hydra config file for the run script"""
-        import hydra
-        # with hydra.initialize(version_base=None, config_path=self.rel_config_path):
-        cfg = hydra.compose(
-            config_name="base", 
-            overrides=[
-                f'contigmap.contigs=[{plen}-{plen}]',
-                f'inference.output_prefix={outpath}/output',
-                'inference.num_designs=1',
-                f'inference.model_directory_path={self.model_path}',
-                f'inference.input_pdb={self.example_path}/input_pdbs/1qys.pdb',
-                f'diffuser.T=20'
-            ],
-            return_hydra_config=True,
+        # compose the base config once, requests only update it
+        with hydra.initialize(version_base=None, config_path=self.rel_config_path):
+            cfg = hydra.compose(
+                config_name="base",
+                overrides=[
+                    f'inference.model_directory_path={self.model_path}',
+                    f'diffuser.T={self.steps}',
+                ] + (
+                    # the sampler parses inference.input_pdb when it is initialized: point it to a small resident file,
+                    # requests with an input structure replace the parsed features with their own (see _target_features)
+                    [f'inference.input_pdb={self.example_path}/input_pdbs/1qys.pdb'] if self.example_path is not None else []
+                ),
+                return_hydra_config=True,
             )
-        return cfg
-    
+        # add dummy hydra pieces and Merge with existing config
+        self.base_cfg = OmegaConf.merge({"hydra": self._dummy_hydra()}, cfg)
+        HydraConfig.instance().set_config(self.base_cfg)
+
+        self.latency_model = LatencyModel()
+        # checkpoint file name -> resident sampler, built once and reinitialized with each request's config
+        self.samplers = {}
+        # a sampler holds the state of the design it is running, so requests take turns
+        self._sampler_lock = threading.Lock()
+        if self.example_path is not None:
+            # load the checkpoint the model uses now rather than in the first request
+            self._get_sampler(self._config({}))
+
     def _dummy_hydra(self):
         import os
         from omegaconf import OmegaConf
@@ -90,35 +222,285 @@ class RFDiffusionUnconditional(mlflow.pyfunc.PythonModel):
         })
         return hydra_runtime
 
-    def _run_inference(self,plen:int):
-        """ runs inference script with fixed environment 
+    def _config(self, updates: Dict[str, Any]):
+        """ copy of the base config with updates (dotted key -> value) applied """
+        import copy
+        from omegaconf import OmegaConf
+        cfg = copy.deepcopy(self.base_cfg)
+        task_overrides = list(cfg.hydra.overrides.task)
+        for key, value in updates.items():
+            OmegaConf.update(cfg, key, value, merge=False)
+            if key.split('.')[0] in ['model', 'diffuser', 'preprocess']:
+                # the sampler resets these groups from the checkpoint, then re-applies only the hydra task overrides
+                task_overrides = [o for o in task_overrides if o.split('=')[0] != key] + [f'{key}={value}']
+        OmegaConf.update(cfg, 'hydra.overrides.task', task_overrides, merge=False)
+        return cfg
+
+    def _resolve_schedule(self, length: int, params: Optional[Dict[str, Any]], num_designs: int = 1) -> Dict[str, Any]:
+        """ validated diffusion schedule of a request, within the guardrails and the latency SLA
+
+        params (all optional):
+            steps: number of diffusion steps (diffuser.T)
+            partial_T: > 0 for partial diffusion: noise the input structure to step partial_T and denoise from there
+            seed: >= 0 for deterministic sampling (design i uses seed + i)
+            on_over_budget: 'downgrade' (default) to run fewer steps, or 'reject', when the estimate exceeds max_latency
+        """
+        params = params or {}
+        steps = int(params.get('steps') or self.steps)
+        if not self.min_steps <= steps <= self.max_steps:
+            raise ValueError(f"steps must be between {self.min_steps} and {self.max_steps}, {steps} was passed")
+        partial_T = int(params.get('partial_T') or 0) or None
+        if partial_T is not None and not 1 <= partial_T <= steps:
+            raise ValueError(f"partial_T must be between 1 and steps ({steps}), {partial_T} was passed")
+        seed = params.get('seed')
+        seed = None if seed is None or int(seed) < 0 else int(seed)
+        on_over_budget = params.get('on_over_budget') or 'downgrade'
+        if on_over_budget not in ('downgrade', 'reject'):
+            raise ValueError(f"on_over_budget must be 'downgrade' or 'reject', {on_over_budget} was passed")
+
+        denoising_steps = partial_T or steps
+        concurrency = self._design_concurrency(num_designs, seed)
+        estimate = self.latency_model.estimate(length, denoising_steps, num_designs, concurrency)
+        if estimate > self.max_latency:
+            allowed = self.latency_model.max_steps(length, self.max_latency, num_designs, concurrency)
+            if on_over_budget == 'reject' or allowed < min(self.min_steps, denoising_steps):
+                raise ValueError(
+                    f"request estimated to take {estimate:.0f}s ({num_designs} designs x {denoising_steps} steps "
+                    f"of length {length}), over the {self.max_latency:.0f}s limit"
+                )
+            if partial_T is not None:
+                # keep the noise level partial_T / steps, denoise in fewer, larger steps
+                steps = max(1, round(steps * allowed / partial_T))
+                partial_T = min(allowed, steps)
+            else:
+                steps = allowed
+            logging.warning(
+                f"estimated {estimate:.0f}s is over the {self.max_latency:.0f}s limit, downgraded to "
+                f"steps={steps}, partial_T={partial_T}"
+            )
+        return {'steps': steps, 'partial_T': partial_T, 'seed': seed}
+
+    def _design_concurrency(self, num_designs: int, seed: Optional[int] = None) -> int:
+        """ most designs of a request _sample runs at a time (it may run fewer when GPU memory is short) """
+        import torch
+
+        if not torch.cuda.is_available() or num_designs == 1 or self.max_concurrent_designs <= 1 or seed is not None:
+            return 1
+        return min(self.max_concurrent_designs, num_designs - 1)
+
+    def _checkpoint_name(self, cfg) -> str:
+        """ checkpoint RFdiffusion's Sampler picks for a config (mirrors Sampler.initialize) """
+        if cfg.inference.ckpt_override_path is not None:
+            return os.path.basename(cfg.inference.ckpt_override_path)
+        if cfg.contigmap.inpaint_seq is not None or cfg.contigmap.provide_seq is not None or cfg.contigmap.inpaint_str:
+            return 'InpaintSeq_Fold_ckpt.pt' if cfg.scaffoldguided.scaffoldguided else 'InpaintSeq_ckpt.pt'
+        if cfg.ppi.hotspot_res is not None and not cfg.scaffoldguided.scaffoldguided:
+            return 'Complex_base_ckpt.pt'
+        if cfg.scaffoldguided.scaffoldguided:
+            return 'Complex_Fold_base_ckpt.pt'
+        return 'Base_ckpt.pt'
+
+    def _target_features(self, pdb_str: str) -> Dict[str, Any]:
+        """ the sampler's target features of a pdb, parsed from the string (as iu.process_target with center=False) """
+        import torch
+        from rfdiffusion.inference import utils as iu
+
+        target_struct = iu.parse_pdb_lines(pdb_str.splitlines(keepends=True), parse_hetatom=True)
+        xyz = torch.from_numpy(target_struct["xyz"])
+        atom_mask = torch.from_numpy(target_struct["mask"])
+        seq_len = len(xyz)
+        # Make 27 atom representation
+        xyz_27 = torch.full((seq_len, 27, 3), np.nan).float()
+        xyz_27[:, :14, :] = xyz[:, :14, :]
+        mask_27 = torch.full((seq_len, 27), False)
+        mask_27[:, :14] = atom_mask[:, :14]
+        return {
+            "xyz_27": xyz_27,
+            "mask_27": mask_27,
+            "seq": torch.from_numpy(target_struct["seq"])[:seq_len],
+            "pdb_idx": target_struct["pdb_idx"],
+            "xyz_het": target_struct["xyz_het"],
+            "info_het": target_struct["info_het"],
+        }
+
+    def _get_sampler(self, cfg):
+        """ resident sampler for the checkpoint cfg selects, initialized with cfg
+
+        A Sampler only reloads its weights when ckpt_override_path changes, so the selected checkpoint
+        is pinned there and each checkpoint gets a sampler of its own.
+        """
+        from rfdiffusion.inference import utils as iu
+        from omegaconf import OmegaConf
+        from hydra.core.hydra_config import HydraConfig
+
+        # the request's overrides of the checkpoint's diffuser settings are read from the hydra config
+        HydraConfig.instance().set_config(cfg)
+        ckpt_name = self._checkpoint_name(cfg)
+        OmegaConf.update(cfg, 'inference.ckpt_override_path', os.path.join(self.model_path, ckpt_name), merge=False)
+        sampler = self.samplers.get(ckpt_name)
+        if sampler is None:
+            logging.info(f'loading RFdiffusion checkpoint {ckpt_name}')
+            sampler = iu.sampler_selector(cfg)
+            self.samplers[ckpt_name] = sampler
+        else:
+            sampler.initialize(cfg)
+        return sampler
+
+    def _sample_design(self, sampler, i_des: int, seed: Optional[int] = None, observe: bool = True) -> str:
+        """ run the denoising trajectory of one design, as in run_inference.main
+
+        observe: feed the runtime to the latency model, only for designs that had the GPU to themselves
+
+        returns the pdb text of the design (backbone atoms, glycine outside the motif)
+        """
+        import random
+        import time
+        import torch
+        from rfdiffusion.util import num2aa
+
+        if seed is not None:
+            torch.manual_seed(seed + i_des)
+            np.random.seed(seed + i_des)
+            random.seed(seed + i_des)
+
+        tic = time.time()
+        x_init, seq_init = sampler.sample_init()
+        x_t = torch.clone(x_init)
+        seq_t = torch.clone(seq_init)
+        # Loop over number of reverse diffusion time steps.
+        for t in range(int(sampler.t_step_input), sampler.inf_conf.final_step - 1, -1):
+            px0, x_t, seq_t, plddt = sampler.sample_step(
+                t=t, x_t=x_t, seq_init=seq_t, final_step=sampler.inf_conf.final_step
+            )
+        if observe:
+            self.latency_model.observe(
+                x_init.shape[0],
+                int(sampler.t_step_input) - sampler.inf_conf.final_step + 1,
+                time.time() - tic,
+            )
+
+        # Output glycines, except for motif region
+        motif_seq = torch.argmax(seq_init, dim=-1)
+        final_seq = torch.where(motif_seq == 21, 7, motif_seq)  # 7 is glycine
+        bfacts = torch.ones_like(final_seq.squeeze())
+        # make bfact=0 for diffused coordinates
+        bfacts[torch.where(motif_seq == 21, True, False)] = 0
+
+        n_res = final_seq.shape[0]
+        if sampler.chain_idx is not None:
+            chains = list(sampler.chain_idx)
+        elif sampler.binderlen is not None:
+            chains = ['A' if i < sampler.binderlen else 'B' for i in range(n_res)]
+        else:
+            chains = ['A'] * n_res
+        return backbone_to_pdb(
+            x_t[:, :4].cpu().numpy(),
+            final_seq.cpu().numpy().reshape(-1),
+            bfacts.cpu().numpy().reshape(-1),
+            chains,
+            num2aa,
+        )
+
+    def _sample(self, cfg, seed: Optional[int] = None, target_feats: Optional[Dict[str, Any]] = None) -> List[str]:
+        """ sample the inference.num_designs designs of a request, returns the pdb text of each
+
+        target_feats: features of the request's input structure (from _target_features), used instead of inference.input_pdb
+
+        The sampler is initialized once per request (config, input pdb parse, template features), all designs reuse it.
+        On GPU, after the first design, the remaining ones run concurrently on as many sampler copies as its peak memory
+        allows (at most max_concurrent_designs). Seeded requests run one design after another, as the random number
+        generators are global.
+        """
+        import copy
+        import queue
+        import torch
+        from concurrent.futures import ThreadPoolExecutor
+
+        with self._sampler_lock:
+            sampler = self._get_sampler(cfg)
+            if target_feats is not None:
+                sampler.target_feats = target_feats
+            num_designs = sampler.inf_conf.num_designs
+            if self._design_concurrency(num_designs, seed) == 1:
+                return [self._sample_design(sampler, i_des, seed) for i_des in range(num_designs)]
+
+            torch.cuda.reset_peak_memory_stats()
+            allocated = torch.cuda.memory_allocated()
+            texts = [self._sample_design(sampler, 0)]
+            design_memory = max(torch.cuda.max_memory_allocated() - allocated, 1)
+            free, _ = torch.cuda.mem_get_info()
+            n_workers = min(
+                self._design_concurrency(num_designs, seed),
+                max(1, int(self.memory_fraction * free // design_memory)),
+            )
+            logging.info(f'sampling {num_designs - 1} more designs on {n_workers} samplers')
+
+            # shallow copies share the model weights, diffuser and parsed input pdb; the per design state
+            # (contig map, masks, self conditioning inputs) is assigned by sample_init/sample_step on each copy
+            idle = queue.Queue()
+            for worker in [sampler] + [copy.copy(sampler) for _ in range(n_workers - 1)]:
+                idle.put(worker)
+
+            def run(i_des):
+                worker = idle.get()
+                try:
+                    # designs sharing the GPU run slower than one alone: keep them out of the latency model
+                    return self._sample_design(worker, i_des, observe=n_workers == 1)
+                finally:
+                    idle.put(worker)
+
+            with ThreadPoolExecutor(n_workers) as pool:
+                texts.extend(pool.map(run, range(1, num_designs)))
+        return texts
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Model definition for RFDiffusion for Unconstrained Problem
+# MAGIC  - this is for predicting a backbone with only the protein legth being a constraint.
+# MAGIC  - We use the mlflow PythonModel as the base class
+# MAGIC  - Although RFDiffusion expects to run from command line, we set Hydra config within python to be able to run the sampler from within our python code
+
+# COMMAND ----------
+
+class RFDiffusionUnconditional(RFDiffusionBase):
+    def _validate_input(self,plen):
+        if not isinstance(plen,int):
+            try:
+                plen = int(plen)
+            except:
+                raise TypeError("plen should be an int (and less than 180)")
+        if plen>180:
+            raise ValueError("plen must be less than 180, {plen} was passed")
+        if plen==0:
+            raise ValueError("protein length must be greater than 0")
+        return plen
+    
+    def _make_config(self,plen:int,steps:Optional[int]=None):
+        """ config of a request, from the base config composed in load_context """
+        return self._config({
+            'contigmap.contigs': [f'{plen}-{plen}'],
+            'inference.num_designs': 1,
+            'diffuser.T': steps or self.steps,
+        })
+
+    def _run_inference(self,plen:int,params:Optional[Dict[str, Any]]=None):
+        """ runs inference with the resident sampler
         
         parameters
         -----------
         plen:
             The length of protein to generate
+        params:
+            steps, seed and on_over_budget, see RFDiffusionBase._resolve_schedule
         """
-        import sys
-        sys.path.append(self.script_path)
-        import hydra
-        from run_inference import main as mn
-        from omegaconf import OmegaConf
-        from hydra.core.hydra_config import HydraConfig
-
         plen = self._validate_input(plen)
+        if params and int(params.get('partial_T') or 0) > 0:
+            raise ValueError("partial_T needs an input structure, use the inpainting model")
+        schedule = self._resolve_schedule(plen, params)
         
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            with hydra.initialize(version_base=None, config_path=self.rel_config_path):
-                cfg = self._make_config(plen=plen,outpath=tmpdirname)
-                # add dummy hydra pieces and Merge with existing config
-                cfg = OmegaConf.merge(
-                    {"hydra": self._dummy_hydra()},
-                    cfg
-                )
-                HydraConfig.instance().set_config(cfg)
-                mn(cfg)
-            with open('{}/output_0.pdb'.format(tmpdirname),'r') as f:
-                pdbtext = f.read()
+        cfg = self._make_config(plen=plen,steps=schedule['steps'])
+        pdbtext = self._sample(cfg, seed=schedule['seed'])[0]
         return pdbtext
     
     def predict(self, context, model_input : List[str], params=None) -> List[str]:
@@ -134,14 +516,14 @@ class RFDiffusionUnconditional(mlflow.pyfunc.PythonModel):
             The string of protein length, e.g "10" will internally be converted to int.
 
         params: Optional[Dict[str, Any]]
-            Additional parameters
+            Additional parameters: steps, seed and on_over_budget (see RFDiffusionBase._resolve_schedule)
         """
         if len(model_input)>1:
             raise ValueError("input must be a list with a single integer as string")
 
         # convert to int (str input is easier to manage on server side)
         plen = int(model_input[0])
-        pdb = self._run_inference(plen)
+        pdb = self._run_inference(plen, params)
         return pdb
 
 # COMMAND ----------
@@ -151,110 +533,73 @@ class RFDiffusionUnconditional(mlflow.pyfunc.PythonModel):
 
 # COMMAND ----------
 
-class RFDiffusionInpainting(mlflow.pyfunc.PythonModel):
-    def load_context(self, context):
-        self.model_path = context.artifacts['model_path']
-        self.script_path = context.artifacts['script_path']
-        
-        import sys
-        import os
-        self.config_path = context.artifacts['config_path']
-        self.rel_config_path = os.path.relpath("/", sys.argv[0])[:-3] + self.config_path
-
-        # more than this is too slow for serving...
-        self.num_designs=1
-        self.steps=20 # rfdiffusion repo suggests 20steps is usually sufficient
+class RFDiffusionInpainting(RFDiffusionBase):
+    # designs per request unless the request sets num_designs
+    num_designs = 1
+    # more than this is too slow for serving...
+    max_num_designs = 8
 
     def _validate_input(self,pdb_str):
         return True
     
-    def _make_config(self,contig_statement:str,pdb_path:str,outpath:str='out'):
-        """ creates a hydra config file for the run script"""
-        import hydra
-        # with hydra.initialize(version_base=None, config_path=self.rel_config_path):
-        cfg = hydra.compose(
-            config_name="base", 
-            overrides=[
-                f'contigmap.contigs=[{contig_statement}]',
-                f'inference.output_prefix={outpath}/output',
-                f'inference.num_designs={self.num_designs}',
-                f'inference.model_directory_path={self.model_path}',
-                f'inference.input_pdb={pdb_path}',
-                f'diffuser.T={self.steps}'
-            ],
-            return_hydra_config=True,
-        )
-        return cfg
-    
-    def _dummy_hydra(self):
-        import os
-        from omegaconf import OmegaConf
-        hydra_runtime = OmegaConf.create({
-            "runtime": {
-                "output_dir": "/path/to/outputs",  
-                "cwd": os.getcwd()
-            },
-            "job": {
-                "name": "manual_job",
-                "num": 0
-            }
-        })
-        return hydra_runtime
-
-    def _run_inference(self,input_pdb:str, start_idx:int, end_idx:int):
-        """ runs inference script with fixed environment 
+    def _make_config(
+        self,
+        contig_statement:str,
+        num_designs:int=1,
+        steps:Optional[int]=None,
+        partial_T:Optional[int]=None):
+        """ config of a request, from the base config composed in load_context """
+        updates = {
+            'contigmap.contigs': [contig_statement],
+            'inference.num_designs': num_designs,
+            'diffuser.T': steps or self.steps,
+        }
+        if partial_T is not None:
+            updates['diffuser.partial_T'] = partial_T
+        return self._config(updates)
+
+    def _run_inference(
+        self,
+        input_pdb:str,
+        start_idx:int,
+        end_idx:int,
+        num_designs:Optional[int]=None,
+        params:Optional[Dict[str, Any]]=None,
+        chain:Optional[str]=None):
+        """ runs inference with the resident sampler
         
         parameters
         -----------
         input_pdb:
-            the pdb string to generate backbone for
+            the pdb string to generate backbone for, parsed in memory (no temporary files)
+        chain:
+            chain of the residues to redesign, by default the first chain of the pdb; other chains are kept
+        num_designs:
+            number of designs to generate for the same mask (default self.num_designs, at most self.max_num_designs)
+        params:
+            steps, partial_T, seed and on_over_budget, see RFDiffusionBase._resolve_schedule
 
         idxs are inclusive (of mask) and based on indexing in the pdb file
         ie idx for start and end will both be generated
         """
-        import sys
-        sys.path.append(self.script_path)
-        from run_inference import main as mn
-        from Bio.PDB.Polypeptide import d3_to_index, dindex_to_1
-        from Bio.PDB import PDBParser
-        import hydra
-        from omegaconf import OmegaConf
-        from hydra.core.hydra_config import HydraConfig
-        
-        with (
-            tempfile.TemporaryDirectory() as tmpdirname,
-            tempfile.TemporaryDirectory() as in_tmpdirname):
-
-            input_pdb_path = os.path.join(in_tmpdirname, 'input.pdb')
-            with open(input_pdb_path, 'w') as f:
-                f.write(input_pdb)
-
-            x_len = end_idx - start_idx + 1
-
-            mysplit = input_pdb.split('\n')[:-1]
-            idxs = set()
-            for i,v in enumerate(mysplit):
-                if v.startswith('ATOM'):
-                    idxs.add(int(v[22:26].strip()))
-            seq_final_pos = max(idxs)
-
-            contigmap = f"A1-{start_idx-1}/{x_len}-{x_len}/A{end_idx+1}-{seq_final_pos}"
-            print(contigmap)
-                
-            with hydra.initialize(version_base=None, config_path=self.rel_config_path):
-                cfg = self._make_config(contigmap, input_pdb_path, outpath=tmpdirname)
-                cfg = OmegaConf.merge(
-                        {"hydra": self._dummy_hydra()},
-                        cfg
-                    )
-                HydraConfig.instance().set_config(cfg)
-                mn(cfg)
-            texts = []
-            for i in range(self.num_designs):
-                with open(f'{tmpdirname}/output_{i}.pdb','r') as f:
-                    pdbtext = f.read()
-                    texts.append(pdbtext)
-        return texts
+        num_designs = self.num_designs if num_designs is None else int(num_designs)
+        if num_designs < 1 or num_designs > self.max_num_designs:
+            raise ValueError(f"num_designs must be between 1 and {self.max_num_designs}, {num_designs} was passed")
+        # parse once: the residue ids give the contig, the features go to the sampler as they are
+        target_feats = self._target_features(input_pdb)
+        if not target_feats['pdb_idx']:
+            raise ValueError("no residues (ATOM records with a CA) in the input pdb")
+        contigmap = make_inpainting_contig(target_feats['pdb_idx'], start_idx, end_idx, chain=chain)
+        logging.getLogger(__name__).debug(f"inpainting contig {contigmap}")
+        schedule = self._resolve_schedule(len(target_feats['pdb_idx']), params, num_designs)
+            
+        cfg = self._make_config(
+            contigmap,
+            num_designs=num_designs,
+            steps=schedule['steps'],
+            partial_T=schedule['partial_T'],
+        )
+        return self._sample(cfg, seed=schedule['seed'], target_feats=target_feats)
     
     def predict(self, context, model_input : List[Dict[str,str]], params=None) -> List[str]:
         """ Generate structure of protein of given length
@@ -265,18 +610,27 @@ class RFDiffusionInpainting(mlflow.pyfunc.PythonModel):
             The mlflow context of the model. Gathered by load_context()
         
         model_input:
-            A list of dicts (pdb, start_idx, end_idx). Should only contain one entry in the list.
-            start_idx and end_idx positions are 1-indexed and are includive to the mask for inpaint
-            the pdb string should be of a pdb file that is 1-indexed for residues, no hetatm, single A chain
+            A list of dicts (pdb, start_idx, end_idx, num_designs, chain). Should only contain one entry in the list.
+            start_idx and end_idx are residue numbers of the pdb and are includive to the mask for inpaint
+            the pdb may have several chains and gaps in its residue numbering
+            num_designs (optional) is the number of designs to generate, they are returned as a list
+            chain (optional) is the chain of the masked residues, by default the first chain
 
         params: Optional[Dict[str, Any]]
-            Additional parameters
+            Additional parameters: steps, partial_T, seed and on_over_budget (see RFDiffusionBase._resolve_schedule)
         """
         if len(model_input)>1:
             raise ValueError("input must be a list with a single entry")
 
         # pdb_texts = self._run_inference(model_input[0])
-        pdb_texts = self._run_inference(model_input[0]['pdb'], int(model_input[0]['start_idx']), int(model_input[0]['end_idx']))
+        pdb_texts = self._run_inference(
+            model_input[0]['pdb'],
+            int(model_input[0]['start_idx']),
+            int(model_input[0]['end_idx']),
+            num_designs=model_input[0].get('num_designs'),
+            params=params,
+            chain=model_input[0].get('chain'),
+        )
         return pdb_texts
 
 # COMMAND ----------
@@ -376,10 +730,18 @@ pdbs[0].split('\n')[:10]
 
 # COMMAND ----------
 
+# request level diffusion schedule: partial_T <= 0 turns partial diffusion off, seed < 0 samples randomly
+schedule_params = {
+    'steps': 20,
+    'partial_T': 0,
+    'seed': -1,
+    'on_over_budget': 'downgrade',
+}
+
 signature = mlflow.models.signature.ModelSignature(
     inputs = Schema([ColSpec(type="string")]),
     outputs = Schema([ColSpec(type="string")]),
-    params = None
+    params = ParamSchema([ParamSpec(k, "string" if isinstance(v, str) else "long", v) for k, v in schedule_params.items() if k != 'partial_T'])
 )
 
 
@@ -388,14 +750,25 @@ input_example=[
     {
         'pdb':extract_chain_reindex(structure),
         'start_idx' : 12,
-        'end_idx': 22 
+        'end_idx': 22,
+        'num_designs': 1,
+        'chain': 'A',
     }
 ]
-inpaint_signature = mlflow.models.infer_signature(
-    input_example,
-    model.predict(context, input_example)
+# num_designs and chain are optional, an inferred schema would require every key of the example
+inpaint_signature = mlflow.models.signature.ModelSignature(
+    inputs = Schema([
+        ColSpec(type="string", name="pdb"),
+        ColSpec(type="long", name="start_idx"),
+        ColSpec(type="long", name="end_idx"),
+        ColSpec(type="long", name="num_designs", required=False),
+        ColSpec(type="string", name="chain", required=False),
+    ]),
+    outputs = Schema([ColSpec(type="string")]),
+    params = ParamSchema([ParamSpec(k, "string" if isinstance(v, str) else "long", v) for k, v in schedule_params.items()])
 )
 print(inpaint_signature)
+print(model.predict(context, input_example))
 
 # COMMAND ----------
 
@@ -0,0 +1,95 @@
+""" Pure Python helpers of the rfdiffusion_log notebook: the latency model and the inpainting contig
+
+The notebook imports mlflow, RFdiffusion and torch at the top, so the cells defining the helpers are
+executed on their own here, with the few modules they use.
+"""
+import itertools
+import logging
+import math
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pytest
+
+NOTEBOOK = os.path.join(os.path.dirname(__file__), '..', 'rfdiffusion_log.py')
+
+
+def _load_cells(*names):
+    with open(NOTEBOOK) as f:
+        cells = f.read().split('# COMMAND ----------')
+    namespace = {
+        'itertools': itertools, 'logging': logging, 'math': math, 'np': np,
+        'Any': Any, 'Dict': Dict, 'List': List, 'Optional': Optional, 'Tuple': Tuple,
+    }
+    for name in names:
+        cell = next(c for c in cells if f'class {name}' in c or f'def {name}(' in c)
+        exec(compile(cell, NOTEBOOK, 'exec'), namespace)
+    return namespace
+
+
+helpers = _load_cells('LatencyModel', 'make_inpainting_contig')
+LatencyModel = helpers['LatencyModel']
+make_inpainting_contig = helpers['make_inpainting_contig']
+
+
+def test_latency_estimate_sequential():
+    model = LatencyModel(seconds_per_residue_step=5e-3, overhead=2.0)
+    assert model.estimate(100, 20) == pytest.approx(12.0)
+    assert model.estimate(180, 20, num_designs=8) == pytest.approx(160.0)
+
+
+def test_latency_estimate_concurrent():
+    model = LatencyModel(seconds_per_residue_step=5e-3, overhead=2.0)
+    # the first design runs alone, the other 7 in rounds of 4
+    assert model.estimate(180, 20, num_designs=8, concurrency=4) == pytest.approx(60.0)
+    assert model.estimate(180, 20, num_designs=1, concurrency=4) == pytest.approx(20.0)
+    assert model.estimate(180, 20, num_designs=2, concurrency=4) == pytest.approx(40.0)
+
+
+@pytest.mark.parametrize('num_designs,concurrency', [(1, 1), (8, 1), (8, 4), (5, 2)])
+def test_max_steps_fits_the_budget(num_designs, concurrency):
+    model = LatencyModel(seconds_per_residue_step=5e-3, overhead=2.0)
+    steps = model.max_steps(180, 120.0, num_designs, concurrency)
+    assert model.estimate(180, steps, num_designs, concurrency) <= 120.0
+    assert model.estimate(180, steps + 1, num_designs, concurrency) > 120.0
+
+
+def test_observe_moves_towards_measured_rate():
+    model = LatencyModel(seconds_per_residue_step=5e-3, overhead=2.0, smoothing=0.5)
+    # 100 residues x 20 steps in 2 + 20 seconds: 1e-2 s per residue step
+    model.observe(100, 20, 22.0)
+    assert model.seconds_per_residue_step == pytest.approx(7.5e-3)
+    model.observe(0, 20, 5.0)
+    assert model.seconds_per_residue_step == pytest.approx(7.5e-3)
+
+
+def _residues(chain, numbers):
+    return [(chain, n) for n in numbers]
+
+
+def test_contig_single_chain():
+    pdb_idx = _residues('A', range(1, 101))
+    assert make_inpainting_contig(pdb_idx, 12, 22) == 'A1-11/11-11/A23-100'
+    assert make_inpainting_contig(pdb_idx, 1, 5) == '5-5/A6-100'
+    assert make_inpainting_contig(pdb_idx, 95, 100) == 'A1-94/6-6'
+
+
+def test_contig_gapped_numbering():
+    pdb_idx = _residues('A', itertools.chain(range(1, 61), range(65, 121)))
+    assert make_inpainting_contig(pdb_idx, 12, 22) == 'A1-11/11-11/A23-60/A65-120'
+    # a masked range spanning the gap becomes one segment of end_idx - start_idx + 1 new residues
+    assert make_inpainting_contig(pdb_idx, 58, 66) == 'A1-57/9-9/A67-120'
+
+
+def test_contig_multi_chain():
+    pdb_idx = _residues('A', range(1, 121)) + _residues('B', range(1, 81))
+    assert make_inpainting_contig(pdb_idx, 12, 22) == 'A1-11/11-11/A23-120/0 B1-80'
+    assert make_inpainting_contig(pdb_idx, 10, 20, chain='B') == 'A1-120/0 B1-9/11-11/B21-80'
+
+
+def test_contig_without_masked_residues():
+    with pytest.raises(ValueError):
+        make_inpainting_contig(_residues('A', range(1, 101)), 200, 210)
+    with pytest.raises(ValueError):
+        make_inpainting_contig(_residues('A', range(1, 101)), 10, 20, chain='B')